@@ -0,0 +1,32 @@
+"""Add worker_assignments table
+
+Revision ID: 3d9c61e5a2f4
+Revises: 7af82a346909
+Create Date: 2026-10-16 10:12:41.530981-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d9c61e5a2f4'
+down_revision = '7af82a346909'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('worker_assignments',
+        sa.Column('group', sa.String(), nullable=False),
+        sa.Column('worker', sa.SmallInteger(), nullable=False),
+        sa.Column('previous_worker', sa.SmallInteger(), nullable=True),
+        sa.Column('moved', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('group', name=op.f('worker_assignments_pk'))
+    )
+    op.create_index('changes_group_id_idx', 'changes', ['group', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('changes_group_id_idx', table_name='changes')
+    op.drop_table('worker_assignments')
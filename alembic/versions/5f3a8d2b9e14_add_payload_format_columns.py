@@ -0,0 +1,40 @@
+"""Add payload format columns
+
+Revision ID: 5f3a8d2b9e14
+Revises: e51f0a7b3c62
+Create Date: 2026-10-16 14:02:37.218840-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3a8d2b9e14'
+down_revision = 'e51f0a7b3c62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('changes', sa.Column('payload_format', sa.SmallInteger(), server_default='0', nullable=False))
+    op.add_column('changes', sa.Column('payload', sa.LargeBinary(), nullable=True))
+    op.add_column('updates', sa.Column('payload_format', sa.SmallInteger(), server_default='0', nullable=False))
+    op.add_column('updates', sa.Column('payload', sa.LargeBinary(), nullable=True))
+    op.alter_column('updates', 'message', existing_type=sa.JSON(), nullable=True)
+
+    # Packed payloads are already compressed, so don't let TOAST try again.
+    op.execute('ALTER TABLE changes ALTER COLUMN payload SET STORAGE EXTERNAL')
+    op.execute('ALTER TABLE updates ALTER COLUMN payload SET STORAGE EXTERNAL')
+
+
+def downgrade():
+    # Older code can only read JSON payloads, and packed payloads can't be
+    # converted in SQL, so drain the queues before downgrading.
+    op.execute('DELETE FROM updates WHERE payload_format != 0')
+    op.execute('DELETE FROM changes WHERE payload_format != 0')
+    op.alter_column('updates', 'message', existing_type=sa.JSON(), nullable=False)
+    op.drop_column('updates', 'payload')
+    op.drop_column('updates', 'payload_format')
+    op.drop_column('changes', 'payload')
+    op.drop_column('changes', 'payload_format')
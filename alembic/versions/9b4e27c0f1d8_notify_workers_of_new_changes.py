@@ -0,0 +1,44 @@
+"""Notify workers of new changes
+
+Revision ID: 9b4e27c0f1d8
+Revises: 3d9c61e5a2f4
+Create Date: 2026-10-16 11:03:27.114092-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4e27c0f1d8'
+down_revision = '3d9c61e5a2f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Each worker listens on channel "expanderN".  Postgres only delivers one
+    # copy of a notification per channel (with the same payload) for each
+    # transaction, so a batch of changes wakes each worker once, when the
+    # batch is committed.
+    # Changes moved to a different worker (by a resize or rebalance) also
+    # notify their new worker.
+    op.execute('''
+        CREATE FUNCTION changes_notify_worker() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('expander' || NEW.worker, '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER changes_notify_worker_trigger
+            AFTER INSERT OR UPDATE OF worker ON changes
+            FOR EACH ROW
+            EXECUTE PROCEDURE changes_notify_worker()
+    ''')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER changes_notify_worker_trigger ON changes')
+    op.execute('DROP FUNCTION changes_notify_worker()')
@@ -0,0 +1,44 @@
+"""Add chunked SYNC actions
+
+Revision ID: a83c5e17d4b0
+Revises: 5f3a8d2b9e14
+Create Date: 2026-10-16 14:48:09.513302-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83c5e17d4b0'
+down_revision = '5f3a8d2b9e14'
+branch_labels = None
+depends_on = None
+
+
+NEW_ACTIONS = ('SYNC_BEGIN', 'SYNC_CHUNK', 'SYNC_END')
+
+
+def upgrade():
+    # Before Postgres 12, ALTER TYPE ... ADD VALUE can't run inside a
+    # transaction, so end the one Alembic started.
+    op.execute('COMMIT')
+    for action in NEW_ACTIONS:
+        op.execute("ALTER TYPE changes_action_enum ADD VALUE IF NOT EXISTS '%s'"
+                   % action
+        )
+
+
+def downgrade():
+    # Enum values can't be removed, so make a new type without them.
+    op.execute("DELETE FROM changes WHERE action IN ('%s')"
+               % "', '".join(NEW_ACTIONS)
+    )
+    op.execute('ALTER TYPE changes_action_enum RENAME TO changes_action_enum_old')
+    op.execute("CREATE TYPE changes_action_enum AS ENUM "
+               "('ADD', 'REMOVE', 'SYNC', 'FLUSH_CHANGES', 'FLUSH_ALL', 'WAIT')"
+    )
+    op.execute('ALTER TABLE changes ALTER COLUMN action TYPE changes_action_enum '
+               'USING action::text::changes_action_enum'
+    )
+    op.execute('DROP TYPE changes_action_enum_old')
@@ -0,0 +1,36 @@
+"""Add delivered membership tables
+
+Revision ID: c47e9a3f8b25
+Revises: a83c5e17d4b0
+Create Date: 2026-10-16 15:20:44.871652-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47e9a3f8b25'
+down_revision = 'a83c5e17d4b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('delivered_groups',
+        sa.Column('group', sa.String(), nullable=False),
+        sa.Column('synced', sa.DateTime(), nullable=True),
+        sa.Column('sync_position', sa.String(collation='C'), nullable=True),
+        sa.PrimaryKeyConstraint('group', name=op.f('delivered_groups_pk'))
+    )
+    op.create_table('delivered_members',
+        sa.Column('group', sa.String(), nullable=False),
+        sa.Column('uniqueid', sa.String(collation='C'), nullable=False),
+        sa.Column('username', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('group', 'uniqueid', name=op.f('delivered_members_pk'))
+    )
+
+
+def downgrade():
+    op.drop_table('delivered_members')
+    op.drop_table('delivered_groups')
@@ -0,0 +1,31 @@
+"""Add change lanes
+
+Revision ID: d2b86f0e5c93
+Revises: c47e9a3f8b25
+Create Date: 2026-10-16 16:05:12.339087-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b86f0e5c93'
+down_revision = 'c47e9a3f8b25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('changes', sa.Column('lane', sa.SmallInteger(), server_default='0', nullable=False))
+    op.add_column('changes', sa.Column('created', sa.DateTime(), server_default=sa.text('now()'), nullable=False))
+    op.execute("UPDATE changes SET lane = 1 "
+               "WHERE action IN ('SYNC', 'SYNC_BEGIN', 'SYNC_CHUNK', 'SYNC_END')"
+    )
+    op.create_index('changes_worker_lane_id_idx', 'changes', ['worker', 'lane', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('changes_worker_lane_id_idx', table_name='changes')
+    op.drop_column('changes', 'created')
+    op.drop_column('changes', 'lane')
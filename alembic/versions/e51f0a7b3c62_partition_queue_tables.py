@@ -0,0 +1,132 @@
+"""Partition queue tables
+
+Revision ID: e51f0a7b3c62
+Revises: 9b4e27c0f1d8
+Create Date: 2026-10-16 12:41:55.702315-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e51f0a7b3c62'
+down_revision = '9b4e27c0f1d8'
+branch_labels = None
+depends_on = None
+
+
+# The number of IDs in each of the partitions created here.  The expander
+# creates later partitions using the [expander] partition-size option.
+PARTITION_SIZE = 1000000
+
+# The columns and constraints of each table.
+COLUMNS = {
+    'changes': '''
+        id     BIGINT              NOT NULL DEFAULT nextval('changes_id_seq'),
+        worker SMALLINT            NOT NULL,
+        action changes_action_enum NOT NULL,
+        "group" VARCHAR,
+        data   JSON,
+        CONSTRAINT changes_pk PRIMARY KEY (id)
+    ''',
+    'updates': '''
+        id             BIGINT  NOT NULL DEFAULT nextval('updates_id_seq'),
+        destination_id INTEGER,
+        message        JSON    NOT NULL,
+        CONSTRAINT updates_pk PRIMARY KEY (id),
+        CONSTRAINT updates_destination_id_fk_destinations_id
+            FOREIGN KEY (destination_id) REFERENCES destinations (id)
+            ON UPDATE CASCADE ON DELETE CASCADE
+    ''',
+}
+
+# The indexes of each table.
+INDEXES = {
+    'changes': {
+        'changes_worker_id_idx': '(worker, id)',
+        'changes_group_id_idx': '("group", id)',
+    },
+    'updates': {
+        'updates_destination_id_idx': '(destination_id, id)',
+    },
+}
+
+# The notification trigger on changes (see revision 9b4e27c0f1d8).
+CREATE_TRIGGER = '''
+    CREATE TRIGGER changes_notify_worker_trigger
+        AFTER INSERT OR UPDATE OF worker ON changes
+        FOR EACH ROW
+        EXECUTE PROCEDURE changes_notify_worker()
+'''
+
+
+def move_aside(table):
+    # Rename the existing table, and its constraints and indexes, out of the
+    # way.
+    op.execute('ALTER TABLE %s RENAME TO %s_old' % (table, table))
+    op.execute('ALTER INDEX %s_pk RENAME TO %s_old_pk' % (table, table))
+    for index in INDEXES[table]:
+        op.execute('ALTER INDEX %s RENAME TO %s_old' % (index, index))
+    if table == 'updates':
+        op.execute('ALTER TABLE updates_old RENAME CONSTRAINT '
+                   'updates_destination_id_fk_destinations_id TO '
+                   'updates_old_destination_id_fk'
+        )
+
+
+def create_indexes(table):
+    for (index, columns) in INDEXES[table].items():
+        op.execute('CREATE INDEX %s ON %s %s' % (index, table, columns))
+
+
+def upgrade():
+    connection = op.get_bind()
+    for table in ('changes', 'updates'):
+        if table == 'changes':
+            op.execute('DROP TRIGGER changes_notify_worker_trigger ON changes')
+        move_aside(table)
+
+        # Create the partitioned table, with its indexes.
+        op.execute('CREATE TABLE %s (%s) PARTITION BY RANGE (id)'
+                   % (table, COLUMNS[table])
+        )
+        create_indexes(table)
+
+        # Create partitions for everything in the old table, plus the next
+        # few IDs.
+        (min_id, next_id) = connection.execute(sa.text(
+            'SELECT MIN(id), nextval(\'%s_id_seq\') FROM %s_old'
+            % (table, table)
+        )).fetchone()
+        start = ((next_id if min_id is None else min_id)
+                 // PARTITION_SIZE) * PARTITION_SIZE
+        end = (next_id // PARTITION_SIZE + 3) * PARTITION_SIZE
+        for first_id in range(start, end, PARTITION_SIZE):
+            op.execute(
+                'CREATE TABLE %s_p%d PARTITION OF %s '
+                'FOR VALUES FROM (%d) TO (%d)'
+                % (table, first_id, table, first_id,
+                   first_id + PARTITION_SIZE)
+            )
+
+        # Copy the rows, and drop the old table.
+        op.execute('INSERT INTO %s SELECT * FROM %s_old' % (table, table))
+        op.execute('DROP TABLE %s_old' % table)
+
+    op.execute(CREATE_TRIGGER)
+
+
+def downgrade():
+    for table in ('changes', 'updates'):
+        if table == 'changes':
+            op.execute('DROP TRIGGER changes_notify_worker_trigger ON changes')
+        move_aside(table)
+
+        # Create the plain table, copy the rows, and drop the partitions.
+        op.execute('CREATE TABLE %s (%s)' % (table, COLUMNS[table]))
+        create_indexes(table)
+        op.execute('INSERT INTO %s SELECT * FROM %s_old' % (table, table))
+        op.execute('DROP TABLE %s_old' % table)
+
+    op.execute(CREATE_TRIGGER)
@@ -0,0 +1,35 @@
+"""Add shard lease tables
+
+Revision ID: f6c1d8a4e207
+Revises: d2b86f0e5c93
+Create Date: 2026-10-16 17:12:08.504316-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6c1d8a4e207'
+down_revision = 'd2b86f0e5c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('expander_hosts',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('heartbeat', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name', name=op.f('expander_hosts_pk'))
+    )
+    op.create_table('shard_leases',
+        sa.Column('shard', sa.SmallInteger(), nullable=False),
+        sa.Column('owner', sa.String(), nullable=True),
+        sa.Column('expires', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('shard', name=op.f('shard_leases_pk'))
+    )
+
+
+def downgrade():
+    op.drop_table('shard_leases')
+    op.drop_table('expander_hosts')
@@ -26,6 +26,8 @@ if (version_info[0] <= 2):
     raise OSError('Python 2 is not supported.  Please try Python 3.')
 if (version_info[0] > 3):
     raise OSError('This software has not been validated on Python 4+.')
+if (version_info[0] == 3) and (version_info[1] < 7):
+    raise OSError('Please use Python 3.7 or later')
 if int(setuptools.__version__.split('.', 1)[0]) < 18:
     raise OSError('Please use setuptools 18 or later')
 
@@ -76,11 +78,14 @@ setup(
 
     url = 'http://github.com/stanford-rc/wglurp',
 
-    packages = find_packages(),
+    packages = find_packages(exclude=['tests']),
     zip_safe = True,
     include_package_data = True,
 
-    python_requires = '>=3.3,<4',
+    # We need Python 3.7 for sqlite3 backups (used by the in-memory local
+    # database), and 3.6 for hashlib.blake2b (used to assign groups to
+    # workers) and for the asyncio expander engine.
+    python_requires = '>=3.7,<4',
     install_requires = [
         'boto3',
         'IPy',
@@ -91,10 +96,12 @@ setup(
         'syncrepl-client>=0.96',
     ],
     provides = ['stanford_wglurp'],
+    test_suite = 'tests',
     entry_points = {
         'console_scripts': [
             'wglurp-ldap = stanford_wglurp.ldap:main',
             'wglurp-expander = stanford_wglurp.expander:main',
+            'wglurp-resize-workers = stanford_wglurp.expander.resize:main',
         ],
     },
     data_files = data_files,
@@ -110,10 +117,7 @@ setup(
         'Operating System :: POSIX',
         'Operating System :: Unix',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Topic :: System :: Systems Administration :: Authentication/Directory :: LDAP'
     ]
 )
@@ -101,6 +101,12 @@ ConfigOption['ldap']['bind-method'] = 'anonymous'
 ConfigOption['ldap']['dn'] = 'dc=stanford,dc=edu'
 ConfigOption['ldap']['scope'] = 'sub'
 ConfigOption['ldap']['filter'] = '(objectClass=*)'
+ConfigOption['ldap']['membership'] = 'shared'
+ConfigOption['ldap']['checkpoint-interval'] = '300'
+ConfigOption['ldap']['group-cache-size'] = '50000'
+ConfigOption['ldap']['coalesce-window'] = '5'
+ConfigOption['ldap']['writer-queue-size'] = '10000'
+ConfigOption['ldap']['sync-chunk-size'] = '1000'
 
 ConfigOption['ldap-simple'] = {}
 ConfigOption['ldap-simple']['dn'] = 'cn=wglurp,dc=stanford,dc=edu'
@@ -122,6 +128,27 @@ ConfigOption['db']['host'] = 'localhost'
 ConfigOption['db']['port'] = '5432'
 ConfigOption['db']['database'] = 'postgres'
 ConfigOption['db']['capath'] = ''
+ConfigOption['db']['batch-size'] = '1000'
+ConfigOption['db']['assignment-ttl'] = '60'
+ConfigOption['db']['payload-format'] = 'packed'
+
+# Expander options
+ConfigOption['expander'] = {}
+ConfigOption['expander']['batch-size'] = '100'
+ConfigOption['expander']['bulk-reserve'] = '10'
+ConfigOption['expander']['rebalance-interval'] = '60'
+ConfigOption['expander']['rebalance-threshold'] = '1.5'
+ConfigOption['expander']['partition-size'] = '1000000'
+ConfigOption['expander']['partition-interval'] = '300'
+ConfigOption['expander']['compact-interval'] = '30'
+ConfigOption['expander']['engine'] = 'sync'
+ConfigOption['expander']['concurrency'] = '8'
+ConfigOption['expander']['min-processes'] = ''
+ConfigOption['expander']['max-processes'] = ''
+ConfigOption['expander']['scale-interval'] = '30'
+ConfigOption['expander']['scale-up-wait'] = '30'
+ConfigOption['expander']['lease-interval'] = '2'
+ConfigOption['expander']['lease-timeout'] = '10'
 
 ConfigOption['db-access'] = {}
 ConfigOption['db-access']['username'] = 'postgres'
@@ -333,6 +360,81 @@ if not path.isdir(ldap_dir):
     )
 del(ldap_dir)
 
+# Now check membership.
+if ConfigOption['ldap']['membership'] not in ['shared', 'wal', 'memory']:
+    validation_error('ldap', 'membership',
+        'Mode "%s" is invalid.  Valid values are "shared", "wal", and '
+        '"memory".' % ConfigOption['ldap']['membership']
+    )
+
+# Checkpoints use the sqlite backup API, which needs Python 3.7+.
+if ConfigOption['ldap']['membership'] == 'memory':
+    import sqlite3
+    if not hasattr(sqlite3.Connection, 'backup'):
+        validation_error('ldap', 'membership',
+            'The "memory" mode needs the sqlite3 backup API (Python 3.7+).'
+        )
+
+# Make sure checkpoint-interval is a positive number.
+try:
+    if int(ConfigOption['ldap']['checkpoint-interval']) <= 0:
+        validation_error('ldap', 'checkpoint-interval',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('ldap', 'checkpoint-interval',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['ldap']['checkpoint-interval']
+    )
+
+# Make sure group-cache-size is a positive number.
+try:
+    if int(ConfigOption['ldap']['group-cache-size']) <= 0:
+        validation_error('ldap', 'group-cache-size',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('ldap', 'group-cache-size',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['ldap']['group-cache-size']
+    )
+
+# Make sure coalesce-window is not negative.
+try:
+    if float(ConfigOption['ldap']['coalesce-window']) < 0:
+        validation_error('ldap', 'coalesce-window',
+                         'Value is negative'
+        )
+except ValueError:
+    validation_error('ldap', 'coalesce-window',
+                     'Value "%s" is not a number'
+                     % ConfigOption['ldap']['coalesce-window']
+    )
+
+# Make sure writer-queue-size is a positive number.
+try:
+    if int(ConfigOption['ldap']['writer-queue-size']) <= 0:
+        validation_error('ldap', 'writer-queue-size',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('ldap', 'writer-queue-size',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['ldap']['writer-queue-size']
+    )
+
+# Make sure sync-chunk-size is a positive number.
+try:
+    if int(ConfigOption['ldap']['sync-chunk-size']) <= 0:
+        validation_error('ldap', 'sync-chunk-size',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('ldap', 'sync-chunk-size',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['ldap']['sync-chunk-size']
+    )
+
 # Now check url.
 
 # First we validate the LDAP URL by building it.
@@ -555,6 +657,36 @@ if ConfigOption['db']['capath'] != '':
         )
     del(ssl_context)
 
+# Make sure batch-size is a positive number.
+try:
+    if int(ConfigOption['db']['batch-size']) <= 0:
+        validation_error('db', 'batch-size',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('db', 'batch-size',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['db']['batch-size']
+    )
+
+# Make sure assignment-ttl is a positive number.
+try:
+    if float(ConfigOption['db']['assignment-ttl']) <= 0:
+        validation_error('db', 'assignment-ttl',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('db', 'assignment-ttl',
+                     'Value "%s" is not a number'
+                     % ConfigOption['db']['assignment-ttl']
+    )
+
+if ConfigOption['db']['payload-format'] not in ['json', 'packed']:
+    validation_error('db', 'payload-format',
+        'Format "%s" is invalid.  Valid values are "json" and "packed".'
+        % ConfigOption['db']['payload-format']
+    )
+
 # There are no real checks to do for the db-access items.
 
 # Now check db-cert
@@ -592,6 +724,176 @@ except Exception as e:
                      'Unable to connect to database: %s' % e
     )
 
+# Now check expander
+
+# Make sure batch-size is a positive number.
+try:
+    if int(ConfigOption['expander']['batch-size']) <= 0:
+        validation_error('expander', 'batch-size',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('expander', 'batch-size',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['expander']['batch-size']
+    )
+
+# Make sure bulk-reserve is not negative.
+try:
+    if int(ConfigOption['expander']['bulk-reserve']) < 0:
+        validation_error('expander', 'bulk-reserve',
+                         'Value is negative'
+        )
+except ValueError:
+    validation_error('expander', 'bulk-reserve',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['expander']['bulk-reserve']
+    )
+
+# Make sure rebalance-interval is not negative.
+try:
+    if float(ConfigOption['expander']['rebalance-interval']) < 0:
+        validation_error('expander', 'rebalance-interval',
+                         'Value is negative'
+        )
+except ValueError:
+    validation_error('expander', 'rebalance-interval',
+                     'Value "%s" is not a number'
+                     % ConfigOption['expander']['rebalance-interval']
+    )
+
+# Make sure rebalance-threshold is more than 1.
+try:
+    if float(ConfigOption['expander']['rebalance-threshold']) <= 1:
+        validation_error('expander', 'rebalance-threshold',
+                         'Value must be more than 1'
+        )
+except ValueError:
+    validation_error('expander', 'rebalance-threshold',
+                     'Value "%s" is not a number'
+                     % ConfigOption['expander']['rebalance-threshold']
+    )
+
+# Make sure partition-size is a positive number.
+try:
+    if int(ConfigOption['expander']['partition-size']) <= 0:
+        validation_error('expander', 'partition-size',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('expander', 'partition-size',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['expander']['partition-size']
+    )
+
+# Make sure partition-interval is a positive number.
+try:
+    if float(ConfigOption['expander']['partition-interval']) <= 0:
+        validation_error('expander', 'partition-interval',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('expander', 'partition-interval',
+                     'Value "%s" is not a number'
+                     % ConfigOption['expander']['partition-interval']
+    )
+
+# Make sure compact-interval is not negative.
+try:
+    if float(ConfigOption['expander']['compact-interval']) < 0:
+        validation_error('expander', 'compact-interval',
+                         'Value is negative'
+        )
+except ValueError:
+    validation_error('expander', 'compact-interval',
+                     'Value "%s" is not a number'
+                     % ConfigOption['expander']['compact-interval']
+    )
+
+if ConfigOption['expander']['engine'] not in ['sync', 'asyncio']:
+    validation_error('expander', 'engine',
+        'Engine "%s" is invalid.  Valid values are "sync" and "asyncio".'
+        % ConfigOption['expander']['engine']
+    )
+
+# Make sure concurrency is a positive number.
+try:
+    if int(ConfigOption['expander']['concurrency']) <= 0:
+        validation_error('expander', 'concurrency',
+                         'Value is not a positive number'
+        )
+except ValueError:
+    validation_error('expander', 'concurrency',
+                     'Value "%s" is not an integer'
+                     % ConfigOption['expander']['concurrency']
+    )
+
+# min-processes and max-processes default to the number of queues, and must
+# be between 1 and that.
+for option in ('max-processes', 'min-processes'):
+    if ConfigOption['expander'][option] == '':
+        ConfigOption['expander'][option] = (
+            ConfigOption['expander']['max-processes']
+            if option == 'min-processes'
+            else ConfigOption['ldap']['workers']
+        )
+    try:
+        if not (1 <= int(ConfigOption['expander'][option])
+                   <= int(ConfigOption['ldap']['workers'])):
+            validation_error('expander', option,
+                             'Value must be between 1 and [ldap] workers'
+            )
+    except ValueError:
+        validation_error('expander', option,
+                         'Value "%s" is not an integer'
+                         % ConfigOption['expander'][option]
+        )
+try:
+    if (int(ConfigOption['expander']['min-processes'])
+        > int(ConfigOption['expander']['max-processes'])
+    ):
+        validation_error('expander', 'min-processes',
+                         'Value is more than max-processes'
+        )
+except ValueError:
+    pass
+
+# Make sure scale-interval is zero or more, and scale-up-wait is positive.
+for (option, minimum) in (('scale-interval', 0), ('scale-up-wait', 0.001)):
+    try:
+        if float(ConfigOption['expander'][option]) < minimum:
+            validation_error('expander', option,
+                             'Value is too small'
+            )
+    except ValueError:
+        validation_error('expander', option,
+                         'Value "%s" is not a number'
+                         % ConfigOption['expander'][option]
+        )
+
+# Make sure lease-interval and lease-timeout are positive numbers, and that
+# leases are renewed well before they expire.
+for option in ('lease-interval', 'lease-timeout'):
+    try:
+        if float(ConfigOption['expander'][option]) <= 0:
+            validation_error('expander', option,
+                             'Value is not a positive number'
+            )
+    except ValueError:
+        validation_error('expander', option,
+                         'Value "%s" is not a number'
+                         % ConfigOption['expander'][option]
+        )
+try:
+    if (float(ConfigOption['expander']['lease-timeout'])
+        < 3 * float(ConfigOption['expander']['lease-interval'])
+    ):
+        validation_error('expander', 'lease-timeout',
+                         'Value must be at least 3 times lease-interval'
+        )
+except ValueError:
+    pass
+
 # Now check challenge
 
 # Make sure the master seed is 64 hex characters
@@ -13,11 +13,38 @@ from .. import logging
 # Get our configuration object
 from ..config import ConfigOption
 
+from . import encoding
 from . import engine
 from . import schema
+from .workers import assignments
+from itertools import islice
 import json
 
 
+# Changes are split into lanes, so that a pile of big SYNCs doesn't hold up
+# small changes.  Workers take changes from the delta lane first.
+LANE_DELTA = 0
+LANE_BULK = 1
+LANE_NAMES = {
+    LANE_DELTA: 'delta',
+    LANE_BULK: 'bulk',
+}
+
+
+def lane_for_action(action):
+    """Get the lane for a change.
+
+    :param str action: The change action.
+
+    :returns: LANE_BULK for SYNCs (including chunked SYNCs), and LANE_DELTA
+    for everything else.
+    """
+    if action in ('SYNC', 'SYNC_BEGIN', 'SYNC_CHUNK', 'SYNC_END'):
+        return LANE_BULK
+    else:
+        return LANE_DELTA
+
+
 class ChangeEntry(object):
     
     def __init__(self, change=None, **kwargs):
@@ -34,8 +61,9 @@ class ChangeEntry(object):
             if type(change) is not schema.Changes:
                 raise Exception()
 
-            # Copy it in!
+            # Copy it in!  It already has a worker.
             self.change = change
+            self.calculated = True
 
         # If we did not get a change object, build one!
         else:
@@ -48,11 +76,17 @@ class ChangeEntry(object):
 
             # Construct a database object from what we got.
             # NOTE: We use worker #0 for now.
+            (payload_format, data, payload) = encoding.encode_members(
+                kwargs['members']
+            )
             self.change = schema.Changes(
                 worker = 0,
                 action = kwargs['action'],
                 group  = kwargs['group'],
-                data   = list(kwargs['members']),
+                data   = data,
+                payload_format = payload_format,
+                payload = payload,
+                lane = lane_for_action(kwargs['action']),
             )
 
             # Mark that calculation has not been completed.
@@ -66,13 +100,13 @@ class ChangeEntry(object):
         if self.calculated is True:
             return
 
-        if self.change in ('FLUSH_CHANGES', 'FLUSH_ALL', 'WAIT'):
+        if self.change.action in ('FLUSH_CHANGES', 'FLUSH_ALL', 'WAIT'):
             self.change.worker = 0
         else:
-            # The worker is based on the group name, mod the number of workers.
-            # Then, shift up one, so that worker #0 is reserved.
-            self.change.worker = 1 + (hash(self.change.group) %
-                                 int(ConfigOption['ldap']['workers']))
+            # The worker is based on a stable hash of the group name, unless
+            # the group has been assigned to a worker.
+            # (Worker #0 is reserved, and is never picked.)
+            self.change.worker = assignments.worker(self.change.group)
 
         self.calculated = True
 
@@ -80,3 +114,72 @@ class ChangeEntry(object):
     def add(self, session):
         self.calculate_worker()
         session.add(self.change)
+
+
+    def members(self):
+        """Get the members in this change, however they are stored.
+
+        :returns: A list of (uniqueid, username) tuples.
+        """
+        return encoding.decode_members(
+            self.change.payload_format,
+            self.change.data,
+            self.change.payload,
+        )
+
+
+    def row(self):
+        """Get this change as a dict of column values, for bulk inserts.
+        """
+        self.calculate_worker()
+        return {
+            'worker': self.change.worker,
+            'action': self.change.action,
+            'group': self.change.group,
+            'data': self.change.data,
+            'payload_format': self.change.payload_format,
+            'payload': self.change.payload,
+            'lane': self.change.lane,
+        }
+
+
+def write_changes(session, entries, batch_size=None):
+    """Write many change entries to the database, in one transaction.
+
+    :param session: A database session, which is not in autocommit mode.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param entries: The change entries to write.
+    :type entries: Iterable of ChangeEntry
+
+    :param int batch_size: The number of changes to put into each INSERT.  If
+    not provided, the `[db] batch-size` option is used.
+
+    :returns: The number of changes written.
+
+    Changes are written with multi-row INSERT statements, instead of one
+    INSERT for each change, and are committed once at the end.  The entries
+    are read one batch at a time, so they may come from a generator.
+
+    If anything fails, the transaction is rolled back, and the exception is
+    raised.
+    """
+    if batch_size is None:
+        batch_size = int(ConfigOption['db']['batch-size'])
+
+    insert = schema.Changes.__table__.insert()
+    entries = iter(entries)
+    change_count = 0
+    try:
+        while True:
+            rows = [entry.row() for entry in islice(entries, batch_size)]
+            if len(rows) == 0:
+                break
+            session.execute(insert.values(rows))
+            change_count = change_count + len(rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return change_count
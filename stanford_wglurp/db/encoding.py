@@ -0,0 +1,158 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# wglurp queue payload encoding.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# Change and update payloads can be big: a SYNC for a large group lists every
+# member.  Stored as JSON text, that is megabytes of repeated brackets and
+# quotes, which Postgres has to store (and write to the WAL), and which we
+# have to parse again on every read.
+#
+# So, each queue row says how its payload is encoded, in its payload_format
+# column.  Rows in the JSON format keep their payload in the old JSON column
+# (data for changes, message for updates).  Rows in any other format keep
+# their payload in the payload (bytea) column instead:
+#
+# * PACKED: A member list, as UTF-8 "uniqueid NUL username NUL ..." (LDAP
+#   strings can't contain NUL), compressed with zlib.
+#
+# * ZJSON: Any JSON value, as compact JSON, compressed with zlib.
+#
+# Readers must handle every format, so that rows written before a format
+# change (or by an older writer) can still be read.  Writers use the format
+# from the `[db] payload-format` option.
+
+
+# Logging must always be imported first!
+from .. import logging
+
+# Get our configuration object
+from ..config import ConfigOption
+
+import json
+import zlib
+
+
+# The payload formats.  These values are stored in the database, so they must
+# never change.
+PAYLOAD_JSON = 0
+PAYLOAD_PACKED = 1
+PAYLOAD_ZJSON = 2
+
+# The zlib compression level.  Level 1 is much faster than the default, and
+# still gets most of the benefit, since member lists repeat a lot.
+COMPRESSION_LEVEL = 1
+
+
+def writer_packs():
+    """Check if new payloads should be packed.
+
+    :returns: True if the `[db] payload-format` option is "packed".
+    """
+    return (ConfigOption['db']['payload-format'] == 'packed')
+
+
+def encode_members(members, packed=None):
+    """Encode a member list, for the changes table.
+
+    :param members: The members.
+    :type members: Iterable of (uniqueid, username) tuples
+
+    :param bool packed: If True, use the PACKED format; if False, use the
+    JSON format.  If not provided, the `[db] payload-format` option is used.
+
+    :returns: A tuple of (payload format, data, payload), where data is for
+    the JSON column, and payload is for the payload column.  Whichever one is
+    not used is None.
+    """
+    if packed is None:
+        packed = writer_packs()
+    if packed is False:
+        return (PAYLOAD_JSON, [list(member) for member in members], None)
+
+    fields = list()
+    for (uniqueid, username) in members:
+        fields.append(uniqueid)
+        fields.append(username)
+    packed_members = '\0'.join(fields).encode('utf-8')
+    return (PAYLOAD_PACKED, None,
+            zlib.compress(packed_members, COMPRESSION_LEVEL))
+
+
+def decode_members(payload_format, data, payload):
+    """Decode a member list, from the changes table.
+
+    :param int payload_format: The row's payload format.
+
+    :param data: The row's JSON column.
+
+    :param bytes payload: The row's payload column.
+
+    :returns: A list of (uniqueid, username) tuples.
+
+    :raises ValueError: The payload format is not known.
+    """
+    if payload_format == PAYLOAD_JSON:
+        if data is None:
+            return list()
+        return [tuple(member) for member in data]
+    elif payload_format == PAYLOAD_PACKED:
+        packed_members = zlib.decompress(bytes(payload))
+        if len(packed_members) == 0:
+            return list()
+        fields = iter(packed_members.decode('utf-8').split('\0'))
+        return list(zip(fields, fields))
+    elif payload_format == PAYLOAD_ZJSON:
+        return [tuple(member) for member in decode_message(
+            payload_format, data, payload
+        )]
+    else:
+        raise ValueError('Unknown payload format %s' % payload_format)
+
+
+def encode_message(message, packed=None):
+    """Encode a message, for the updates table.
+
+    :param message: The message, which can be anything JSON can hold.
+
+    :param bool packed: If True, use the ZJSON format; if False, use the JSON
+    format.  If not provided, the `[db] payload-format` option is used.
+
+    :returns: A tuple of (payload format, message, payload), where message is
+    for the JSON column, and payload is for the payload column.  Whichever one
+    is not used is None.
+    """
+    if packed is None:
+        packed = writer_packs()
+    if packed is False:
+        return (PAYLOAD_JSON, message, None)
+    encoded_message = json.dumps(message, separators=(',', ':'))
+    return (PAYLOAD_ZJSON, None,
+            zlib.compress(encoded_message.encode('utf-8'), COMPRESSION_LEVEL))
+
+
+def decode_message(payload_format, message, payload):
+    """Decode a message, from the updates table.
+
+    :param int payload_format: The row's payload format.
+
+    :param message: The row's JSON column.
+
+    :param bytes payload: The row's payload column.
+
+    :returns: The message.
+
+    :raises ValueError: The payload format is not known, or is not valid for
+    messages.
+    """
+    if payload_format == PAYLOAD_JSON:
+        return message
+    elif payload_format == PAYLOAD_ZJSON:
+        return json.loads(zlib.decompress(bytes(payload)).decode('utf-8'))
+    else:
+        raise ValueError('Payload format %s is not valid for messages'
+                         % payload_format
+        )
@@ -57,7 +57,11 @@ db_url = URL('postgresql',
 
 
 # Create an Engine for our URL.
-DB = create_engine(db_url)
+# The asyncio expander engine uses a connection for each group in flight, plus
+# one for claiming changes, so make sure the pool has room for them.
+DB = create_engine(db_url,
+    pool_size = max(5, int(ConfigOption['expander']['concurrency']) + 1)
+)
 DBAC = create_engine(db_url, isolation_level='AUTOCOMMIT')
 
 # Create a session factory, bound to our engine.
@@ -0,0 +1,214 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# wglurp queue table partitions.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# The changes and updates tables are queues: rows are added at one end, and
+# deleted from the other.  Deleting leaves dead rows (and index entries)
+# behind, which Postgres has to vacuum, and which slow down the queries that
+# look for the head of the queue.
+#
+# So, both tables are partitioned by ID range.  New rows always go into the
+# newest partitions, and once every row in an old partition has been deleted,
+# the whole partition is dropped, taking its dead rows with it.
+#
+# Partitions are named after the table and the first ID they hold (like
+# "changes_p2000000").  This code makes sure that there are always partitions
+# ready for the next few ranges of IDs, and drops partitions once they are
+# empty and no new IDs can land in them.
+#
+# NOTE: Partitioned tables (with primary keys, foreign keys, and row
+# triggers) need Postgres 11 or later.
+
+
+# Logging must always be imported first!
+from ..logging import logger
+
+import re
+import sqlalchemy
+
+
+# The tables which are partitioned.
+PARTITIONED_TABLES = ('changes', 'updates')
+
+# Used to parse a partition's bounds.
+BOUND_RE = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+
+def list_partitions(session, table):
+    """List the partitions of a table.
+
+    :param session: A database session.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str table: The name of the partitioned table.
+
+    :returns: A list of (partition name, first ID, end ID) tuples, sorted by
+    first ID.  The end ID is not included in the partition.
+    """
+    result = session.execute(sqlalchemy.text('''
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+          FROM pg_inherits
+          JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+          JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+         WHERE parent.relname = :table
+    '''), {'table': table})
+
+    partitions = list()
+    for (name, bound) in result:
+        match = BOUND_RE.search(bound)
+        if match is None:
+            logger.warning('Partition %s has unexpected bounds "%s"'
+                           % (name, bound)
+            )
+            continue
+        partitions.append((name, int(match.group(1)), int(match.group(2))))
+    partitions.sort(key=lambda partition: partition[1])
+    return partitions
+
+
+def next_id(session, table):
+    """Get the next ID which a table's sequence will hand out.
+
+    :param session: A database session.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str table: The name of the table.
+
+    :returns: An int.
+    """
+    (last_value, is_called) = session.execute(sqlalchemy.text(
+        'SELECT last_value, is_called FROM %s_id_seq' % table
+    )).fetchone()
+    return (last_value + 1 if is_called else last_value)
+
+
+def create_partitions(session, table, size, ahead):
+    """Make sure partitions exist for upcoming IDs.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str table: The name of the partitioned table.
+
+    :param int size: The number of IDs in each new partition.
+
+    :param int ahead: The number of partitions to have ready, past the one
+    holding the next ID.
+
+    :returns: The number of partitions created.
+
+    Transaction management is left to the caller.
+    """
+    upcoming_id = next_id(session, table)
+    partitions = list_partitions(session, table)
+    if len(partitions) == 0:
+        end = (upcoming_id // size) * size
+    else:
+        end = partitions[-1][2]
+        if end < upcoming_id:
+            logger.critical('Table %s has no partition for IDs %d to %d!'
+                            % (table, end, upcoming_id)
+            )
+            end = (upcoming_id // size) * size
+
+    # Keep going until the partition after the "next ID" partition is ready.
+    created_count = 0
+    target = upcoming_id + (ahead + 1) * size
+    while end < target:
+        name = '%s_p%d' % (table, end)
+        logger.info('Creating partition %s, for IDs %d to %d'
+                    % (name, end, end + size - 1)
+        )
+        session.execute(sqlalchemy.text(
+            'CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%d) TO (%d)'
+            % (name, table, end, end + size)
+        ))
+        end = end + size
+        created_count = created_count + 1
+    return created_count
+
+
+def drop_partitions(session, table):
+    """Drop old partitions which are empty.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str table: The name of the partitioned table.
+
+    :returns: The number of partitions dropped.
+
+    A partition is dropped once its IDs are all in the past (so nothing new
+    will land in it) and it has no rows.  Each partition is checked on its
+    own: the worker queues drain independently (and parked changes don't
+    drain at all), so an older partition with rows doesn't stop a newer,
+    empty one from being dropped.
+
+    Before it is dropped, the partition is locked and checked again, so that
+    a transaction which is still adding rows to it finishes first.  Workers
+    lock the parent table before its partitions, so we do the same, to avoid
+    deadlocking with them.  The parent is only locked if there is something
+    to drop.
+
+    Transaction management is left to the caller.
+    """
+    upcoming_id = next_id(session, table)
+    empty_partitions = list()
+    for (name, first_id, end_id) in list_partitions(session, table):
+        if end_id > upcoming_id:
+            break
+        row_exists = session.execute(sqlalchemy.text(
+            'SELECT EXISTS (SELECT 1 FROM %s)' % name
+        )).scalar()
+        if not row_exists:
+            empty_partitions.append(name)
+    if len(empty_partitions) == 0:
+        return 0
+
+    session.execute(sqlalchemy.text(
+        'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % table
+    ))
+    dropped_count = 0
+    for name in empty_partitions:
+        session.execute(sqlalchemy.text(
+            'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % name
+        ))
+        row_exists = session.execute(sqlalchemy.text(
+            'SELECT EXISTS (SELECT 1 FROM %s)' % name
+        )).scalar()
+        if row_exists:
+            continue
+        logger.info('Dropping empty partition %s' % name)
+        session.execute(sqlalchemy.text('DROP TABLE %s' % name))
+        dropped_count = dropped_count + 1
+    return dropped_count
+
+
+def maintain_partitions(session, size, ahead=2):
+    """Create upcoming partitions, and drop empty ones, for every queue.
+
+    :param session: A database session, which is not in autocommit mode.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param int size: The number of IDs in each new partition.
+
+    :param int ahead: The number of partitions to have ready, past the one
+    holding the next ID.
+
+    :returns: None.
+
+    Each table is handled in its own transaction.
+    """
+    for table in PARTITIONED_TABLES:
+        try:
+            create_partitions(session, table, size, ahead)
+            session.commit()
+            drop_partitions(session, table)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
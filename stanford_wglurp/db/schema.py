@@ -14,6 +14,7 @@ from sqlalchemy import (BigInteger, Binary, Column, DateTime, Enum, ForeignKey,
                         Index, Integer, SmallInteger, String, Sequence)
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import MetaData
 
@@ -40,6 +41,9 @@ class Changes(BaseTable):
 
     This table is a queue of group changes.  The queue is written to by the
     Syncrepl client (a single process).  The queue is read by multiple workers.
+
+    The table is partitioned by ID range (see revision e51f0a7b3c62, and
+    :mod:`stanford_wglurp.db.partitions`), which SQLAlchemy doesn't know about.
     """
     __tablename__ = 'changes'
 
@@ -57,6 +61,8 @@ class Changes(BaseTable):
 
     # The ID of the worker whose queue this is in.
     # Worker #0 is special, and is used for FLUSH_CHANGES, FLUSH_ALL, and WAIT.
+    # A negative number is a change which couldn't be processed, and has been
+    # parked (see stanford_wglurp.expander.worker.park_change).
     worker = Column(
         SmallInteger,
         nullable = False
@@ -66,6 +72,9 @@ class Changes(BaseTable):
     # * ADD and REMOVE indicate that one or more people are being added/removed
     # from a group.
     # * SYNC indicates the group membership list is being replaced.
+    # * SYNC_BEGIN, SYNC_CHUNK, and SYNC_END are a SYNC for a big group, sent
+    # in pieces: SYNC_BEGIN starts the new membership list, each SYNC_CHUNK
+    # adds to it, and SYNC_END means the list is complete.
     # * FLUSH_CHANGES, FLUSH_ALL, and WAIT are all to be defined.
     action = Column(
         Enum(
@@ -75,6 +84,9 @@ class Changes(BaseTable):
             'FLUSH_CHANGES',
             'FLUSH_ALL',
             'WAIT',
+            'SYNC_BEGIN',
+            'SYNC_CHUNK',
+            'SYNC_END',
             name = 'changes_action_enum',
         ),
         nullable = False
@@ -90,15 +102,193 @@ class Changes(BaseTable):
     # * For ADD and REMOVE, this is a JSON list of people to add to/remove from
     # the group.
     # * For SYNC, this is a JSON list of people who are in the group.
+    # * For SYNC_CHUNK, this is a JSON list of some of the people who are in
+    # the group, sorted by unique ID.
+    # * For SYNC_BEGIN and SYNC_END, this is an empty list.
     # * For FLUSH_CHANGES, FLUSH_ALL, and WAIT, this is undefined.
+    # Only used when payload_format is 0 (JSON).
     data = Column(
         JSON,
     )
 
+    # How the contents of the change are encoded.  See
+    # stanford_wglurp.db.encoding for the formats.
+    payload_format = Column(
+        SmallInteger,
+        nullable = False,
+        server_default = '0'
+    )
+
+    # The encoded contents of the change, when payload_format is not 0.
+    payload = Column(
+        Binary,
+    )
+
+    # The lane the change is in.  Workers take changes from lane 0 (small
+    # changes) before lane 1 (SYNCs).  See stanford_wglurp.db.changes.
+    lane = Column(
+        SmallInteger,
+        nullable = False,
+        server_default = '0'
+    )
+
+    # When the change was added to the queue.
+    created = Column(
+        DateTime,
+        nullable = False,
+        server_default = func.now()
+    )
+
 
 # Create an index on the worker ID and change ID.
 Index('changes_worker_id_idx', Changes.worker, Changes.id)
 
+# Create an index on the worker ID, lane, and change ID, for workers taking
+# changes one lane at a time.
+Index('changes_worker_lane_id_idx', Changes.worker, Changes.lane, Changes.id)
+
+# Create an index on the group and change ID, so a worker can check that no
+# older change for the same group is waiting on another worker.
+Index('changes_group_id_idx', Changes.group, Changes.id)
+
+
+class WorkerAssignments(BaseTable):
+    """Groups which have been moved to a specific worker.
+
+    Normally, a group's worker comes from a hash of the group name.  This
+    table overrides that for some groups (normally, big and busy ones), so
+    that the work can be spread out evenly.  It is maintained by the
+    expander's rebalancer, and read (through a cache) by the Syncrepl client.
+    """
+    __tablename__ = 'worker_assignments'
+
+    # The name of the group.
+    group = Column(
+        String,
+        primary_key = True
+    )
+
+    # The ID of the worker handling this group.
+    worker = Column(
+        SmallInteger,
+        nullable = False
+    )
+
+    # The ID of the worker which handled this group before.
+    previous_worker = Column(
+        SmallInteger,
+    )
+
+    # When the group was moved.
+    moved = Column(
+        DateTime,
+        nullable = False
+    )
+
+
+class ExpanderHosts(BaseTable):
+    """The expander hosts which are running.
+
+    Each expander supervisor updates its row every few seconds.  Hosts whose
+    heartbeat is recent count towards each host's share of the shards.
+    """
+    __tablename__ = 'expander_hosts'
+
+    # The name of the host (and the supervisor's PID).
+    name = Column(
+        String,
+        primary_key = True
+    )
+
+    # When the host last checked in.
+    heartbeat = Column(
+        DateTime,
+        nullable = False
+    )
+
+
+class ShardLeases(BaseTable):
+    """Which expander host handles each shard (worker queue).
+
+    An expander host only runs workers for the shards it has a lease on.  The
+    host renews its leases every few seconds; once a lease expires, any other
+    host may take the shard.  See :mod:`stanford_wglurp.expander.leases`.
+    """
+    __tablename__ = 'shard_leases'
+
+    # The shard (worker) number.
+    shard = Column(
+        SmallInteger,
+        primary_key = True
+    )
+
+    # The name of the host holding the lease, or NULL if nobody does.
+    owner = Column(
+        String,
+    )
+
+    # When the lease expires.
+    expires = Column(
+        DateTime,
+    )
+
+
+class DeliveredGroups(BaseTable):
+    """The groups whose membership the expander has delivered.
+
+    A group gets a row once any of its changes has been processed.  Once a
+    complete SYNC has been processed, the group has a baseline, and later
+    SYNCs are turned into ADD and REMOVE updates, instead of being sent in
+    full.
+    """
+    __tablename__ = 'delivered_groups'
+
+    # The name of the group.
+    group = Column(
+        String,
+        primary_key = True
+    )
+
+    # When the last complete SYNC was processed.  If NULL, the group has no
+    # baseline.
+    synced = Column(
+        DateTime,
+    )
+
+    # During a chunked SYNC, the unique ID of the last member in the last
+    # chunk processed (or an empty string, if no chunks have been processed).
+    # NULL when no chunked SYNC is in progress.
+    sync_position = Column(
+        String(collation='C'),
+    )
+
+
+class DeliveredMembers(BaseTable):
+    """The last-delivered membership of each group.
+
+    Unique IDs use the "C" collation, so that they sort the same way here as
+    they do in the LDAP client's sqlite database, and in Python.
+    """
+    __tablename__ = 'delivered_members'
+
+    # The name of the group.
+    group = Column(
+        String,
+        primary_key = True
+    )
+
+    # The member's unique ID.
+    uniqueid = Column(
+        String(collation='C'),
+        primary_key = True
+    )
+
+    # The member's username.
+    username = Column(
+        String,
+        nullable = False
+    )
+
 
 class Destinations(BaseTable):
     __tablename__ = 'destinations'
@@ -311,9 +501,22 @@ class Updates(BaseTable):
     destination = relationship('Destinations')
 
     # The message to pass to the destination.
+    # Only used when payload_format is 0 (JSON).
     message = Column(
         JSON,
-        nullable = False
+    )
+
+    # How the message is encoded.  See stanford_wglurp.db.encoding for the
+    # formats.
+    payload_format = Column(
+        SmallInteger,
+        nullable = False,
+        server_default = '0'
+    )
+
+    # The encoded message, when payload_format is not 0.
+    payload = Column(
+        Binary,
     )
 
 
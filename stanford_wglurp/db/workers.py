@@ -0,0 +1,222 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# wglurp worker assignment.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# Every change for a group goes to the same worker, so that a group's changes
+# are processed in order.  The worker is picked with a "jump" consistent hash
+# (Lamping & Veach, https://arxiv.org/abs/1406.2294) of the group name.  The
+# hash of the name is stable across processes (unlike Python's built-in
+# hash), and when the number of workers changes, only the groups which have to
+# move (about 1/N of them) get a different worker.
+#
+# Some groups are moved to a specific worker by the expander's rebalancer.
+# Those are listed in the worker_assignments table, which the Syncrepl client
+# reads through the AssignmentCache.
+
+
+# Logging must always be imported first!
+from ..logging import logger
+
+# Get our configuration object
+from ..config import ConfigOption
+
+import hashlib
+import sqlalchemy
+import time
+
+from . import engine
+from . import schema
+
+
+def group_key(group):
+    """Get a stable 64-bit key for a group name.
+
+    :param str group: The name of the group.
+
+    :returns: An int.
+    """
+    digest = hashlib.blake2b(group.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def jump_hash(key, buckets):
+    """Pick a bucket for a key, using jump consistent hashing.
+
+    :param int key: A 64-bit key.
+
+    :param int buckets: The number of buckets.
+
+    :returns: An int, from zero to buckets - 1.
+    """
+    b = -1
+    j = 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def worker_for_group(group, workers=None):
+    """Get the worker which handles a group's changes.
+
+    :param str group: The name of the group.
+
+    :param int workers: The number of workers.  If not provided, the
+    `[ldap] workers` option is used.
+
+    :returns: A worker number, from 1 to the number of workers.
+
+    Worker #0 is reserved, so it is never returned.
+    """
+    if workers is None:
+        workers = int(ConfigOption['ldap']['workers'])
+    return 1 + jump_hash(group_key(group), workers)
+
+
+class AssignmentCache(object):
+    """A cache of the worker_assignments table.
+
+    :param float ttl: The number of seconds to keep the cache, before it is
+    re-read.
+
+    The whole table is read at once, since only a few groups are expected to
+    have assignments.  If the table can't be read, the old copy is kept, and
+    we try again after another `ttl` seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.assignments = dict()
+        self.expires = 0
+
+
+    def refresh(self):
+        """Re-read the worker_assignments table.
+
+        :returns: None.
+        """
+        assignments_table = schema.WorkerAssignments.__table__
+        db_session = engine.Session()
+        try:
+            self.assignments = dict(db_session.execute(
+                sqlalchemy.select([
+                    assignments_table.c.group, assignments_table.c.worker
+                ])
+            ).fetchall())
+            logger.debug('Loaded %d worker assignments.'
+                         % len(self.assignments)
+            )
+        except Exception as e:
+            logger.warning('Unable to load worker assignments: %s' % e)
+        finally:
+            db_session.close()
+        self.expires = time.monotonic() + self.ttl
+
+
+    def worker(self, group):
+        """Get the worker which handles a group's changes.
+
+        :param str group: The name of the group.
+
+        :returns: A worker number, from 1 to the number of workers.
+
+        If the group has no assignment, :func:`worker_for_group` is used.
+        """
+        if time.monotonic() >= self.expires:
+            self.refresh()
+        try:
+            return self.assignments[group]
+        except KeyError:
+            return worker_for_group(group)
+
+
+# The cache used by ChangeEntry.
+assignments = AssignmentCache(
+    ttl = float(ConfigOption['db']['assignment-ttl'])
+)
+
+
+def resize_workers(session, workers):
+    """Move waiting changes to the workers they belong to.
+
+    :param session: A database session, which is not in autocommit mode.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param int workers: The new number of workers.
+
+    :returns: A tuple containing the number of groups moved, and the number of
+    changes moved.
+
+    The changes table is locked for the duration, so nothing can be added,
+    claimed, or removed while changes are being moved.  A worker in the middle
+    of processing a change holds a lock on it, so we wait for it to finish;
+    that way, a group's older changes are always finished before its newer
+    changes can be seen by another worker.
+
+    Groups assigned to a worker which no longer exists lose their assignment,
+    and go back to the worker picked by hashing.
+
+    Only groups whose worker changes are touched.  Everything is done in one
+    transaction, which is committed at the end.
+    """
+    changes_table = schema.Changes.__table__
+    assignments_table = schema.WorkerAssignments.__table__
+    try:
+        logger.info('Locking the changes table.')
+        session.execute(sqlalchemy.text(
+            'LOCK TABLE changes IN EXCLUSIVE MODE'
+        ))
+
+        # Drop assignments to workers which are going away, and read the rest.
+        result = session.execute(assignments_table.delete().where(
+            assignments_table.c.worker > workers
+        ))
+        if result.rowcount > 0:
+            logger.info('Removed %d worker assignments.' % result.rowcount)
+        current_assignments = dict(session.execute(sqlalchemy.select([
+            assignments_table.c.group, assignments_table.c.worker
+        ])).fetchall())
+
+        # Work out where each group with waiting changes should be.
+        moves = dict()
+        groups_query = sqlalchemy.select([
+            changes_table.c.group, changes_table.c.worker
+        ]).where(changes_table.c.worker > 0).distinct()
+        for (group, worker) in session.execute(groups_query):
+            new_worker = current_assignments.get(group)
+            if new_worker is None:
+                new_worker = worker_for_group(group, workers)
+            if new_worker != worker:
+                moves.setdefault(new_worker, set()).add(group)
+
+        # Move the changes, one destination worker at a time.
+        group_count = 0
+        change_count = 0
+        for (new_worker, groups) in moves.items():
+            logger.debug('Moving %d groups to worker #%d'
+                         % (len(groups), new_worker)
+            )
+            result = session.execute(
+                changes_table.update().
+                where(changes_table.c.worker > 0).
+                where(changes_table.c.worker != new_worker).
+                where(changes_table.c.group.in_(groups)).
+                values(worker=new_worker)
+            )
+            group_count = group_count + len(groups)
+            change_count = change_count + result.rowcount
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    logger.info('Moved %d changes, from %d groups.'
+                % (change_count, group_count)
+    )
+    return (group_count, change_count)
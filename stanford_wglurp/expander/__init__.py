@@ -11,27 +11,45 @@
 from ..logging import logger
 
 import multiprocessing
-from os import kill
+from os import kill, path
 import signal
 import sys
+import time
 
-from . import worker
-from ..config import ConfigOption
-from ..db import engine, schema
+from . import aioworker, metrics, worker
+from .leases import LeaseKeeper, host_name
+from .rebalance import Rebalancer
+from .scaling import Scaler, queue_sets
+from ..config import ConfigBoolean, ConfigOption
+from ..db import engine, partitions, schema
 
 
-# The dictionary of workers, and the program status (Singleton.exiting or not) is global.
+# How often (in seconds) the metrics file is updated.
+METRICS_INTERVAL = 10
+
+
+# The dictionary of workers (and the queues each one handles), and the program
+# status (Singleton.exiting or not) is global.
 class Singleton(object):
     worker_processes = dict()
+    worker_queues = dict()
+    lease_owner = None
     exiting = False
 
 
-def prepare_worker(worker_number):
+def prepare_worker(worker_number, queues=None):
     logger.debug('Preparing worker #%d' % worker_number)
+    if queues is None:
+        queues = Singleton.worker_queues.get(worker_number, [worker_number])
+    Singleton.worker_queues[worker_number] = queues
+    if ConfigOption['expander']['engine'] == 'asyncio':
+        target = aioworker.run
+    else:
+        target = worker.run
     process = multiprocessing.Process(
         name='expander%d' % worker_number,
-        target=worker.run,
-        args=(worker_number,),
+        target=target,
+        args=(worker_number, queues, Singleton.lease_owner),
         daemon=True,
     )
     Singleton.worker_processes[worker_number] = process
@@ -45,36 +63,217 @@ def start_worker(worker_number):
     )
 
 
+def running_queues():
+    """Get the queues our workers are handling.
+
+    :returns: A set of queue numbers.
+    """
+    return set(queue for queues in Singleton.worker_queues.values()
+               for queue in queues)
+
+
+def stop_workers(while_waiting=None):
+    """Stop every running worker, and wait for them to exit.
+
+    :param while_waiting: If provided, this is called about once a second
+    while we wait.
+
+    :returns: None.
+    """
+    for (number, process) in list(Singleton.worker_processes.items()):
+        logger.info('Stopping worker #%d PID %d' % (number, process.pid))
+        kill(process.pid, signal.SIGTERM)
+    for (number, process) in list(Singleton.worker_processes.items()):
+        process.join(1)
+        while process.exitcode is None:
+            if while_waiting is not None:
+                while_waiting()
+            process.join(1)
+        logger.info('Worker #%d (PID %d) stopped with code %d' %
+                    (number, process.pid, process.exitcode)
+        )
+        del Singleton.worker_processes[number]
+    Singleton.worker_queues.clear()
+
+
+def start_workers(process_count, queues):
+    """Start workers for a set of queues.
+
+    :param int process_count: The number of worker processes to run.
+
+    :param queues: The queues to handle.
+    :type queues: Iterable of int
+
+    :returns: None.
+
+    No workers may be running.
+    """
+    for (number, process_queues) in queue_sets(
+        process_count, list(queues)
+    ).items():
+        if Singleton.exiting is True:
+            break
+        prepare_worker(number, process_queues)
+        start_worker(number)
+
+        # The stop handler might have been called while this worker was
+        # starting, in which case it wasn't signalled.
+        if Singleton.exiting is True:
+            kill(Singleton.worker_processes[number].pid, signal.SIGTERM)
+
+
+def renew_leases(keeper):
+    """Renew our shard leases, logging any problem.
+
+    :param keeper: Our lease keeper.
+    :type keeper: stanford_wglurp.expander.leases.LeaseKeeper
+
+    :returns: None.
+
+    This is used while waiting for workers to stop.
+    """
+    db_session = engine.Session()
+    try:
+        keeper.renew(db_session)
+    except Exception as e:
+        logger.error('Unable to renew shard leases: %s' % e)
+    finally:
+        db_session.close()
+
+
+def check_leases(keeper, process_count):
+    """Renew our shard leases, and hand shards over between hosts.
+
+    :param keeper: Our lease keeper.
+    :type keeper: stanford_wglurp.expander.leases.LeaseKeeper
+
+    :param int process_count: The number of worker processes to run.
+
+    :returns: None.
+
+    If our shards change, every worker is stopped (before any shard is given
+    up), and workers are started for the new set.  Exceptions are passed up.
+    """
+    db_session = engine.Session()
+    try:
+        running = running_queues()
+        held = keeper.renew(db_session)
+        if Singleton.exiting is True:
+            return
+
+        # Work out which shards we have to give up.
+        share = keeper.share(db_session)
+        extra = set(sorted(held)[share:])
+        if len(running - (held - extra)) > 0:
+            stop_workers(lambda: renew_leases(keeper))
+        keeper.release(db_session, extra)
+
+        # Take more shards, if we're short, and restart if anything changed.
+        keeper.acquire(db_session, share - len(keeper.owned))
+        if keeper.owned != running_queues():
+            stop_workers(lambda: renew_leases(keeper))
+            logger.info('Now handling shards: %s'
+                        % (', '.join(str(shard) for shard in sorted(keeper.owned))
+                           or 'none')
+            )
+            start_workers(process_count, keeper.owned)
+    finally:
+        db_session.close()
+
+
 def main():
     # Set us up to use forkserver
     logger.info('Preparing forkserver')
     multiprocessing.set_start_method('forkserver')
 
+    # If doing metrics, open our metrics file.
+    if ConfigBoolean['metrics']['active'] is True:
+        logger.debug('Enabling metrics.')
+        metrics_file_path = path.join(
+            ConfigOption['metrics']['path'],
+            'expander'
+        )
+        logger.info('Metrics will write to "%s"' % metrics_file_path)
+        try:
+            metrics_file = open(metrics_file_path,
+                mode='w+',
+                encoding='utf-8'
+            )
+        except Exception as e:
+            logger.critical('Unable to open metrics file "%s"!'
+                            % metrics_file_path
+            )
+            logger.critical('--> %s' % e)
+            sys.exit(1)
+        next_metrics = time.monotonic()
+    else:
+        metrics_file = None
+
     # Set up a stop handler.
     def stop_handler(signal_number, frame):
         logger.warning('Expander stop handler has been called.')
         logger.info('The received signal was %d' % signal_number)
         Singleton.exiting = True
         for (number, process) in Singleton.worker_processes.items():
+            if process.pid is None:
+                continue
             logger.info('Signalling worker #%d PID %d' %
                 (number, process.pid)
             )
             kill(process.pid, signal.SIGTERM)
 
-    # Prepare our workers
+    # There is one queue (shard) for each of `[ldap] workers`.  We only run
+    # workers for the shards we hold a lease on, and the number of processes
+    # can go up and down.
     worker_count = int(ConfigOption['ldap']['workers'])
-    for worker_number in range(1, 1 + worker_count):
-        prepare_worker(worker_number)
+    min_processes = int(ConfigOption['expander']['min-processes'])
+    max_processes = int(ConfigOption['expander']['max-processes'])
+    process_count = min_processes
+    lease_interval = float(ConfigOption['expander']['lease-interval'])
+    lease_timeout = float(ConfigOption['expander']['lease-timeout'])
+    keeper = LeaseKeeper(host_name(), worker_count, lease_timeout)
+    Singleton.lease_owner = keeper.name
+    logger.info('Taking shard leases as %s' % keeper.name)
+    next_lease_check = time.monotonic()
 
     # Put the stop handler in place
     signal.signal(signal.SIGHUP, stop_handler)
     signal.signal(signal.SIGINT, stop_handler)
     signal.signal(signal.SIGTERM, stop_handler)
 
-    # Start our workers
-    logger.info('Starting workers!')
-    for number in Singleton.worker_processes.keys():
-        start_worker(number)
+    # Set up the rebalancer, if it's enabled.
+    rebalance_interval = float(ConfigOption['expander']['rebalance-interval'])
+    if rebalance_interval > 0:
+        rebalancer = Rebalancer(
+            workers = worker_count,
+            threshold = float(ConfigOption['expander']['rebalance-threshold']),
+        )
+        next_rebalance = time.monotonic() + rebalance_interval
+    else:
+        logger.info('Rebalancing is disabled.')
+        rebalancer = None
+
+    # Set up the scaler, if the number of processes can change.
+    scale_interval = float(ConfigOption['expander']['scale-interval'])
+    if min_processes < max_processes and scale_interval > 0:
+        logger.info('Worker processes will scale from %d to %d.'
+                    % (min_processes, max_processes)
+        )
+        scaler = Scaler(
+            minimum = min_processes,
+            maximum = max_processes,
+            up_wait = float(ConfigOption['expander']['scale-up-wait']),
+        )
+        next_scale = time.monotonic() + scale_interval
+    else:
+        scaler = None
+
+    # Partitions are checked right away, and then on a schedule.
+    partition_size = int(ConfigOption['expander']['partition-size'])
+    partition_interval = float(
+        ConfigOption['expander']['partition-interval']
+    )
+    next_partition_check = time.monotonic()
 
     # At this point, we wait (possibly for a very long time) for workers to
     # exit.
@@ -82,15 +281,112 @@ def main():
     # Wait for workers to exit, either expectedly or not.
     # This loop iterates once each time a process exits, giving us the chance
     # to either restart it or clean it up.
-    while len(Singleton.worker_processes) > 0:
+    # We also wake up when it's time to check our leases (which is also when
+    # workers are first started), to check partitions, or to rebalance.
+    while Singleton.exiting is False or len(Singleton.worker_processes) > 0:
         # TODO: Worker 0 stuff.
 
-        # Wait for a process to exit.
-        logger.info('Waiting for a worker to exit (this will be a while)...')
-        multiprocessing.connection.wait(
+        # Check our leases, if it's time.  If we can't, and they might expire
+        # before we can, stop our workers, so that another host can take over
+        # safely.
+        if time.monotonic() >= next_lease_check:
+            try:
+                check_leases(keeper, process_count)
+            except Exception as e:
+                logger.error('Unable to check shard leases: %s' % e)
+                if (len(Singleton.worker_processes) > 0
+                    and (keeper.renewed is None or time.monotonic()
+                         - keeper.renewed > lease_timeout / 2)
+                ):
+                    logger.error('Our leases might expire; '
+                                 'stopping all workers.')
+                    stop_workers()
+            next_lease_check = time.monotonic() + lease_interval
+
+        # The host holding shard 1 also does the jobs for the whole expander.
+        leader = (1 in keeper.owned)
+
+        # Maintain queue partitions, if it's time.
+        if (leader and Singleton.exiting is False
+            and time.monotonic() >= next_partition_check
+        ):
+            db_session = engine.Session()
+            try:
+                partitions.maintain_partitions(db_session, partition_size)
+            except Exception as e:
+                logger.error('Unable to maintain queue partitions: %s' % e)
+            finally:
+                db_session.close()
+            next_partition_check = time.monotonic() + partition_interval
+
+        # Rebalance, if it's time.
+        if (rebalancer is not None and leader and Singleton.exiting is False
+            and time.monotonic() >= next_rebalance
+        ):
+            db_session = engine.Session()
+            try:
+                rebalancer.rebalance(db_session)
+            except Exception as e:
+                logger.error('Unable to rebalance workers: %s' % e)
+            finally:
+                db_session.close()
+            next_rebalance = time.monotonic() + rebalance_interval
+
+        # Add or retire workers, if it's time.
+        if (scaler is not None and Singleton.exiting is False
+            and time.monotonic() >= next_scale
+        ):
+            db_session = engine.Session()
+            try:
+                stats = metrics.lane_stats(db_session)
+                wanted = scaler.decide(
+                    dict((key, value) for (key, value) in stats.items()
+                         if key[0] in keeper.owned),
+                    process_count
+                )
+            except Exception as e:
+                logger.error('Unable to check queue depths: %s' % e)
+                wanted = process_count
+            finally:
+                db_session.close()
+            if wanted != process_count:
+                process_count = wanted
+                stop_workers(lambda: renew_leases(keeper))
+                start_workers(process_count, keeper.owned)
+            next_scale = time.monotonic() + scale_interval
+
+        # Update metrics, if it's time.
+        if metrics_file is not None and time.monotonic() >= next_metrics:
+            db_session = engine.Session()
+            try:
+                metrics.write_metrics(metrics_file,
+                                      metrics.lane_stats(db_session),
+                                      worker_count)
+            except Exception as e:
+                logger.error('Unable to write metrics: %s' % e)
+            finally:
+                db_session.close()
+            next_metrics = time.monotonic() + METRICS_INTERVAL
+
+        # Wait for a process to exit, or for the next scheduled job.  Only
+        # jobs which will actually run count; the others' timers aren't
+        # advanced, so they would wake us straight away.
+        next_job = next_lease_check
+        if leader and Singleton.exiting is False:
+            next_job = min(next_job, next_partition_check)
+            if rebalancer is not None:
+                next_job = min(next_job, next_rebalance)
+        if metrics_file is not None:
+            next_job = min(next_job, next_metrics)
+        if scaler is not None and Singleton.exiting is False:
+            next_job = min(next_job, next_scale)
+        logger.debug('Waiting for a worker to exit (this will be a while)...')
+        ready = multiprocessing.connection.wait(
             [process.sentinel for process in Singleton.worker_processes.values()],
-            timeout=None
+            timeout=max(0, next_job - time.monotonic())
         )
+        if len(ready) == 0:
+            continue
         logger.info('At least one sentinel has triggered!')
 
         # Go through each worker to see which one exited.
@@ -123,7 +419,21 @@ def main():
 
     # There are no more workers left.
     logger.info('No more workers remaining.  Exiting now.')
+
+    # Hand our shards over to the other hosts.
+    db_session = engine.Session()
+    try:
+        keeper.leave(db_session)
+    except Exception as e:
+        logger.error('Unable to give up our shard leases: %s' % e)
+        logger.error('Other hosts will take them once they expire.')
+    finally:
+        db_session.close()
+
+    # Leave the metrics file showing nothing waiting.
+    if metrics_file is not None:
+        logger.debug('Doing final metrics write...')
+        metrics.write_metrics(metrics_file, dict(), worker_count)
+        metrics_file.close()
     logger.info('Go Tree!')
     sys.exit(0)
-
-    # TODO: Metrics!
@@ -0,0 +1,432 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander asyncio worker.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# The regular worker (in worker.py) handles one batch at a time, so one slow
+# group holds up everything behind it.  This worker keeps many groups in
+# flight at once, while still handling each group's changes in order.
+#
+# There is no async Postgres driver here, so all database work runs in
+# threads, with asyncio keeping track of what is in flight:
+#
+# * One thread claims batches from our queue.  The claim's locks are released
+#   straight away; instead, we remember the IDs of every change in flight, so
+#   they aren't claimed again.
+#
+# * A batch is split up by group.  Each group's changes are handed to a pool
+#   of threads (one database connection each), which locks them again,
+#   processes them, and deletes them, in one transaction.  Changes which have
+#   since moved to another worker (because of a resize) are skipped.
+#
+# * If more changes arrive for a group which is already in flight, they wait
+#   for the group's earlier changes to finish, so a group's changes are never
+#   processed at the same time, or out of order.
+#
+# * If a group's changes can't be processed (and it isn't the database's
+#   fault), they are tried again one at a time, and the bad change is parked,
+#   just like the regular worker does.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import signal
+import threading
+import time
+
+from ..config import ConfigOption
+from ..db import engine
+from ..db.schema import Changes
+from .compact import compact_queue
+from .leases import lock_leases
+from .notify import Listener
+from .worker import TRANSIENT_ERRORS, claim_batch, process_change, \
+    process_singly
+
+
+# Make a class to hold our "globals".
+class Singleton:
+    exiting = False
+
+
+# Each thread has its own database session.
+sessions = threading.local()
+all_sessions = list()
+all_sessions_lock = threading.Lock()
+
+
+def thread_session():
+    """Get this thread's database session.
+
+    :returns: A sqlalchemy.orm.session.Session.
+    """
+    try:
+        return sessions.session
+    except AttributeError:
+        sessions.session = engine.Session()
+        with all_sessions_lock:
+            all_sessions.append(sessions.session)
+        return sessions.session
+
+
+def claim(queues, batch_size, bulk_reserve, in_flight_ids, owner):
+    """Claim the next batch of changes, grouped by group.
+
+    :param list queues: The worker numbers whose queues we take changes from.
+
+    :param int batch_size: The maximum number of changes to claim.
+
+    :param int bulk_reserve: The number of places in the batch kept for the
+    bulk lane.
+
+    :param set in_flight_ids: The IDs of changes which are in flight.
+
+    :param str owner: The name of our host, or None.
+
+    :returns: A tuple of (change count, groups), where groups is a list of
+    (group name, list of change IDs) tuples.  Each group's IDs are in order.
+
+    This runs in a thread.  No locks are held when it returns.
+    """
+    db_session = thread_session()
+    try:
+        batch = claim_batch(db_session, queues, batch_size, bulk_reserve,
+                            in_flight_ids, owner)
+        groups = dict()
+        for change in batch:
+            groups.setdefault(change.group, list()).append(change.id)
+        return (len(batch), list(groups.items()))
+    finally:
+        db_session.rollback()
+        db_session.expunge_all()
+
+
+def compact(queues, owner, in_flight_ids):
+    """Compact our queues.
+
+    :param list queues: The worker numbers whose queues we handle.
+
+    :param str owner: The name of our host, or None.
+
+    :param set in_flight_ids: The IDs of changes which are in flight.  Their
+    groups are left alone.
+
+    :returns: None.
+
+    This runs in a thread.
+    """
+    for queue in queues:
+        compact_queue(thread_session(), queue, owner=owner,
+                      skip_ids=in_flight_ids)
+
+
+def process_group(queues, change_ids, owner):
+    """Process some of a group's changes.
+
+    :param list queues: The worker numbers whose queues we handle.
+
+    :param list change_ids: The IDs of the changes.
+
+    :param str owner: The name of our host, or None.
+
+    :returns: The number of changes processed.
+
+    This runs in a thread.  The changes are locked, processed in order, and
+    deleted, all in one transaction.  Changes which are no longer in our
+    queues (or whose queue's lease we no longer hold) are skipped.
+    """
+    db_session = thread_session()
+    try:
+        queues = lock_leases(db_session, owner, queues)
+        changes = db_session.query(Changes).\
+            filter(Changes.id.in_(change_ids)).\
+            filter(Changes.worker.in_(queues)).\
+            order_by(Changes.id).\
+            with_for_update().\
+            all()
+        for change in changes:
+            process_change(db_session, change)
+        if len(changes) > 0:
+            db_session.query(Changes).\
+                filter(Changes.id.in_([change.id for change in changes])).\
+                delete(synchronize_session=False)
+        db_session.commit()
+        return len(changes)
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.expunge_all()
+
+
+def process_group_singly(queues, group, change_ids, owner):
+    """Process a group's changes one at a time, after they failed together.
+
+    :param list queues: The worker numbers whose queues we handle.
+
+    :param str group: The name of the group.
+
+    :param list change_ids: The IDs of the changes, in order.
+
+    :param str owner: The name of our host, or None.
+
+    :returns: The number of changes processed.
+
+    This runs in a thread.  See
+    :func:`stanford_wglurp.expander.worker.process_singly`.
+    """
+    return process_singly(
+        thread_session(), queues,
+        [(change_id, group) for change_id in change_ids], owner
+    )
+
+
+class Dispatcher(object):
+    """Keep many groups in flight, one chain of changes per group.
+
+    :param list queues: The worker numbers whose queues we handle.
+
+    :param int concurrency: The most groups to process at once.
+
+    :param listener: Our listener.
+    :type listener: stanford_wglurp.expander.notify.Listener
+
+    :param loop: The event loop.
+
+    :param str owner: The name of our host, or None.
+    """
+
+    def __init__(self, queues, concurrency, listener, loop, owner=None):
+        self.queues = queues
+        self.owner = owner
+        self.concurrency = concurrency
+        self.listener = listener
+        self.loop = loop
+        self.batch_size = int(ConfigOption['expander']['batch-size'])
+        self.bulk_reserve = int(ConfigOption['expander']['bulk-reserve'])
+        self.compact_interval = float(
+            ConfigOption['expander']['compact-interval']
+        )
+        self.next_compact = 0
+
+        # Claims (and compaction) get their own thread, so they never wait
+        # behind processing.
+        self.claim_executor = ThreadPoolExecutor(max_workers=1)
+        self.group_executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # The changes in flight, and the last task of each group in flight.
+        self.in_flight_ids = set()
+        self.tails = dict()
+        self.tasks = set()
+
+        # The groups whose changes went back to the queue (because they
+        # couldn't be processed) during the current claim.
+        self.failed_groups = set()
+
+
+    async def run_group(self, group, change_ids, previous):
+        # Wait for the group's earlier changes.  If they weren't processed,
+        # we can't be either; everything goes back to the queue, and will be
+        # claimed again, in order.
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+                if previous.result() is False:
+                    self.failed_groups.add(group)
+                    return False
+            try:
+                await self.loop.run_in_executor(
+                    self.group_executor, process_group, self.queues,
+                    change_ids, self.owner
+                )
+                return True
+            except Exception as e:
+                logger.error('Unable to process %d changes for group %s: %s'
+                             % (len(change_ids), group, e)
+                )
+                error = e
+
+            # If it wasn't the database's fault, one of the changes is bad.
+            # Try them one at a time, so the bad one gets parked; anything
+            # after it stays in the queue, behind it.
+            if not isinstance(error, TRANSIENT_ERRORS):
+                logger.info('Trying the changes for group %s one at a time.'
+                            % group
+                )
+                try:
+                    processed_count = await self.loop.run_in_executor(
+                        self.group_executor, process_group_singly,
+                        self.queues, group, change_ids, self.owner
+                    )
+                    if processed_count == len(change_ids):
+                        return True
+                    self.failed_groups.add(group)
+                    return False
+                except Exception as e:
+                    logger.error('Unable to process changes for group %s one '
+                                 'at a time: %s' % (group, e)
+                    )
+
+            # Hold on to the group for a bit, so we don't retry right away.
+            await asyncio.sleep(5)
+            self.failed_groups.add(group)
+            return False
+        finally:
+            self.in_flight_ids.difference_update(change_ids)
+
+
+    def start_group(self, group, change_ids):
+        """Start processing some of a group's changes.
+
+        :param str group: The name of the group.
+
+        :param list change_ids: The IDs of the changes, in order.
+
+        :returns: None.
+        """
+        self.in_flight_ids.update(change_ids)
+        task = self.loop.create_task(self.run_group(
+            group, change_ids, self.tails.get(group)
+        ))
+        self.tails[group] = task
+        self.tasks.add(task)
+
+        def done(task):
+            self.tasks.discard(task)
+            if self.tails.get(group) is task:
+                del self.tails[group]
+        task.add_done_callback(done)
+
+
+    async def run(self):
+        """Claim and dispatch changes until told to exit.
+
+        :returns: None.
+        """
+        change_count = 0
+        while Singleton.exiting is False:
+            # Don't take on more groups than we can handle.
+            if len(self.tails) >= self.concurrency:
+                await asyncio.wait(self.tasks,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                continue
+
+            # A full batch means we're behind, so compact our queue (but not
+            # too often).
+            if (self.compact_interval > 0
+                and change_count == self.batch_size
+                and time.monotonic() >= self.next_compact
+            ):
+                try:
+                    await self.loop.run_in_executor(
+                        self.claim_executor, compact, self.queues, self.owner,
+                        set(self.in_flight_ids)
+                    )
+                except Exception as e:
+                    logger.error('Unable to compact our queue: %s' % e)
+                self.next_compact = time.monotonic() + self.compact_interval
+
+            logger.debug('Querying for next changes')
+            self.failed_groups = set()
+            try:
+                (change_count, groups) = await self.loop.run_in_executor(
+                    self.claim_executor, claim, self.queues, self.batch_size,
+                    self.bulk_reserve, set(self.in_flight_ids), self.owner
+                )
+            except Exception as e:
+                logger.error('Unable to claim changes: %s' % e)
+                (change_count, groups) = (0, list())
+                await asyncio.sleep(5)
+
+            if change_count > 0:
+                logger.debug('Found %d changes, for %d groups'
+                             % (change_count, len(groups))
+                )
+                for (group, change_ids) in groups:
+                    # The claim was allowed to skip past this group's
+                    # changes which were in flight, but they have since gone
+                    # back to the queue, so these changes would jump ahead of
+                    # them.  They'll be claimed again, in order.
+                    if group in self.failed_groups:
+                        logger.debug('Group %s failed during the claim; '
+                                     'leaving %d changes for later.'
+                                     % (group, len(change_ids))
+                        )
+                        continue
+                    self.start_group(group, change_ids)
+            elif len(self.tasks) > 0:
+                # Something is still in flight; its finishing might unblock
+                # more changes.
+                await asyncio.wait(self.tasks, timeout=1,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+            else:
+                logger.debug('No change found.')
+                # Wait for a notification on 'expanderX', for up to 30
+                # seconds.  We'll return early if a notification comes in,
+                # and when signalled.
+                await self.loop.run_in_executor(
+                    self.claim_executor, self.listener.wait, 30
+                )
+
+        # Let everything in flight finish.
+        if len(self.tasks) > 0:
+            logger.info('Waiting for %d groups to finish.' % len(self.tails))
+            await asyncio.wait(self.tasks)
+        self.claim_executor.shutdown()
+        self.group_executor.shutdown()
+
+
+def run(number, queues=None, owner=None):
+    """Run a worker process, using asyncio.
+
+    :param int number: The process number.
+
+    :param list queues: The worker numbers whose queues this process handles.
+    If not provided, only queue `number` is handled.
+
+    :param str owner: The name of our host, which holds the leases on our
+    queues.  If None, leases aren't checked.
+
+    :returns: None.
+    """
+    if queues is None:
+        queues = [number]
+    logger.info('Worker number %d started, for queues %s, with asyncio!'
+                % (number, ', '.join(str(queue) for queue in queues))
+    )
+    concurrency = int(ConfigOption['expander']['concurrency'])
+
+    # Our listener stays connected the whole time we run.
+    listener = Listener(['expander%d' % queue for queue in queues])
+
+    # Set up a stop handler.  The event loop takes over the signal wakeup fd,
+    # so we have to wake the listener ourselves.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    def stop_handler(signal_number):
+        logger.warning('Worker stop handler has been called.')
+        logger.info('The received signal was %d' % signal_number)
+        Singleton.exiting = True
+        listener.wake()
+    for signal_number in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_handler, signal_number)
+
+    dispatcher = Dispatcher(queues, concurrency, listener, loop, owner)
+    try:
+        loop.run_until_complete(dispatcher.run())
+    finally:
+        loop.close()
+
+    # At this point, exiting is True, and everything has finished.
+    for db_session in all_sessions:
+        db_session.close()
+    listener.close()
+    logger.info('Worker number %d exiting!' % number)
@@ -0,0 +1,221 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander queue compaction.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# When a worker falls behind, its queue can hold several SYNCs, and lots of
+# ADDs and REMOVEs, for the same group.  Only the newest SYNC, and the changes
+# after it, matter: the delivered membership (see delivered.py) turns the
+# SYNC into whatever ADDs and REMOVEs are needed.
+#
+# So, a worker which is behind compacts its own queue.  For each group with
+# more than one change waiting:
+#
+# * Every change older than the newest complete SYNC is deleted.  A complete
+#   SYNC is a SYNC, or a SYNC_BEGIN with its SYNC_END already in the queue.
+#
+# * Each run of ADD and REMOVE changes, with nothing else in between, is
+#   merged into (at most) one REMOVE followed by one ADD.  The merged changes
+#   re-use the IDs of the first two changes in the run, so they stay in the
+#   same place in the queue.
+#
+# Only the worker itself reads its queue, but the asyncio worker keeps changes
+# in flight (see aioworker.py) while it compacts, so a group is left alone if
+# any of its changes are in flight, or locked by someone else.  (A resize
+# locks the whole table, and the rebalancer only moves groups which have
+# nothing waiting.)
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+from collections import OrderedDict
+import sqlalchemy
+
+from ..db import encoding
+from ..db.schema import Changes
+from .leases import lock_leases
+
+
+def compact_queue(session, number, group_limit=1000, owner=None,
+                  skip_ids=()):
+    """Compact a worker's queue.
+
+    :param session: A database session, which is not in autocommit mode.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param int number: The worker number.
+
+    :param int group_limit: The most groups to compact in one call.
+
+    :param str owner: The name of our host.  If provided, nothing is done
+    unless we still hold the queue's lease.
+
+    :param skip_ids: The IDs of changes which are in flight.  Groups with any
+    of these changes are not compacted.
+    :type skip_ids: Iterable of int
+
+    :returns: The number of changes removed from the queue.
+
+    Everything is done in one transaction, which is committed at the end.
+    """
+    try:
+        if len(lock_leases(session, owner, [number])) == 0:
+            session.rollback()
+            return 0
+
+        skip_ids = list(skip_ids)
+        query = session.query(Changes.group).\
+            filter(Changes.worker == number)
+        if len(skip_ids) > 0:
+            busy_groups = session.query(Changes.group).\
+                filter(Changes.id.in_(skip_ids))
+            query = query.filter(~Changes.group.in_(busy_groups))
+        groups = [row[0] for row in query.
+            group_by(Changes.group).
+            having(sqlalchemy.func.count() > 1).
+            limit(group_limit).
+            all()
+        ]
+
+        removed_count = 0
+        for group in groups:
+            removed_count = removed_count + compact_group(
+                session, number, group
+            )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.expunge_all()
+
+    logger.info('Compacted %d groups, removing %d changes.'
+                % (len(groups), removed_count)
+    )
+    return removed_count
+
+
+def compact_group(session, number, group):
+    """Compact the changes for one group in a worker's queue.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param int number: The worker number.
+
+    :param str group: The name of the group.
+
+    :returns: The number of changes removed from the queue.
+
+    Transaction management is left to the caller.
+    """
+    # Only read the IDs and actions, so big SYNCs don't have to be loaded.
+    # If someone else has any of the group's changes locked, leave the group
+    # alone.
+    changes = session.query(Changes.id, Changes.action).\
+        filter(Changes.worker == number).\
+        filter(Changes.group == group).\
+        order_by(Changes.id).\
+        with_for_update(of=Changes, skip_locked=True).\
+        all()
+    total = session.query(sqlalchemy.func.count(Changes.id)).\
+        filter(Changes.worker == number).\
+        filter(Changes.group == group).\
+        scalar()
+    if len(changes) < total:
+        logger.debug('Group %s is busy; not compacting it.' % group)
+        return 0
+
+    # Find the newest complete SYNC, working backwards.
+    sync_start = None
+    end_seen = False
+    for (change_id, action) in reversed(changes):
+        if action == 'SYNC_END':
+            end_seen = True
+        elif action == 'SYNC' or (action == 'SYNC_BEGIN' and end_seen):
+            sync_start = change_id
+            break
+
+    # Everything before it can go.
+    removed_count = 0
+    if sync_start is not None:
+        removed_count = session.query(Changes).\
+            filter(Changes.worker == number).\
+            filter(Changes.group == group).\
+            filter(Changes.id < sync_start).\
+            delete(synchronize_session=False)
+        changes = [change for change in changes if change[0] >= sync_start]
+
+    # Merge each run of ADDs and REMOVEs.
+    run_ids = list()
+    for (change_id, action) in changes + [(None, None)]:
+        if action in ('ADD', 'REMOVE'):
+            run_ids.append(change_id)
+            continue
+        if len(run_ids) > 1:
+            removed_count = removed_count + merge_run(session, run_ids)
+        run_ids = list()
+
+    if removed_count > 0:
+        logger.debug('Removed %d changes for group %s.'
+                     % (removed_count, group)
+        )
+    return removed_count
+
+
+def merge_run(session, run_ids):
+    """Merge a run of ADD and REMOVE changes.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param list run_ids: The IDs of the changes in the run, oldest first.
+    There must be at least two.
+
+    :returns: The number of changes removed from the queue.
+
+    Each member ends up in whichever change (ADD or REMOVE) they were last
+    in.  The first change in the run becomes the REMOVE, and the second
+    becomes the ADD, so removes still go before adds.  The rest of the run
+    (and either of the first two, if it would be empty) is deleted.
+    """
+    run = session.query(Changes).\
+        filter(Changes.id.in_(run_ids)).\
+        order_by(Changes.id).\
+        all()
+
+    last_action = OrderedDict()
+    for change in run:
+        for member in encoding.decode_members(
+            change.payload_format, change.data, change.payload
+        ):
+            last_action.pop(member, None)
+            last_action[member] = change.action
+    removes = [member for (member, action) in last_action.items()
+               if action == 'REMOVE']
+    adds = [member for (member, action) in last_action.items()
+            if action == 'ADD']
+
+    # Re-use the first two changes; delete everything else.
+    keep = dict()
+    if len(removes) > 0:
+        keep[run[0].id] = ('REMOVE', removes)
+    if len(adds) > 0:
+        keep[run[1].id] = ('ADD', adds)
+    for change in run:
+        if change.id not in keep:
+            session.delete(change)
+            continue
+        (action, members) = keep[change.id]
+        (payload_format, data, payload) = encoding.encode_members(members)
+        change.action = action
+        change.payload_format = payload_format
+        change.data = data
+        change.payload = payload
+    session.flush()
+
+    return len(run) - len(keep)
@@ -0,0 +1,280 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander delivered membership state.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# A SYNC lists every member of a group, but most of the time, very little has
+# changed since the last one.  So, the expander keeps the membership it last
+# delivered for each group (in the delivered_members table), and turns each
+# SYNC into the ADDs and REMOVEs needed to get from there to the new
+# membership.  Destinations which already have a baseline (a group which has
+# had a complete SYNC) only get that difference.
+#
+# ADD and REMOVE changes are applied to the delivered membership as they are
+# processed, so it stays current between SYNCs.
+#
+# Members are compared one range of unique IDs at a time.  A SYNC covers every
+# unique ID.  A chunked SYNC's members are sorted by unique ID, so each
+# SYNC_CHUNK covers the unique IDs after the previous chunk, up to its own
+# last member, and the SYNC_END covers everything after the last chunk.  The
+# position is kept in the delivered_groups table, so only one chunk is ever
+# in memory, and a chunked SYNC survives a worker restart or a group move.
+#
+# Everything here happens in the caller's transaction, which is the same one
+# that deletes the change from the queue, so the delivered membership always
+# matches the changes which have been processed.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import datetime
+from itertools import islice
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from ..db import schema
+
+
+# The number of rows to delete, or upsert, in one statement.
+STATEMENT_SIZE = 1000
+
+
+def diff_range(session, group, members, after=None, upto=None, start=None):
+    """Compare members with the delivered membership, and update it.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :param members: The new members whose unique IDs are in the range.
+    :type members: Iterable of (uniqueid, username) tuples
+
+    :param str after: The range starts after this unique ID.  If None, the
+    range has no start.
+
+    :param str upto: The range ends at (and includes) this unique ID.  If
+    None, the range has no end.
+
+    :param str start: The range starts at (and includes) this unique ID.
+    This is used instead of `after`, when we don't know where the range
+    really starts.
+
+    :returns: A tuple of (adds, removes), each being a list of (uniqueid,
+    username) tuples, sorted by unique ID.
+
+    A member whose username has changed is both removed (with the old
+    username) and added (with the new one).
+    """
+    members_table = schema.DeliveredMembers.__table__
+    query = sqlalchemy.select([
+        members_table.c.uniqueid, members_table.c.username
+    ]).where(members_table.c.group == group)
+    if after is not None:
+        query = query.where(members_table.c.uniqueid > after)
+    if start is not None:
+        query = query.where(members_table.c.uniqueid >= start)
+    if upto is not None:
+        query = query.where(members_table.c.uniqueid <= upto)
+    delivered = dict(session.execute(query).fetchall())
+    new = dict(members)
+
+    # Set operations on the unique IDs do the heavy lifting.
+    changed = set(uniqueid for uniqueid in (new.keys() & delivered.keys())
+                  if new[uniqueid] != delivered[uniqueid])
+    added_ids = (new.keys() - delivered.keys()) | changed
+    removed_ids = (delivered.keys() - new.keys()) | changed
+    adds = sorted((uniqueid, new[uniqueid]) for uniqueid in added_ids)
+    removes = sorted((uniqueid, delivered[uniqueid])
+                     for uniqueid in removed_ids)
+
+    remove_members(session, group, removes)
+    add_members(session, group, adds)
+    return (adds, removes)
+
+
+def add_members(session, group, members):
+    """Add members to the delivered membership.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :param members: The members to add.
+    :type members: Iterable of (uniqueid, username) tuples
+
+    :returns: None.
+
+    Members who are already there have their username updated.
+    """
+    members_table = schema.DeliveredMembers.__table__
+    members = iter(members)
+    while True:
+        rows = [{'group': group, 'uniqueid': uniqueid, 'username': username}
+                for (uniqueid, username) in islice(members, STATEMENT_SIZE)]
+        if len(rows) == 0:
+            break
+        upsert = insert(members_table).values(rows)
+        session.execute(upsert.on_conflict_do_update(
+            index_elements = [members_table.c.group, members_table.c.uniqueid],
+            set_ = dict(username = upsert.excluded.username)
+        ))
+
+
+def remove_members(session, group, members):
+    """Remove members from the delivered membership.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :param members: The members to remove.
+    :type members: Iterable of (uniqueid, username) tuples
+
+    :returns: None.
+    """
+    members_table = schema.DeliveredMembers.__table__
+    members = iter(members)
+    while True:
+        uniqueids = [uniqueid for (uniqueid, username)
+                     in islice(members, STATEMENT_SIZE)]
+        if len(uniqueids) == 0:
+            break
+        session.execute(members_table.delete().
+            where(members_table.c.group == group).
+            where(members_table.c.uniqueid.in_(uniqueids))
+        )
+
+
+def lock_group(session, group):
+    """Get (and lock) a group's delivered_groups row, creating it if needed.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :returns: The DeliveredGroups row.
+    """
+    groups_table = schema.DeliveredGroups.__table__
+    session.execute(insert(groups_table).values(
+        group = group,
+    ).on_conflict_do_nothing(
+        index_elements = [groups_table.c.group]
+    ))
+    return session.query(schema.DeliveredGroups).\
+        filter(schema.DeliveredGroups.group == group).\
+        with_for_update().\
+        one()
+
+
+def sync(session, group, members):
+    """Process a SYNC.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :param members: Every member of the group.
+    :type members: Iterable of (uniqueid, username) tuples
+
+    :returns: A tuple of (baseline, adds, removes).  If baseline is False,
+    the group had no baseline, so the whole membership must be delivered.
+    """
+    group_row = lock_group(session, group)
+    baseline = (group_row.synced is not None)
+    if group_row.sync_position is not None:
+        logger.warning('SYNC of group %s replaces a chunked SYNC.' % group)
+    (adds, removes) = diff_range(session, group, members)
+    group_row.synced = datetime.datetime.utcnow()
+    group_row.sync_position = None
+    return (baseline, adds, removes)
+
+
+def sync_begin(session, group):
+    """Process a SYNC_BEGIN.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :returns: None.
+    """
+    group_row = lock_group(session, group)
+    if group_row.sync_position is not None:
+        logger.warning('SYNC of group %s restarted before it ended.' % group)
+    group_row.sync_position = ''
+
+
+def sync_chunk(session, group, members):
+    """Process a SYNC_CHUNK.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :param members: Some members of the group, sorted by unique ID, which
+    follow the members in the last chunk.
+    :type members: List of (uniqueid, username) tuples
+
+    :returns: A tuple of (baseline, adds, removes).  If baseline is False,
+    the group had no baseline, so the whole chunk must be delivered.
+    """
+    group_row = lock_group(session, group)
+    baseline = (group_row.synced is not None)
+    if len(members) == 0:
+        return (baseline, list(), list())
+
+    # Without a SYNC_BEGIN, we don't know where the last chunk ended, so we
+    # can only compare this chunk's own range.
+    first_id = min(members)[0]
+    last_id = max(members)[0]
+    after = group_row.sync_position
+    if after is None:
+        logger.warning('SYNC_CHUNK of group %s arrived without a SYNC_BEGIN.'
+                       % group
+        )
+        (adds, removes) = diff_range(session, group, members,
+                                     start=first_id, upto=last_id)
+    else:
+        (adds, removes) = diff_range(session, group, members,
+                                     after=(None if after == '' else after),
+                                     upto=last_id)
+    group_row.sync_position = last_id
+    return (baseline, adds, removes)
+
+
+def sync_end(session, group):
+    """Process a SYNC_END.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str group: The name of the group.
+
+    :returns: A tuple of (baseline, adds, removes).  adds is always empty;
+    removes has the delivered members after the last chunk.
+    """
+    group_row = lock_group(session, group)
+    baseline = (group_row.synced is not None)
+    if group_row.sync_position is None:
+        logger.warning('SYNC_END of group %s arrived without a SYNC_BEGIN.'
+                       % group
+        )
+        return (baseline, list(), list())
+
+    after = group_row.sync_position
+    (adds, removes) = diff_range(session, group, list(),
+                                 after=(None if after == '' else after))
+    group_row.synced = datetime.datetime.utcnow()
+    group_row.sync_position = None
+    return (baseline, adds, removes)
@@ -0,0 +1,282 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander shard leases.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# Several expander hosts can share the work.  Each shard (worker queue) is
+# handled by one host at a time, which holds a lease on it in the
+# shard_leases table.  Every few seconds, each host's supervisor:
+#
+# * Updates its heartbeat in the expander_hosts table, and renews its leases.
+#
+# * Works out its share of the shards: the number of shards, divided by the
+#   number of hosts with a recent heartbeat (rounded up).
+#
+# * Gives up any shards over its share (once its workers have stopped), and
+#   takes free or expired shards, up to its share.
+#
+# When a host dies, its leases expire after `[expander] lease-timeout`
+# seconds, and the other hosts take its shards on their next check.  A host
+# which can't renew its leases stops its workers before they could expire.
+#
+# That isn't enough on its own: a host which stalls (a long pause, or a
+# network problem) can still have workers running after its leases expire.
+# So, workers fence themselves.  Every transaction which claims or compacts
+# changes first calls lock_leases(), which only returns the shards whose
+# leases we still hold, and key-share locks those lease rows.  Renewing a
+# lease doesn't conflict with that lock, but taking one over does (acquire()
+# skips locked rows), so a shard can't change hands while one of our
+# transactions is using it.
+#
+# All times come from the database's clock, so host clocks don't matter.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import datetime
+from math import ceil
+from os import getpid
+import socket
+import sqlalchemy
+import time
+from sqlalchemy.dialects.postgresql import insert
+
+from ..db import schema
+
+
+def lock_leases(session, owner, shards):
+    """Lock our unexpired leases, for the rest of the transaction.
+
+    :param session: A database session, in a transaction.
+    :type session: sqlalchemy.orm.session.Session
+
+    :param str owner: The name of our host.  If None, leases aren't checked.
+
+    :param list shards: The shards we want to use.
+
+    :returns: A list of the shards we may use, in this transaction.
+
+    The transaction might have started a while ago, so leases are checked
+    against the time now, not the time the transaction started.
+    """
+    if owner is None:
+        return list(shards)
+    leases_table = schema.ShardLeases.__table__
+    held = set(row[0] for row in session.execute(
+        sqlalchemy.select([leases_table.c.shard]).
+        where(leases_table.c.owner == owner).
+        where(leases_table.c.expires
+              > sqlalchemy.func.statement_timestamp()).
+        where(leases_table.c.shard.in_(shards)).
+        with_for_update(key_share=True)
+    ))
+    for shard in shards:
+        if shard not in held:
+            logger.warning('Our lease on shard %d has expired; skipping it.'
+                           % shard)
+    return [shard for shard in shards if shard in held]
+
+
+def host_name():
+    """Get the name this expander host uses for its leases.
+
+    :returns: A str, with the host name and our PID.
+
+    The PID is included, so that a restarted supervisor doesn't think the
+    old one's leases are still in use by it.
+    """
+    return '%s:%d' % (socket.getfqdn(), getpid())
+
+
+class LeaseKeeper(object):
+    """Keep this host's shard leases.
+
+    :param str name: This host's name.
+
+    :param int shards: The number of shards.
+
+    :param float timeout: How long (in seconds) a lease lasts without being
+    renewed.
+
+    `owned` is the set of shards this host holds a lease on, and `renewed` is
+    when (from :func:`time.monotonic`) the leases were last renewed.
+    """
+
+    def __init__(self, name, shards, timeout):
+        self.name = name
+        self.shards = shards
+        self.timeout = datetime.timedelta(seconds=timeout)
+        self.owned = set()
+        self.renewed = None
+
+
+    def renew(self, session):
+        """Update our heartbeat, and renew our leases.
+
+        :param session: A database session, which is not in autocommit mode.
+        :type session: sqlalchemy.orm.session.Session
+
+        :returns: The set of shards we still hold.  Any other shard in
+        `owned` was taken by another host, after our lease expired.
+        """
+        hosts_table = schema.ExpanderHosts.__table__
+        leases_table = schema.ShardLeases.__table__
+        now = sqlalchemy.func.now()
+        try:
+            upsert = insert(hosts_table).values(name=self.name, heartbeat=now)
+            session.execute(upsert.on_conflict_do_update(
+                index_elements = [hosts_table.c.name],
+                set_ = dict(heartbeat = upsert.excluded.heartbeat)
+            ))
+
+            # Forget hosts which have been gone for a while.
+            session.execute(hosts_table.delete().
+                where(hosts_table.c.heartbeat < now - self.timeout * 10)
+            )
+
+            held = set(row[0] for row in session.execute(
+                leases_table.update().
+                where(leases_table.c.owner == self.name).
+                where(leases_table.c.shard <= self.shards).
+                values(expires = now + self.timeout).
+                returning(leases_table.c.shard)
+            ))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        for shard in sorted(self.owned - held):
+            logger.warning('Lost the lease on shard %d.' % shard)
+        self.owned = held
+        self.renewed = time.monotonic()
+        return held
+
+
+    def share(self, session):
+        """Work out how many shards this host should hold.
+
+        :param session: A database session.
+        :type session: sqlalchemy.orm.session.Session
+
+        :returns: An int.
+        """
+        hosts_table = schema.ExpanderHosts.__table__
+        try:
+            host_count = session.execute(
+                sqlalchemy.select([sqlalchemy.func.count()]).
+                where(hosts_table.c.heartbeat
+                      > sqlalchemy.func.now() - self.timeout)
+            ).scalar()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return int(ceil(self.shards / max(1, host_count)))
+
+
+    def acquire(self, session, count):
+        """Take leases on free (or expired) shards.
+
+        :param session: A database session, which is not in autocommit mode.
+        :type session: sqlalchemy.orm.session.Session
+
+        :param int count: The most shards to take.
+
+        :returns: The set of shards taken.
+        """
+        if count <= 0:
+            return set()
+        leases_table = schema.ShardLeases.__table__
+        now = sqlalchemy.func.now()
+        try:
+            # Make sure every shard has a row.
+            session.execute(insert(leases_table).values([
+                {'shard': shard} for shard in range(1, 1 + self.shards)
+            ]).on_conflict_do_nothing(
+                index_elements = [leases_table.c.shard]
+            ))
+
+            free = sqlalchemy.select([leases_table.c.shard]).\
+                where(leases_table.c.shard <= self.shards).\
+                where(sqlalchemy.or_(
+                    leases_table.c.owner == None,
+                    leases_table.c.expires < now,
+                )).\
+                order_by(leases_table.c.shard).\
+                limit(count).\
+                with_for_update(skip_locked=True)
+            taken = set(row[0] for row in session.execute(
+                leases_table.update().
+                where(leases_table.c.shard.in_(free)).
+                values(owner = self.name, expires = now + self.timeout).
+                returning(leases_table.c.shard)
+            ))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        for shard in sorted(taken):
+            logger.info('Took the lease on shard %d.' % shard)
+        self.owned = self.owned | taken
+        return taken
+
+
+    def release(self, session, shards):
+        """Give up leases.
+
+        :param session: A database session, which is not in autocommit mode.
+        :type session: sqlalchemy.orm.session.Session
+
+        :param shards: The shards to give up.
+        :type shards: Iterable of int
+
+        :returns: None.
+
+        Our workers must already have stopped handling these shards.
+        """
+        shards = set(shards)
+        if len(shards) == 0:
+            return
+        leases_table = schema.ShardLeases.__table__
+        try:
+            session.execute(leases_table.update().
+                where(leases_table.c.owner == self.name).
+                where(leases_table.c.shard.in_(shards)).
+                values(owner = None, expires = None)
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        for shard in sorted(shards):
+            logger.info('Gave up the lease on shard %d.' % shard)
+        self.owned = self.owned - shards
+
+
+    def leave(self, session):
+        """Give up every lease, and remove our heartbeat.
+
+        :param session: A database session, which is not in autocommit mode.
+        :type session: sqlalchemy.orm.session.Session
+
+        :returns: None.
+
+        Our workers must already have stopped.
+        """
+        hosts_table = schema.ExpanderHosts.__table__
+        self.release(session, self.owned)
+        try:
+            session.execute(hosts_table.delete().
+                where(hosts_table.c.name == self.name)
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
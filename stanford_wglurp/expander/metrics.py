@@ -0,0 +1,101 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander metrics.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# The expander's metrics come from the changes table, so they are written by
+# the supervisor (not the workers), every few seconds.  For each lane, we
+# report how many changes are waiting (depth), and how many seconds the oldest
+# one has been waiting (wait), both overall and for each worker.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import fcntl
+from os import fsync
+import sqlalchemy
+import time
+
+from ..db.changes import LANE_NAMES
+from ..db.schema import Changes
+
+
+def lane_stats(session):
+    """Get the depth and wait time of every worker's lanes.
+
+    :param session: A database session.
+    :type session: sqlalchemy.orm.session.Session
+
+    :returns: A dict mapping (worker, lane) to a (depth, wait) tuple, where
+    wait is in seconds.
+
+    Only lanes with something waiting are included.
+    """
+    changes_table = Changes.__table__
+    wait = sqlalchemy.func.extract('epoch',
+        sqlalchemy.func.now() - sqlalchemy.func.min(changes_table.c.created)
+    )
+    query = sqlalchemy.select([
+        changes_table.c.worker, changes_table.c.lane,
+        sqlalchemy.func.count(), wait
+    ]).group_by(changes_table.c.worker, changes_table.c.lane)
+
+    stats = dict()
+    try:
+        for (worker, lane, depth, lane_wait) in session.execute(query):
+            stats[(worker, lane)] = (depth, float(lane_wait))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return stats
+
+
+def write_metrics(metrics_file, stats, workers):
+    """Write lane metrics to the metrics file.
+
+    :param metrics_file: The open metrics file.
+
+    :param dict stats: The output of :func:`lane_stats`.
+
+    :param int workers: The number of workers.
+
+    :returns: None.
+    """
+    logger.debug('Metrics writer acquiring file lock.')
+    fcntl.lockf(metrics_file, fcntl.LOCK_EX)
+    metrics_file.seek(0)
+    metrics_file.truncate(0)
+    print('expander.last_updated', round(time.time()),
+        sep='=', file=metrics_file
+    )
+
+    for (lane, lane_name) in sorted(LANE_NAMES.items()):
+        lane_depth = 0
+        lane_wait = 0.0
+        for worker in range(0, 1 + workers):
+            (depth, wait) = stats.get((worker, lane), (0, 0.0))
+            lane_depth = lane_depth + depth
+            lane_wait = max(lane_wait, wait)
+            if worker > 0:
+                print('expander.worker%d.%s.depth' % (worker, lane_name),
+                    depth, sep='=', file=metrics_file
+                )
+                print('expander.worker%d.%s.wait' % (worker, lane_name),
+                    round(wait), sep='=', file=metrics_file
+                )
+        print('expander.%s.depth' % lane_name, lane_depth,
+            sep='=', file=metrics_file
+        )
+        print('expander.%s.wait' % lane_name, round(lane_wait),
+            sep='=', file=metrics_file
+        )
+
+    # Flush the file, and downgrade our lock.
+    metrics_file.flush()
+    fsync(metrics_file.fileno())
+    fcntl.lockf(metrics_file, fcntl.LOCK_SH)
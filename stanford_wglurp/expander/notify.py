@@ -0,0 +1,138 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander notification listener.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# When changes are added to a worker's queue, a trigger on the changes table
+# sends a NOTIFY on that worker's channel.  Each worker keeps one connection
+# open, which LISTENs on its channels, so that it can sleep until there is
+# something to do.
+#
+# The listener also watches the signal wakeup fd, so a signal (like SIGTERM)
+# wakes it immediately, instead of after the timeout.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import os
+import select
+import signal
+
+from ..db import engine
+
+
+class Listener(object):
+    """A long-lived connection, listening for notifications.
+
+    :param list channels: The names of the channels to listen on.
+
+    The connection is opened on the first call to :meth:`wait`, and is
+    re-opened if it fails.
+
+    .. note::
+
+        This installs a signal wakeup fd, so it must be created in the main
+        thread, and there can only be one per process.
+    """
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.connection = None
+
+        # Signals write a byte to this pipe, which wakes up select().
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        signal.set_wakeup_fd(self.wakeup_write)
+
+
+    def connect(self):
+        """Open our connection, and start listening.
+
+        :returns: None.
+        """
+        logger.debug('Opening listener connection for %s'
+                     % ', '.join(self.channels)
+        )
+        self.connection = engine.DBAC.raw_connection()
+        cursor = self.connection.cursor()
+        for channel in self.channels:
+            cursor.execute('LISTEN %s' % channel)
+        cursor.close()
+
+
+    def close(self):
+        """Close our connection.
+
+        :returns: None.
+        """
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+
+    def wake(self):
+        """Wake up a :meth:`wait` which is running in another thread.
+
+        :returns: None.
+
+        This is for when something else (like an asyncio event loop) has
+        taken over the signal wakeup fd.
+        """
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            pass
+
+
+    def wait(self, timeout):
+        """Wait for a notification, a signal, or a timeout.
+
+        :param float timeout: The maximum number of seconds to wait.
+
+        :returns: The number of notifications received.
+
+        Every notification already received is drained, so the next call will
+        wait for a new one.  We might return with no notifications (because of
+        a signal, or a timeout), so the caller should always check for work.
+        """
+        try:
+            if self.connection is None:
+                self.connect()
+            psycopg2_connection = self.connection.connection
+
+            # Anything already received counts, so don't wait for it.
+            psycopg2_connection.poll()
+            if len(psycopg2_connection.notifies) == 0:
+                logger.debug('Sleeping on NOTIFY %s...'
+                             % ', '.join(self.channels)
+                )
+                select.select([psycopg2_connection, self.wakeup_read], [], [],
+                              timeout)
+                psycopg2_connection.poll()
+            notification_count = len(psycopg2_connection.notifies)
+            del psycopg2_connection.notifies[:]
+        except Exception as e:
+            logger.error('Listener connection failed: %s' % e)
+            self.close()
+
+            # Don't let the caller spin; wait a bit before it tries again.
+            select.select([self.wakeup_read], [], [], min(timeout, 5))
+            notification_count = 0
+
+        # Empty the wakeup pipe.
+        try:
+            while len(os.read(self.wakeup_read, 512)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+        logger.debug('Received %d notifications.' % notification_count)
+        return notification_count
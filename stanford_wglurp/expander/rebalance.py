@@ -0,0 +1,209 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander worker rebalancing.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# Hashing spreads groups evenly across workers, but it doesn't know which
+# groups are busy, so several busy groups can end up on the same worker.  The
+# rebalancer watches how many changes are waiting for each group, and moves
+# busy groups off of overloaded workers, by adding them to the
+# worker_assignments table.
+#
+# A group is only moved when none of its changes are waiting, so that a
+# worker never has to wait on another.  The Syncrepl client only sees a move
+# once its assignment cache expires, so it might still send a few changes to
+# the old worker after a move.  Workers handle that by never taking a change
+# while an older change for the same group is waiting on a different worker.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import datetime
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from ..db import schema
+from ..db.workers import worker_for_group
+
+
+class Rebalancer(object):
+    """Move busy groups between workers.
+
+    :param int workers: The number of workers.
+
+    :param float threshold: A worker is overloaded when its load is more than
+    this many times the average load.
+
+    :param float decay: How much of a group's load is kept from one
+    :meth:`rebalance` to the next.
+
+    A group's load is the number of its changes which are waiting, averaged
+    over time (an exponential moving average), so that one burst doesn't make
+    a group look busy forever.
+    """
+
+    def __init__(self, workers, threshold, decay=0.5):
+        self.workers = workers
+        self.threshold = threshold
+        self.decay = decay
+        self.loads = dict()
+
+
+    def sample(self, session):
+        """Update group loads from the changes table.
+
+        :param session: A database session.
+        :type session: sqlalchemy.orm.session.Session
+
+        :returns: A dict mapping group name to the number of changes waiting.
+        """
+        changes_table = schema.Changes.__table__
+        waiting = dict(session.execute(
+            sqlalchemy.select([
+                changes_table.c.group, sqlalchemy.func.count()
+            ]).
+            where(changes_table.c.worker != 0).
+            group_by(changes_table.c.group)
+        ).fetchall())
+
+        # Decay every load, add the new samples, and forget idle groups.
+        for group in list(self.loads):
+            load = self.loads[group] * self.decay + waiting.get(group, 0)
+            if load < 0.01:
+                del self.loads[group]
+            else:
+                self.loads[group] = load
+        for group in waiting:
+            if group not in self.loads:
+                self.loads[group] = waiting[group]
+
+        return waiting
+
+
+    def rebalance(self, session):
+        """Sample loads, and move one group if a worker is overloaded.
+
+        :param session: A database session, which is not in autocommit mode.
+        :type session: sqlalchemy.orm.session.Session
+
+        :returns: The name of the group moved, or None.
+
+        Everything is done in one transaction, which is committed at the end.
+        """
+        assignments_table = schema.WorkerAssignments.__table__
+        try:
+            waiting = self.sample(session)
+            assignments = dict(session.execute(sqlalchemy.select([
+                assignments_table.c.group, assignments_table.c.worker
+            ])).fetchall())
+
+            # Work out each worker's load.
+            group_workers = dict()
+            worker_loads = dict((number, 0.0)
+                                for number in range(1, 1 + self.workers))
+            for (group, load) in self.loads.items():
+                worker = assignments.get(group)
+                if worker is None or worker not in worker_loads:
+                    worker = worker_for_group(group, self.workers)
+                group_workers[group] = worker
+                worker_loads[worker] = worker_loads[worker] + load
+
+            # Is anyone overloaded?
+            average_load = sum(worker_loads.values()) / self.workers
+            busiest = max(worker_loads, key=worker_loads.get)
+            idlest = min(worker_loads, key=worker_loads.get)
+            if (average_load == 0
+                or worker_loads[busiest] <= self.threshold * average_load
+            ):
+                logger.debug('Worker loads are balanced.')
+                session.commit()
+                return None
+            logger.info('Worker #%d has load %.1f; the average is %.1f.'
+                        % (busiest, worker_loads[busiest], average_load)
+            )
+
+            # Pick the busiest group which would make things better, and
+            # which has nothing waiting.
+            gap = worker_loads[busiest] - worker_loads[idlest]
+            candidates = sorted(
+                (group for group in group_workers
+                 if group_workers[group] == busiest
+                 and self.loads[group] < gap
+                 and waiting.get(group, 0) == 0),
+                key=self.loads.get, reverse=True
+            )
+            moved_group = None
+            for group in candidates:
+                if self.move(session, group, busiest, idlest) is True:
+                    moved_group = group
+                    break
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        if moved_group is None:
+            logger.info('No group on worker #%d could be moved right now.'
+                        % busiest
+            )
+        else:
+            logger.info('Moved group %s (load %.1f) from worker #%d to #%d.'
+                        % (moved_group, self.loads[moved_group], busiest,
+                           idlest)
+            )
+        return moved_group
+
+
+    def move(self, session, group, old_worker, new_worker):
+        """Assign a group to a new worker, if none of its changes are waiting.
+
+        :param session: A database session, in a transaction.
+        :type session: sqlalchemy.orm.session.Session
+
+        :param str group: The name of the group.
+
+        :param int old_worker: The worker the group is moving from.
+
+        :param int new_worker: The worker the group is moving to.
+
+        :returns: True if the group was moved.
+
+        The group's assignment row is locked first, and then we check for
+        waiting changes.  Transaction management is left to the caller.
+        """
+        assignments_table = schema.WorkerAssignments.__table__
+        changes_table = schema.Changes.__table__
+
+        # Write the new assignment (which locks it), then check the group is
+        # still quiet.  If it isn't, undo.
+        session.execute(sqlalchemy.text('SAVEPOINT rebalance_move'))
+        upsert = insert(assignments_table).values(
+            group = group,
+            worker = new_worker,
+            previous_worker = old_worker,
+            moved = datetime.datetime.utcnow(),
+        )
+        session.execute(upsert.on_conflict_do_update(
+            index_elements = [assignments_table.c.group],
+            set_ = dict(
+                worker = upsert.excluded.worker,
+                previous_worker = upsert.excluded.previous_worker,
+                moved = upsert.excluded.moved,
+            )
+        ))
+        waiting = session.execute(
+            sqlalchemy.select([sqlalchemy.func.count()]).
+            where(changes_table.c.group == group)
+        ).scalar()
+        if waiting > 0:
+            logger.debug('Group %s is no longer quiet.' % group)
+            session.execute(sqlalchemy.text(
+                'ROLLBACK TO SAVEPOINT rebalance_move'
+            ))
+            return False
+        session.execute(sqlalchemy.text('RELEASE SAVEPOINT rebalance_move'))
+        return True
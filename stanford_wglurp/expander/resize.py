@@ -0,0 +1,57 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp worker resize command.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# To change the number of workers:
+#
+# 1. Stop the LDAP client daemon.  (When it is restarted, it will pick up
+#    where it left off.)
+#
+# 2. Change the `[ldap] workers` option.
+#
+# 3. Run this command, which moves the waiting changes of every group whose
+#    worker has changed.  The expander can keep running while this happens.
+#
+# 4. Restart the expander (on every expander host, once they all have the new
+#    `[ldap] workers`), and then start the LDAP client daemon.
+#
+# Nothing needs to be drained first.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import sys
+
+from ..config import ConfigOption
+from ..db import engine
+from ..db.workers import resize_workers
+
+
+def main():
+    workers = int(ConfigOption['ldap']['workers'])
+    logger.info('Moving waiting changes to match %d workers.' % workers)
+
+    db_session = engine.Session()
+    try:
+        (group_count, change_count) = resize_workers(db_session, workers)
+    except Exception as e:
+        logger.critical('Unable to move waiting changes: %s' % e)
+        logger.critical('No changes were moved.')
+        sys.exit(1)
+    finally:
+        db_session.close()
+
+    print('Moved %d changes, from %d groups, to match %d workers.'
+          % (change_count, group_count, workers)
+    )
+    logger.info('Go Tree!')
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
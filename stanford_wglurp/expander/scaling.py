@@ -0,0 +1,111 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp Expander process scaling.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# The number of queues is fixed (it's the `[ldap] workers` option, which
+# groups are hashed across), but the number of worker processes isn't.  Each
+# process handles one or more queues, and the supervisor adds processes when
+# changes are waiting too long, and retires them when things are quiet,
+# between `[expander] min-processes` and `max-processes`.
+#
+# With several expander hosts, each host only deals out the queues (shards) it
+# holds a lease on; see leases.py.
+#
+# A queue must never be handled by two processes at once, or a group's
+# changes could be handled out of order.  So, when the number of processes
+# changes, every process is stopped (each one finishes what it's doing
+# first), and the new set is started with the queues dealt out again.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+
+def queue_sets(processes, queues):
+    """Deal out queues to processes.
+
+    :param int processes: The number of processes.
+
+    :param list queues: The queue numbers.
+
+    :returns: A dict mapping process number (from 1) to a list of queue
+    numbers.
+
+    Queues are dealt out round-robin, so every process has either the same
+    number of queues, or one more than the others.  There are never more
+    processes than queues.
+    """
+    processes = min(processes, len(queues))
+    sets = dict((number, list()) for number in range(1, 1 + processes))
+    for (index, queue) in enumerate(sorted(queues)):
+        sets[1 + index % processes].append(queue)
+    return sets
+
+
+class Scaler(object):
+    """Decide how many worker processes to run.
+
+    :param int minimum: The fewest processes to run.
+
+    :param int maximum: The most processes to run.
+
+    :param float up_wait: If any change has been waiting longer than this many
+    seconds, we need more processes.
+
+    :param int down_checks: How many checks in a row have to find things
+    quiet, before a process is retired.
+
+    Things are quiet when no change has been waiting for more than a tenth of
+    `up_wait`.  We scale up quickly (doubling), and down slowly (one at a
+    time), so that a refresh storm is absorbed quickly, without flapping.
+    """
+
+    def __init__(self, minimum, maximum, up_wait, down_checks=3):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.up_wait = up_wait
+        self.down_checks = down_checks
+        self.quiet_checks = 0
+
+
+    def decide(self, stats, processes):
+        """Decide how many processes to run.
+
+        :param dict stats: The output of
+        :func:`stanford_wglurp.expander.metrics.lane_stats`.
+
+        :param int processes: The number of processes running now.
+
+        :returns: The number of processes to run.
+        """
+        depth = sum(depth for (depth, wait) in stats.values())
+        oldest_wait = max([wait for (depth, wait) in stats.values()] + [0.0])
+        logger.debug('%d changes waiting; the oldest for %.1f seconds.'
+                     % (depth, oldest_wait)
+        )
+
+        if oldest_wait > self.up_wait:
+            self.quiet_checks = 0
+            wanted = min(self.maximum, max(self.minimum, processes * 2))
+            if wanted > processes:
+                logger.info('Changes have waited %.1f seconds; scaling up '
+                            'from %d to %d processes.'
+                            % (oldest_wait, processes, wanted)
+                )
+            return wanted
+
+        if oldest_wait <= self.up_wait / 10:
+            self.quiet_checks = self.quiet_checks + 1
+        else:
+            self.quiet_checks = 0
+        if self.quiet_checks >= self.down_checks and processes > self.minimum:
+            self.quiet_checks = 0
+            logger.info('Things are quiet; scaling down from %d to %d '
+                        'processes.' % (processes, processes - 1)
+            )
+            return processes - 1
+        return max(self.minimum, min(self.maximum, processes))
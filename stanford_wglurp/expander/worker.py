@@ -9,14 +9,30 @@
 # We have to load the logger first!
 from ..logging import logger
 
-import select
+from collections import OrderedDict
 import signal
 import sqlalchemy
+import sqlalchemy.exc
 import time
+from sqlalchemy.orm import aliased
 
 from ..config import ConfigOption
-from ..db import engine
+from ..db import encoding, engine
+from ..db.changes import LANE_BULK, LANE_DELTA
 from ..db.schema import Changes
+from . import delivered
+from .compact import compact_queue
+from .leases import lock_leases
+from .notify import Listener
+
+
+# Database errors which are likely to go away on their own.  Any other error
+# from processing a change, on its own, means the change itself is bad.
+TRANSIENT_ERRORS = (
+    sqlalchemy.exc.InterfaceError,
+    sqlalchemy.exc.OperationalError,
+    sqlalchemy.exc.TimeoutError,
+)
 
 
 # Make a class to hold our "globals".
@@ -24,9 +40,283 @@ class Singleton:
     exiting = False
 
 
-def run(number):
-    logger.info('Worker number %d started!' % number)
+def claim_lane(db_session, queues, lane, limit, claimed_ids):
+    """Claim the next changes from one lane of a worker's queues.
+
+    :param db_session: A database session, which is not in autocommit mode.
+    :type db_session: sqlalchemy.orm.session.Session
+
+    :param list queues: The worker numbers whose queues we take changes from.
+
+    :param int lane: The lane to take changes from.
+
+    :param int limit: The maximum number of changes to claim.
+
+    :param list claimed_ids: The IDs of changes already claimed for this
+    batch.  They are not claimed again, and they don't hold anything up.
+
+    :returns: A list of Changes, oldest first.
+
+    A change is only taken if every older change for the same group is
+    either in this lane of our queues, or already claimed.  So, a small change
+    for a group waits behind that group's SYNC, but not behind anyone else's.
+    """
+    if limit <= 0:
+        return list()
+
+    older_changes = aliased(Changes)
+    blocking = sqlalchemy.and_(
+        older_changes.group == Changes.group,
+        older_changes.id < Changes.id,
+        sqlalchemy.or_(
+            ~older_changes.worker.in_(queues),
+            older_changes.lane != lane,
+        ),
+    )
+    query = db_session.query(Changes).\
+        filter(Changes.worker.in_(queues)).\
+        filter(Changes.lane == lane)
+    if len(claimed_ids) > 0:
+        blocking = sqlalchemy.and_(
+            blocking, ~older_changes.id.in_(claimed_ids)
+        )
+        query = query.filter(~Changes.id.in_(claimed_ids))
+    return query.\
+        filter(~sqlalchemy.exists().where(blocking)).\
+        order_by(Changes.id).\
+        limit(limit).\
+        with_for_update(of=Changes, skip_locked=True).\
+        all()
+
+
+def claim_batch(db_session, queues, batch_size, bulk_reserve=0,
+                claimed_ids=(), owner=None):
+    """Claim the next batch of changes for a worker process.
+
+    :param db_session: A database session, which is not in autocommit mode.
+    :type db_session: sqlalchemy.orm.session.Session
+
+    :param list queues: The worker numbers whose queues we take changes from.
+
+    :param int batch_size: The maximum number of changes to claim.
+
+    :param int bulk_reserve: The number of places in the batch kept for the
+    bulk lane, so that SYNCs are never starved.
+
+    :param claimed_ids: The IDs of changes which are already being worked
+    on.  They are not claimed again, and they don't hold anything up.
+    :type claimed_ids: Iterable of int
+
+    :param str owner: The name of our host.  If provided, only queues whose
+    leases we still hold are used (see
+    :func:`stanford_wglurp.expander.leases.lock_leases`).
+
+    :returns: A list of Changes, oldest first.
+
+    Changes are taken from the delta lane first, then the bulk lane, and then
+    (if there's still room) the delta lane again.  Within each group, changes
+    are still processed in order.
+
+    The changes are locked until the session's transaction ends, so that they
+    can't be moved to another worker (by a resize) until we're done.  Changes
+    which are already locked are skipped, instead of waiting for them.
+
+    If a group was just moved to us, older changes for it might still be
+    waiting in a queue we don't handle, so that group is skipped until
+    they're done.
+    """
+    queues = lock_leases(db_session, owner, queues)
+    if len(queues) == 0:
+        return list()
+    claimed_ids = list(claimed_ids)
+    batch = claim_lane(db_session, queues, LANE_DELTA,
+                       max(1, batch_size - bulk_reserve), claimed_ids)
+    batch.extend(claim_lane(db_session, queues, LANE_BULK,
+                            batch_size - len(batch),
+                            claimed_ids + [change.id for change in batch]))
+    if len(batch) < batch_size:
+        batch.extend(claim_lane(db_session, queues, LANE_DELTA,
+                                batch_size - len(batch),
+                                claimed_ids + [change.id for change in batch]))
+    batch.sort(key=lambda change: change.id)
+    return batch
+
+
+def process_change(db_session, change):
+    """Process one change.
+
+    :param db_session: A database session, in the transaction which will
+    delete the change.
+    :type db_session: sqlalchemy.orm.session.Session
+
+    :param change: The change to process.
+    :type change: stanford_wglurp.db.schema.Changes
+
+    :returns: None.
+
+    The group's delivered membership is updated, and SYNCs are turned into
+    ADDs and REMOVEs when the group has a baseline.
+    """
+    members = encoding.decode_members(
+        change.payload_format, change.data, change.payload
+    )
+
+    if change.action == 'ADD':
+        delivered.add_members(db_session, change.group, members)
+        adds = members
+        removes = list()
+    elif change.action == 'REMOVE':
+        delivered.remove_members(db_session, change.group, members)
+        adds = list()
+        removes = members
+    elif change.action == 'SYNC_BEGIN':
+        delivered.sync_begin(db_session, change.group)
+        logger.info('Chunked SYNC of group %s starting.' % change.group)
+        return
+    elif change.action in ('SYNC', 'SYNC_CHUNK', 'SYNC_END'):
+        # A chunked SYNC is spread over several changes (and maybe several
+        # batches); the delivered_groups table keeps track of where we are.
+        if change.action == 'SYNC':
+            (baseline, adds, removes) = delivered.sync(
+                db_session, change.group, members
+            )
+        elif change.action == 'SYNC_CHUNK':
+            (baseline, adds, removes) = delivered.sync_chunk(
+                db_session, change.group, members
+            )
+        else:
+            (baseline, adds, removes) = delivered.sync_end(
+                db_session, change.group
+            )
+
+        # Without a baseline, the whole membership has to go out.  (A
+        # SYNC_END has no members of its own; it only removes whoever wasn't
+        # in any chunk, so it is logged like any other change.)
+        if baseline is False and change.action != 'SYNC_END':
+            # TODO: Check for subscriptions, and make update messages.
+            logger.info('%s of group %s has no baseline; sending %d members.'
+                        % (change.action, change.group, len(members))
+            )
+            return
+    else:
+        logger.info('Change found!  For group %s, action is %s.'
+                    % (change.group, change.action)
+        )
+        return
+
+    # TODO: Check for subscriptions, and make update messages.
+    logger.info('%s of group %s: adding %d members, removing %d members.'
+                % (change.action, change.group, len(adds), len(removes))
+    )
+
+
+def park_change(db_session, change_id):
+    """Take a bad change out of its queue.
+
+    :param db_session: A database session, which is not in autocommit mode.
+    :type db_session: sqlalchemy.orm.session.Session
+
+    :param int change_id: The ID of the change.
+
+    :returns: None.
+
+    The change stays in the table, with its worker number made negative, so
+    no worker will take it.  Later changes for the same group are held up
+    behind it (so they stay in order) until someone fixes the change, and
+    puts it back (by making the worker number positive again), or deletes it.
+    """
+    db_session.query(Changes).\
+        filter(Changes.id == change_id).\
+        filter(Changes.worker > 0).\
+        update({Changes.worker: -Changes.worker}, synchronize_session=False)
+    db_session.commit()
+
+
+def process_singly(db_session, queues, batch, owner=None):
+    """Process a failed batch one change at a time, group by group.
+
+    :param db_session: A database session, which is not in autocommit mode.
+    The batch's transaction must already have been rolled back.
+    :type db_session: sqlalchemy.orm.session.Session
+
+    :param list queues: The worker numbers whose queues we take changes from.
+
+    :param list batch: The (change ID, group name) of each change from the
+    batch, in order.
+
+    :param str owner: The name of our host, or None.
+
+    :returns: The number of changes processed.
+
+    Each change is processed (and deleted) in its own transaction, so one
+    bad change doesn't hold up every other group.  If a change fails, it is
+    parked (see :func:`park_change`), and the rest of its group is left in
+    the queue, behind it.  If the database itself has a problem, we stop.
+    """
+    groups = OrderedDict()
+    for (change_id, group) in batch:
+        groups.setdefault(group, list()).append(change_id)
+
+    processed_count = 0
+    for (group, change_ids) in groups.items():
+        for change_id in change_ids:
+            try:
+                change = db_session.query(Changes).\
+                    filter(Changes.id == change_id).\
+                    filter(Changes.worker.in_(
+                        lock_leases(db_session, owner, queues)
+                    )).\
+                    with_for_update(skip_locked=True).\
+                    one_or_none()
+
+                # If the change has gone (or is busy), the rest of the group
+                # can't go ahead of it.
+                if change is None:
+                    db_session.rollback()
+                    break
+                process_change(db_session, change)
+                db_session.delete(change)
+                db_session.commit()
+                processed_count = processed_count + 1
+            except TRANSIENT_ERRORS:
+                db_session.rollback()
+                raise
+            except Exception as e:
+                db_session.rollback()
+                logger.error('Change %d (for group %s) can not be processed, '
+                             'and has been parked: %s'
+                             % (change_id, group, e)
+                )
+                park_change(db_session, change_id)
+                break
+            finally:
+                db_session.expunge_all()
+    return processed_count
+
+
+def run(number, queues=None, owner=None):
+    """Run a worker process.
+
+    :param int number: The process number.
+
+    :param list queues: The worker numbers whose queues this process handles.
+    If not provided, only queue `number` is handled.
+
+    :param str owner: The name of our host, which holds the leases on our
+    queues.  If None, leases aren't checked.
+
+    :returns: None.
+    """
+    if queues is None:
+        queues = [number]
+    logger.info('Worker number %d started, for queues %s!'
+                % (number, ', '.join(str(queue) for queue in queues))
+    )
     db_session = engine.Session()
+    batch_size = int(ConfigOption['expander']['batch-size'])
+    bulk_reserve = int(ConfigOption['expander']['bulk-reserve'])
+    compact_interval = float(ConfigOption['expander']['compact-interval'])
+    next_compact = 0
 
     # Set up a stop handler
     def stop_handler(signal_number, frame):
@@ -37,37 +327,72 @@ def run(number):
     signal.signal(signal.SIGINT, stop_handler)
     signal.signal(signal.SIGTERM, stop_handler)
 
+    # Our listener stays connected the whole time we run.
+    listener = Listener(['expander%d' % queue for queue in queues])
+    batch = list()
+
     # We will look forever, until told to exit.
     while Singleton.exiting is False:
-        # Set up the query to get our next change
-        logger.debug('Preparing query for next change')
-        next_change_query = db_session.query(Changes).\
-            filter(Changes.worker == number).\
-            order_by(Changes.id).\
-            limit(1)
-
-        # Actually run the query!
-        logger.debug('Querying for next change')
-        next_change = next_change_query.one_or_none()
-
-        # If we got a change, process it!
-        if next_change is not None:
-            logger.debug('Found a change')
-
-            # For now, grab some info from the change.
-            # TODO: Check for subscriptions, and make update messages.
-            logger.info('Change found!  For group %s, action is %s.'
-                        % (next_change.group, next_change.action)
-            )
-            time.sleep(0.25)
+        # A full batch means we're behind, so compact our queue (but not too
+        # often).
+        if (compact_interval > 0
+            and len(batch) == batch_size
+            and time.monotonic() >= next_compact
+        ):
+            logger.debug('Compacting our queues')
+            try:
+                for queue in queues:
+                    compact_queue(db_session, queue, owner=owner)
+            except Exception as e:
+                logger.error('Unable to compact our queues: %s' % e)
+            next_compact = time.monotonic() + compact_interval
 
-            # Mark the change for deletion, since we're processing it.
-            logger.debug('Deleting change')
-            db_session.delete(next_change)
+        # Claim our next batch of changes.
+        logger.debug('Querying for next changes')
+        batch = claim_batch(db_session, queues, batch_size, bulk_reserve,
+                            owner=owner)
 
-            # Commit our changes!
-            logger.debug('Committing!')
-            db_session.commit()
+        # If we got changes, process them!
+        if len(batch) > 0:
+            logger.debug('Found %d changes' % len(batch))
+            batch_keys = [(change.id, change.group) for change in batch]
+
+            # Changes are in order, so each group's changes stay in order.
+            # If anything fails, the whole batch is rolled back, and tried
+            # again one change at a time, so a bad change doesn't hold up
+            # everyone else.
+            try:
+                for change in batch:
+                    process_change(db_session, change)
+
+                # Delete all of the changes at once, since we've processed
+                # them.
+                logger.debug('Deleting changes')
+                db_session.query(Changes).\
+                    filter(Changes.id.in_([change.id for change in batch])).\
+                    delete(synchronize_session=False)
+
+                # Commit our changes!
+                logger.debug('Committing!')
+                db_session.commit()
+            except Exception as e:
+                logger.error('Unable to process %d changes: %s'
+                             % (len(batch), e)
+                )
+                db_session.rollback()
+                if not isinstance(e, TRANSIENT_ERRORS):
+                    logger.info('Trying the changes one at a time.')
+                    try:
+                        process_singly(db_session, queues, batch_keys, owner)
+                    except Exception as e:
+                        logger.error('Unable to process changes one at a '
+                                     'time: %s' % e
+                        )
+                        db_session.rollback()
+                        listener.wait(5)
+                else:
+                    listener.wait(5)
+            db_session.expunge_all()
 
         else:
             logger.debug('No change found.')
@@ -77,29 +402,14 @@ def run(number):
             logger.debug('Rolling back for safety.')
             db_session.rollback()
 
-            # Get ready to listen for messages on 'expanderX', for 60 seconds.
-            # We do this outside of the session, because we don't want a
-            # transaction.
-            db_connection = engine.AutoCommitSession().connection()
-
-            # Prepare our query, and trigger execution.
-            logger.debug('Sleeping on NOTIFY expander%d...' % number)
-            listen_query = sqlalchemy.text(
-                    'LISTEN expander%d' % number
-                )
-            listen_result = db_connection.execute(listen_query)
-
-            # Listen for up to 60 seconds for a notification.
-            # We'll return early if a notification comes in, and when signalled.
-            # TODO: This call doesn't exit early when signalled.
-            select.select([db_connection.connection], [], [], 30)
-            logger.debug('Sleep complete!')
-
-            # Free up the listen result.
-            listen_result.close()
+            # Wait for a notification on 'expanderX', for up to 30 seconds.
+            # We'll return early if a notification comes in, and when
+            # signalled.
+            listener.wait(30)
 
             # We'll loop around again now!
 
     # At this point, we've hit the end of the while loop, and exiting is True.
 
+    listener.close()
     logger.info('Worker number %d exiting!' % number)
@@ -17,7 +17,7 @@ from ..logging import logger
 import fcntl
 import ldap
 from ldapurl import LDAPUrl
-from os import fsync, path
+from os import fsync, path, remove
 import signal
 from syncrepl_client import Syncrepl, SyncreplMode
 from sys import exit
@@ -25,6 +25,11 @@ import threading
 import time
 
 from .callback import LDAPCallback
+from .coalesce import ChangeCoalescer
+from .groupcache import GroupNameCache
+from .localdb import MembershipDB
+from .spool import ChangeSpool
+from .writer import ChangeWriter
 from ..config import ConfigBoolean, ConfigOption, parsed_ldap_url
 from ..db import engine
 
@@ -59,6 +64,53 @@ def write_metrics(metrics_file, stats_class, finish_event):
         print('ldap.records.deleted', stats_class.records_deleted,
             sep='=', file=metrics_file
         )
+        print('ldap.groupcache.hits', stats_class.group_names.hits,
+            sep='=', file=metrics_file
+        )
+        print('ldap.groupcache.misses', stats_class.group_names.misses,
+            sep='=', file=metrics_file
+        )
+        print('ldap.groupcache.size', len(stats_class.group_names.names),
+            sep='=', file=metrics_file
+        )
+        print('ldap.coalesce.received', stats_class.coalescer.changes_received,
+            sep='=', file=metrics_file
+        )
+        print('ldap.coalesce.cancelled',
+            stats_class.coalescer.changes_cancelled,
+            sep='=', file=metrics_file
+        )
+        print('ldap.coalesce.sent', stats_class.coalescer.rows_sent,
+            sep='=', file=metrics_file
+        )
+        print('ldap.writer.queued', stats_class.writer.queue_depth(),
+            sep='=', file=metrics_file
+        )
+        print('ldap.writer.written', stats_class.writer.changes_written,
+            sep='=', file=metrics_file
+        )
+        print('ldap.writer.batches', stats_class.writer.batches_written,
+            sep='=', file=metrics_file
+        )
+        print('ldap.writer.failures', stats_class.writer.write_failures,
+            sep='=', file=metrics_file
+        )
+        print('ldap.writer.waits', stats_class.writer.send_waits,
+            sep='=', file=metrics_file
+        )
+        print('ldap.writer.wait_time',
+            round(stats_class.writer.send_wait_time),
+            sep='=', file=metrics_file
+        )
+        print('ldap.spool.pending', stats_class.writer.spool.pending,
+            sep='=', file=metrics_file
+        )
+        print('ldap.spool.spooled', stats_class.writer.spool.changes_spooled,
+            sep='=', file=metrics_file
+        )
+        print('ldap.spool.replayed', stats_class.writer.spool.changes_replayed,
+            sep='=', file=metrics_file
+        )
 
         # Flush file, release locks, and either sleep or end.
         # Note we don't actually release the lock, we downgrade it.
@@ -128,6 +180,34 @@ def main():
                   )
     )
 
+    # Set up the group name cache.
+    LDAPCallback.group_names = GroupNameCache(
+        size = int(ConfigOption['ldap']['group-cache-size']),
+        encoding = LDAPCallback.groups_encoding,
+    )
+
+    # Set up the change writer.
+    LDAPCallback.writer = ChangeWriter(
+        queue_size = int(ConfigOption['ldap']['writer-queue-size']),
+        spool = ChangeSpool(ConfigOption['ldap']['data'] + 'spool'),
+    )
+
+    # Set up the change coalescer.
+    LDAPCallback.coalescer = ChangeCoalescer(
+        window = float(ConfigOption['ldap']['coalesce-window']),
+        send = LDAPCallback.send_changes,
+    )
+
+    # If the membership tables are kept separately, open them now.
+    if ConfigOption['ldap']['membership'] != 'shared':
+        LDAPCallback.membership_db = MembershipDB(
+            mode = ConfigOption['ldap']['membership'],
+            path = ConfigOption['ldap']['data'] + 'membership.sqlite3',
+            checkpoint_interval = int(
+                ConfigOption['ldap']['checkpoint-interval']
+            ),
+        )
+
     # Set up our Syncrepl client
     try:
         logger.info('LDAP URL is %s' % parsed_ldap_url.unparse())
@@ -175,6 +255,22 @@ def main():
         logger.debug('Calling please_stop')
         client.please_stop()
 
+    # In the persist phase, our tables are committed as soon as a change is
+    # recorded, but the change itself is held by the coalescer and the writer
+    # for a while before it's safe.  So, we keep a marker file while we run,
+    # and only remove it once everything has been written (or spooled).  If
+    # it's still there when we start, changes might have been lost, so our
+    # snapshot can't be trusted, and the end of the refresh phase will SYNC
+    # every group.
+    running_path = ConfigOption['ldap']['data'] + 'running'
+    if path.exists(running_path):
+        logger.warning('The last run did not shut down cleanly.  '
+                       'All groups will be synced.'
+        )
+        LDAPCallback.unclean_start = True
+    with open(running_path, mode='w', encoding='ascii') as running_file:
+        fsync(running_file.fileno())
+
     # Start our Syncrepl thread, and intercept signals.
     logger.debug('Spawning client thread...')
     client_thread = threading.Thread(
@@ -189,6 +285,28 @@ def main():
     client_thread.start()
     logger.info('LDAP client thread #%d launched!' % client_thread.ident)
 
+    # Start our writer thread
+    writer_event = threading.Event()
+    writer_thread = threading.Thread(
+        name='LDAP writer',
+        target=LDAPCallback.writer.run,
+        daemon=True,
+        args=(writer_event,)
+    )
+    writer_thread.start()
+    logger.info('LDAP writer thread #%d launched!' % writer_thread.ident)
+
+    # Start our coalescer thread
+    coalescer_event = threading.Event()
+    coalescer_thread = threading.Thread(
+        name='LDAP coalescer',
+        target=LDAPCallback.coalescer.run,
+        daemon=True,
+        args=(coalescer_event,)
+    )
+    coalescer_thread.start()
+    logger.info('LDAP coalescer thread #%d launched!' % coalescer_thread.ident)
+
     # Start our metrics thread
     if ConfigBoolean['metrics']['active'] is True:
         metrics_event = threading.Event()
@@ -207,6 +325,28 @@ def main():
         client_thread.join(timeout=5.0)
     logger.info('LDAP client thread has exited!')
 
+    # Send any changes which are still being held.
+    logger.debug('Signaling coalescer thread to exit.')
+    coalescer_event.set()
+    coalescer_thread.join()
+    logger.info('Coalescer thread has exited!')
+
+    # Write out everything that's still queued.
+    logger.debug('Signaling writer thread to exit.')
+    writer_event.set()
+    writer_thread.join()
+    logger.info('Writer thread has exited!')
+
+    # If every change is safe, this was a clean shutdown.
+    if (len(LDAPCallback.coalescer.pending) == 0
+        and LDAPCallback.writer.flush(timeout=0) is True
+    ):
+        remove(running_path)
+    else:
+        logger.error('Some changes were not written.  '
+                     'All groups will be synced at the next start.'
+        )
+
     # If metrics are running, signal them to stop.
     # Before closing, write out zeroes, to prevent fake stats being collected.
     if ConfigBoolean['metrics']['active'] is True:
@@ -222,7 +362,14 @@ def main():
             sep='=', file=metrics_file
         )
         print('ldap.records.added=0', 'ldap.records.modified=0',
-              'ldap.records.deleted=0',
+              'ldap.records.deleted=0', 'ldap.groupcache.hits=0',
+              'ldap.groupcache.misses=0', 'ldap.groupcache.size=0',
+              'ldap.coalesce.received=0', 'ldap.coalesce.cancelled=0',
+              'ldap.coalesce.sent=0', 'ldap.writer.queued=0',
+              'ldap.writer.written=0', 'ldap.writer.batches=0',
+              'ldap.writer.failures=0', 'ldap.writer.waits=0',
+              'ldap.writer.wait_time=0', 'ldap.spool.pending=0',
+              'ldap.spool.spooled=0', 'ldap.spool.replayed=0',
                 sep="\n", file=metrics_file
         )
         logger.debug('Flushing and closing metrics file.')
@@ -232,8 +379,15 @@ def main():
         metrics_file.close()
 
     # Unbind, cleanup, and exit.
+    logger.info('Group name cache hit rate was %.1f%% (%d hits, %d misses).'
+                % (LDAPCallback.group_names.hit_rate() * 100,
+                   LDAPCallback.group_names.hits,
+                   LDAPCallback.group_names.misses)
+    )
     logger.info('Ending database session.')
     LDAPCallback.db_session.close()
+    if LDAPCallback.membership_db is not None:
+        LDAPCallback.membership_db.close()
     logger.info('Unbinding & disconnecting from the LDAP server.')
     client.db_reconnect()
     client.unbind()
@@ -21,6 +21,9 @@ from sys import exit
 
 from ..config import ConfigBoolean, ConfigOption, parsed_ldap_url
 from ..db import changes, engine, schema
+from .localdb import prepare_schema
+from .membership import MembershipIndex
+from .refresh import RefreshBuilder
 from .support import *
 
 # We also need threading, which might not be present.
@@ -58,6 +61,57 @@ class LDAPCallback(BaseCallback):
     # Placeholder for the DB session
     db_session = None
 
+    # Placeholder for the group name cache, shared by all callbacks.
+    group_names = None
+
+    # Placeholder for the change coalescer, used in the persist phase.
+    coalescer = None
+
+    # Placeholder for the change writer, which sends changes to the database.
+    writer = None
+
+    # Placeholder for the refresh builder, which is set up at bind time.
+    builder = None
+
+    # Placeholder for the membership index, which is set up after refresh.
+    index = None
+
+    # Placeholder for the membership database.  If None, the membership
+    # tables live in Syncrepl's database.
+    membership_db = None
+
+    # True if the last run didn't shut down cleanly, so that changes it
+    # recorded in our tables might never have been written.
+    unclean_start = False
+
+
+    @classmethod
+    def membership_cursor(cls, cursor):
+        """Get the cursor to use for the membership tables.
+
+        :param cursor: The cursor Syncrepl gave to the callback.
+        :type cursor: sqlite3.Cursor
+
+        :return: The cursor for the membership tables.
+        """
+        if cls.membership_db is None:
+            return cursor
+        else:
+            return cls.membership_db.cursor
+
+
+    @classmethod
+    def membership_commit(cls):
+        """Commit changes to the membership tables.
+
+        :return: None.
+
+        When the membership tables live in Syncrepl's database, this does
+        nothing, because Syncrepl commits once the callback ends.
+        """
+        if cls.membership_db is not None:
+            cls.membership_db.commit()
+
 
     @classmethod
     def bind_complete(cls, ldap, cursor):
@@ -71,24 +125,15 @@ class LDAPCallback(BaseCallback):
                     % ldap.whoami_s()
         )
 
-        # Create database tables, if needed.
-        logger.debug('Creating workgroup tables in Syncrepl database.')
-        cursor.executescript('''
-            CREATE TABLE IF NOT EXISTS workgroups (
-                name VARCHAR(128) PRIMARY KEY
-            );
-
-            CREATE TABLE IF NOT EXISTS members (
-                dn       TEXT         PRIMARY KEY,
-                uniqueid VARCHAR(128) UNIQUE,
-                username VARCHAR(128) UNIQUE
-            );
-
-            CREATE TABLE IF NOT EXISTS workgroup_members (
-                workgroup_name UNSIGNED INT REFERENCES workgroups (name),
-                member_id VARCHAR(128) REFERENCES members (uniqueid)
-            );
-        ''')
+        # Create (or upgrade) database tables, if needed.
+        # (A separate membership database did this when it was opened.)
+        if cls.membership_db is None:
+            logger.debug('Preparing workgroup tables in Syncrepl database.')
+            prepare_schema(cursor)
+
+        # Refresh-phase records are fed into the builder as they arrive.
+        cls.builder = RefreshBuilder(cls)
+        cls.builder.start(cls.membership_cursor(cursor))
 
         logger.info('Beginning refresh...')
 
@@ -103,62 +148,71 @@ class LDAPCallback(BaseCallback):
         """
 
         logger.info('LDAP server refresh complete!')
+        cursor = cls.membership_cursor(cursor)
 
-        logger.info('Clearing database...')
-        cursor.executescript('''
-            DELETE FROM workgroup_members;
-            DELETE FROM workgroups;
-            DELETE FROM members;
-        ''')
-
-        # Start going through all of the users.
-        # Since this is the same as a single record add, let's call that method.
-        # add_method is used so that we don't have to resolve 'cls......' in
-        # every iteration of the for loop.
-        # As this goes, we build a list of groups that have been created.
-        logger.info('Building view of current workgroups...')
-        add_method = cls.record_add_persist
-        groups_created = set()
-        for user in items:
-            groups_modified = add_method(
-                user, items[user], cursor, send_message=False
-            )
-            groups_created |= set(groups_modified)
+        # Most records were staged as they arrived.  Fill in the ones that
+        # haven't changed since our last run, which we weren't told about.
+        logger.info('Finishing view of current workgroups...')
+        builder = cls.builder
+        cls.builder = None
+        groups_count = builder.finish(items, cursor)
 
         logger.info('%d LDAP records processed to populate %d groups.'
-                    % (len(items), len(groups_created))
+                    % (len(items), groups_count)
+        )
+        logger.info('Group name cache has %d names (%d hits, %d misses).'
+                    % (len(cls.group_names.names), cls.group_names.hits,
+                       cls.group_names.misses)
         )
 
+        # Compare the new view with what we had at the end of our last run.
+        # If we don't have a complete view from last time, then we have to
+        # SYNC everything.
+        logger.info('Comparing with our view from the last run...')
+        snapshot_known = (get_state(cursor, 'snapshot') == 'complete'
+                          and cls.unclean_start is False)
+        builder.compare(cursor, snapshot_known)
+        builder.replace(cursor)
+
+        # Send out what changed.  Removes go first, so that a change of
+        # username (a remove and an add) is sent in the right order.
+        # Each of these gets its own cursor, since they are read as we go.
+        # Big groups are SYNCed in chunks, so they're never all in memory.
+        sync_count = cls.writer.send_changes(sync_changes(
+            cursor.connection.cursor(), groups_table='refresh_syncs',
+            chunk_size=int(ConfigOption['ldap']['sync-chunk-size'])
+        ))
+        remove_count = cls.send_changes('REMOVE', builder.changes(
+            cursor.connection.cursor(), 'REMOVE'
+        ))
+        add_count = cls.send_changes('ADD', builder.changes(
+            cursor.connection.cursor(), 'ADD'
+        ))
+        logger.info('Sent %d SYNC changes, REMOVE for %d groups, '
+                    'and ADD for %d groups.'
+                    % (sync_count, remove_count, add_count)
+        )
+        for table in ('refresh_syncs', 'refresh_adds', 'refresh_removes'):
+            cursor.execute('DROP TABLE temp.%s' % table)
+        del builder
+
+        # The snapshot can't be marked complete until those changes are safe
+        # (in the database, or the spool).  Otherwise, a crash before the
+        # writer gets to them would lose them for good, because the next run
+        # would compare against the new view.
+        logger.info('Waiting for the changes to be written...')
+        cls.writer.flush()
+
+        # Our tables now have a complete view, which the persist phase will
+        # keep current.
         # The commit will happen as soon as the callback ends!
+        set_state(cursor, 'snapshot', 'complete')
 
-        # Send a sync message for each group created.
-        db_session = engine.AutoCommitSession()
-        for group_name in groups_created:
-            logger.info('Syncing membership for group %s' % group_name)
-
-            # Get the membership of the group
-            cursor.execute('''
-                    SELECT members.uniqueid,
-                           members.username
-                      FROM workgroup_members
-                INNER JOIN members
-                        ON members.uniqueid = workgroup_members.member_id
-                 WHERE workgroup_members.workgroup_name = ?
-            ''', (group_name,))
-
-            # Construct the change entry using what we got.
-            db_entry = changes.ChangeEntry(
-                action = 'SYNC',
-                group = group_name,
-                members = cursor.fetchall(),
-            )
-            db_entry.add(db_session)
-            db_session.flush()
-
-        # Log completion, and close the session.
-        logger.info('Sync changes uploaded!')
-        db_session.close()
+        cls.membership_commit()
 
+        # Load the view into memory, for the persist-phase callbacks to use.
+        cls.index = MembershipIndex()
+        cls.index.load(cursor)
 
         # Now we can start doing stuff when an event comes in!
         logger.debug('Monkey-patching add, delete, and change records...')
@@ -170,6 +224,24 @@ class LDAPCallback(BaseCallback):
         logger.info('Refresh-complete processing is complete!')
 
 
+    @classmethod
+    def send_changes(cls, action, groups):
+        """Send a change for each of a number of groups.
+
+        :param str action: The change action ("SYNC", "ADD", or "REMOVE").
+
+        :param groups: The groups, and their members, to send.
+        :type groups: Iterable of (group name, member list) tuples
+
+        :return: The number of changes sent.
+
+        Changes are queued for the change writer, which writes them to the
+        database from its own thread.  This only waits if the writer's queue
+        is full.
+        """
+        return cls.writer.send(action, groups)
+
+
     @classmethod
     def record_add_persist(cls, dn, attrs, cursor, send_message=True):
         """Called to indicate the addition of a new LDAP record, in the persist
@@ -191,61 +263,29 @@ class LDAPCallback(BaseCallback):
 
         # Get the unique ID and the username.
         # This catches cases where attributes are missing, or multi-valued.
-        unique_username = list()
-        for (attribute_name, attribute_encoding) in (
-            (cls.unique_attribute, cls.unique_encoding),
-            (cls.username_attribute, cls.username_encoding)
-        ):
-            # In one operation, we access the attribute list (can throw
-            # KeyError), access the first item (can throw IndexError), and
-            # decode it (can throw UnicodeError).  Saves us alot of checks!
-            try:
-                attribute_value_list = attrs[attribute_name]
-                unique_username.append(
-                    attribute_value_list[0].decode(attribute_encoding)
-                )
-            except (KeyError, IndexError):
-                logger.warning('Entry "%s" is missing the required '
-                               '\'%s\' attribute!' % (dn, attribute_name)
-                )
-                break
-            except UnicodeError as e:
-                logger.warning('Error %s decoding the \'%s\' of entry "%s": %s'
-                               % (attribute_encoding, attribute_name,
-                                  dn, str(e)
-                                 )
-                )
-                break
-            # Finally, catch if the attribute is multi-valued.
-            if len(attribute_value_list) > 1:
-                logger.error('Entry "%s" has a multi-valued '
-                             '\'%s\' attribute!' % (dn, attribute_name)
-                )
-                break
-
-        # If we didn't run through the for() loop twice, skip this user.
+        unique_username = decode_user(dn, attrs,
+            (cls.unique_attribute, cls.username_attribute),
+            (cls.unique_encoding, cls.username_encoding)
+        )
+
+        # If decoding failed, skip this user.
         # (The error/warning would have been logged already.
         # NOTE: Return an empty list, since no groups were touched.
-        if len(unique_username) < 2:
+        if unique_username is None:
             return list()
 
         # Finally our uid and uname are known for this user!
-        # Add them to the database.
+        # Add them to the index.
         # If the add fails, abort the entire operation.
         logger.debug('DN "%s"\'s unique ID / username is %s / %s'
                      % (dn, unique_username[0], unique_username[1])
         )
-        try:
-            cursor.execute('''
-                INSERT
-                  INTO members
-                      (dn, uniqueid, username)
-                VALUES (?, ?, ?)
-            ''', (dn, unique_username[0], unique_username[1]))
-        except sqlite3.Error as e:
-            logger.error('Database problem attempting to add '
-                         'DN/unique ID/username "%s"/"%s"/"%s" to members: %s'
-                         % (dn, unique_username[0], unique_username[1], e))
+        if cls.index.add_member(
+            dn, unique_username[0], unique_username[1]
+        ) is False:
+            logger.error('Unable to add DN/unique ID/username "%s"/"%s"/"%s" '
+                         'to members: One of them is already in use.'
+                         % (dn, unique_username[0], unique_username[1]))
             return list()
 
         # Our multivalued attribute is allowed to be missing/empty
@@ -266,23 +306,25 @@ class LDAPCallback(BaseCallback):
             # add_user_to_group is from .support
             # We either get a group name as a string here, or None if the add failed.
             actual_group = add_user_to_group(
-                cursor,
+                cls.index,
                 unique_username,
                 group,
-                cls.groups_encoding
+                cls.group_names
             )
             actual_groups.append(actual_group)
 
             # Also, send a message about the group addition.
             # NOTE: This is disabled if we are being called by refresh_done.
-            if send_message is True:
-                # TODO: Send "add" message.
+            if send_message is True and actual_group is not None:
+                cls.coalescer.add(actual_group, unique_username)
                 cls.records_count_lock.acquire()
                 cls.records_added = cls.records_added + 1
                 cls.records_count_lock.release()
-                pass
 
+        # Write out our changes.
         # Syncrepl will handle committing, once the callback ends!
+        cls.index.flush(cls.membership_cursor(cursor))
+        cls.membership_commit()
         return actual_groups
 
 
@@ -297,7 +339,7 @@ class LDAPCallback(BaseCallback):
 
         :return: None - any returned value is ignored.
 
-        At the start, in the refresh phase, we don't do anything.
+        In the refresh phase, the record is staged by the refresh builder.
         Later on, we do stuff!
         """
         logger.debug('New record %s' % dn)
@@ -306,6 +348,7 @@ class LDAPCallback(BaseCallback):
         cls.records_count_lock.acquire()
         cls.records_added = cls.records_added + 1
         cls.records_count_lock.release()
+        cls.builder.add(dn, attrs, cls.membership_cursor(cursor))
 
 
     @classmethod
@@ -323,40 +366,27 @@ class LDAPCallback(BaseCallback):
         cls.records_count_lock.release()
 
         # Start by getting the unique ID and username for this user.
-        cursor.execute('''
-            SELECT uniqueid, username
-              FROM members
-             WHERE dn = ?
-        ''', (dn,))
-        member_info = cursor.fetchone()
+        member_info = cls.index.lookup_dn(dn)
         if (member_info is None):
             logger.error('Trying to delete nonexistant DN "%s"' % dn)
             return
 
-        # Look up all of the member's groups
-        cursor.execute('''
-            SELECT workgroup_name
-              FROM workgroup_members
-             WHERE member_id = ?
-        ''', (member_info[0],))
-        groups_list = cursor.fetchall()
-
         # For each membership, remove the mapping and send a message.
-        for group in [group_tuple[0] for group_tuple in groups_list]:
-            remove_user_from_group(cursor, member_info, group)
-            # TODO: Send "User removed from group" message.
+        # (We copy the member's groups, since we change them as we go.)
+        for group in list(cls.index.groups_of(member_info[0])):
+            actual_group = remove_user_from_group(cls.index, member_info, group)
+            if actual_group is not None:
+                cls.coalescer.remove(actual_group, member_info)
 
         # Finally, delete the member entry entirely.
         logger.info('Removing deleted user %s (%s), who had DN "%s"'
                     % (member_info[0], member_info[1], dn)
         )
-        cursor.execute('''
-            DELETE
-              FROM members
-             WHERE dn = ?
-        ''', (dn,))
+        cls.index.remove_member(dn)
 
-        # All done!
+        # All done!  Write out our changes.
+        cls.index.flush(cls.membership_cursor(cursor))
+        cls.membership_commit()
 
 
     @classmethod
@@ -367,13 +397,14 @@ class LDAPCallback(BaseCallback):
 
         :return: None - any returned value is ignored.
 
-        At the start, in the refresh phase, we don't do anything.
+        In the refresh phase, the record is removed from the refresh builder.
         Later on, we do stuff!
         """
         logger.debug('Deleting record %s' % dn)
         cls.records_count_lock.acquire()
         cls.records_deleted = cls.records_deleted + 1
         cls.records_count_lock.release()
+        cls.builder.delete(dn, cls.membership_cursor(cursor))
 
 
     @classmethod
@@ -388,23 +419,12 @@ class LDAPCallback(BaseCallback):
 
         Since we track the DN in our database, we need to update it!
         """
-        # Start by getting the unique ID and username for this user.
-        cursor.execute('''
-            SELECT uniqueid
-              FROM members
-             WHERE dn = ?
-        ''', (old_dn,))
-        member_info = cursor.fetchone()
-        if (member_info is None):
-            logger.error('Trying to change nonexistant DN "%s"' % dn)
+        # Update the DN in the index, which also checks that it exists.
+        if cls.index.rename_member(old_dn, new_dn) is False:
+            logger.error('Trying to change nonexistant DN "%s"' % old_dn)
             return
-
-        # Update the DN in the DB.
-        cursor.execute('''
-            UPDATE members
-               SET dn = ?
-             WHERE uniqueid = ?
-        ''', (new_dn, member_info[0]))
+        cls.index.flush(cls.membership_cursor(cursor))
+        cls.membership_commit()
 
         # Let Syncrepl handle the transaction.
         # No stats tracking; the change callback will handle that!
@@ -420,11 +440,11 @@ class LDAPCallback(BaseCallback):
 
         :return: None - any returned value is ignored.
 
-        At the start, in the refresh phase, we don't do anything.
+        In the refresh phase, the refresh builder is told about the new DN.
         Later on, we do stuff!
         """
         # No stats tracking; the change callback will handle that!
-        pass
+        cls.builder.rename(old_dn, new_dn, cls.membership_cursor(cursor))
 
 
     @classmethod
@@ -446,12 +466,7 @@ class LDAPCallback(BaseCallback):
 
         # Get the user's _current_ user information.
         # (It might change in a moment, though...)
-        cursor.execute('''
-            SELECT uniqueid, username
-              FROM members
-             WHERE dn = ?
-        ''', (dn,))
-        unique_username = cursor.fetchone()
+        unique_username = cls.index.lookup_dn(dn)
         if (unique_username is None):
             logger.error('Trying to change nonexistant DN "%s"' % dn)
             return
@@ -478,31 +493,31 @@ class LDAPCallback(BaseCallback):
             # (Our method handles decoding, and creating the group.)
             # (It also does logging!)
             actual_group = add_user_to_group(
-                cursor,
+                cls.index,
                 unique_username,
                 added_group,
-                cls.groups_encoding
+                cls.group_names
             )
             if actual_group is not None:
-                # TODO: Send message.
-                pass
+                cls.coalescer.add(actual_group, unique_username)
 
         # Remove groups
         for removed_group in old_groups - new_groups:
             actual_group = remove_user_from_group(
-                cursor,
+                cls.index,
                 unique_username,
                 removed_group,
-                cls.groups_encoding
+                cls.group_names
             )
             if actual_group is not None:
-                # TODO: Send message.
-                pass
-        
+                cls.coalescer.remove(actual_group, unique_username)
+
         # Now that groups are in sync, check for a username or unique ID change.
         # TODO: See above.
 
-        # All done!
+        # All done!  Write out our changes.
+        cls.index.flush(cls.membership_cursor(cursor))
+        cls.membership_commit()
 
 
     @classmethod
@@ -517,10 +532,12 @@ class LDAPCallback(BaseCallback):
         :param new_attrs: The new attributes.
         :type new_attrs: Dict of lists of bytes
 
-        At the start, in the refresh phase, we don't do anything.
+        In the refresh phase, the new record replaces the old one in the
+        refresh builder.
         Later on, we do stuff!
         """
         logger.debug('Record %s modified' % dn)
         cls.records_count_lock.acquire()
         cls.records_modified = cls.records_modified + 1
         cls.records_count_lock.release()
+        cls.builder.add(dn, new_attrs, cls.membership_cursor(cursor))
@@ -0,0 +1,204 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP change coalescing.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# In the persist phase, every membership change would normally become its own
+# row in the changes queue.  When a lot of people are moved around at once,
+# the same groups are touched over and over in a few seconds, so instead we
+# hold each group's changes for a short window, and then send one REMOVE and
+# one ADD for the group, with everyone in them.  If someone is added and then
+# removed (or removed and then added) inside the window, nothing is sent for
+# them at all.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import threading
+import time
+
+
+class ChangeCoalescer(object):
+    """Merge membership changes for each group over a time window.
+
+    :param float window: The number of seconds to hold a group's changes,
+    counted from the first change.  If zero, changes are sent on the next
+    call to :meth:`flush`.
+
+    :param send: The function used to send changes.  It is called with an
+    action ("ADD" or "REMOVE") and a list of (group name, member list) tuples.
+    :type send: Callable
+
+    Members are (unique ID, username) tuples.  A change of username is a
+    remove of one tuple and an add of another, so it is never cancelled out.
+
+    Changes are recorded by the Syncrepl client thread, and sent by the thread
+    running :meth:`run`.
+    """
+
+    def __init__(self, window, send):
+        self.window = window
+        self.send = send
+
+        # Maps group name to a [first change time, adds, removes] list.  Adds
+        # and removes are dicts, keyed by member tuple, so each member can
+        # only be in one of them.
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+        # Counters for metrics.
+        self.changes_received = 0
+        self.changes_cancelled = 0
+        self.rows_sent = 0
+
+
+    def add(self, group_name, member):
+        """Record that a member was added to a group.
+
+        :param str group_name: The name of the group.
+
+        :param tuple member: A tuple containing unique ID and username.
+
+        :returns: None.
+        """
+        self._record(group_name, member, 1, 2)
+
+
+    def remove(self, group_name, member):
+        """Record that a member was removed from a group.
+
+        :param str group_name: The name of the group.
+
+        :param tuple member: A tuple containing unique ID and username.
+
+        :returns: None.
+        """
+        self._record(group_name, member, 2, 1)
+
+
+    def _record(self, group_name, member, slot, opposite_slot):
+        # slot is where this change goes in the pending list, and
+        # opposite_slot is where the change which would cancel it lives.
+        with self.lock:
+            self.changes_received = self.changes_received + 1
+            group_pending = self.pending.get(group_name)
+            if group_pending is None:
+                group_pending = [time.monotonic(), dict(), dict()]
+                self.pending[group_name] = group_pending
+            if member in group_pending[opposite_slot]:
+                logger.debug('Change for %s in group %s cancelled out.'
+                             % (member[0], group_name)
+                )
+                del group_pending[opposite_slot][member]
+                self.changes_cancelled = self.changes_cancelled + 2
+            else:
+                group_pending[slot][member] = None
+
+
+    def flush(self, everything=False):
+        """Send the changes for groups whose window has passed.
+
+        :param bool everything: If True, send every group's changes now.
+
+        :returns: The number of groups sent.
+
+        If sending fails, the changes are put back, to be tried again on the
+        next flush, and the exception is raised.
+        """
+        # Take the groups which are ready, so the lock isn't held while
+        # sending.
+        cutoff = time.monotonic() - self.window
+        with self.lock:
+            if everything is True:
+                ready = self.pending
+                self.pending = dict()
+            else:
+                ready = dict()
+                for group_name in list(self.pending):
+                    if self.pending[group_name][0] <= cutoff:
+                        ready[group_name] = self.pending.pop(group_name)
+        if len(ready) == 0:
+            return 0
+
+        # Removes go first, so a change of username is sent in the right
+        # order.  Groups where everything cancelled out are skipped.
+        removes = list()
+        adds = list()
+        for group_name in sorted(ready):
+            (_, group_adds, group_removes) = ready[group_name]
+            if len(group_removes) > 0:
+                removes.append((group_name, list(group_removes)))
+            if len(group_adds) > 0:
+                adds.append((group_name, list(group_adds)))
+
+        try:
+            if len(removes) > 0:
+                self.send('REMOVE', removes)
+            if len(adds) > 0:
+                self.send('ADD', adds)
+        except Exception:
+            self._requeue(ready)
+            raise
+
+        with self.lock:
+            self.rows_sent = self.rows_sent + len(removes) + len(adds)
+        return len(ready)
+
+
+    def _requeue(self, ready):
+        # Put back changes which could not be sent.  They happened before
+        # anything now pending, so they are replayed first.
+        with self.lock:
+            newer = self.pending
+            self.pending = ready
+            for group_name in newer:
+                (first_time, group_adds, group_removes) = newer[group_name]
+                older = self.pending.get(group_name)
+                if older is None:
+                    self.pending[group_name] = newer[group_name]
+                    continue
+                for member in group_removes:
+                    if member in older[1]:
+                        del older[1][member]
+                    else:
+                        older[2][member] = None
+                for member in group_adds:
+                    if member in older[2]:
+                        del older[2][member]
+                    else:
+                        older[1][member] = None
+
+
+    def run(self, finish_event):
+        """Send changes as their windows pass, until told to finish.
+
+        :param threading.Event finish_event: When set, everything left is
+        sent, and we return.
+
+        :returns: None.
+        """
+        interval = min(max(self.window / 4, 0.1), 1.0)
+        while not finish_event.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Unable to send coalesced changes: %s' % e)
+            finish_event.wait(interval)
+
+        logger.debug('Coalescer sending remaining changes.')
+        try:
+            self.flush(everything=True)
+        except Exception as e:
+            logger.critical('Unable to send final coalesced changes for %d '
+                            'groups: %s' % (len(self.pending), e)
+            )
+        logger.info('Coalescer received %d changes, cancelled %d, and sent '
+                    '%d rows.'
+                    % (self.changes_received, self.changes_cancelled,
+                       self.rows_sent)
+        )
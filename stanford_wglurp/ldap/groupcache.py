@@ -0,0 +1,91 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP group name cache.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# Every entry lists its groups as raw bytes, and a directory has far fewer
+# groups than it has memberships.  Without a cache, every membership decodes
+# its group name into a brand new string, and every set in the membership
+# index holds its own copy.  The GroupNameCache decodes each group name once,
+# and hands out the same (interned) string every time after that.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+from collections import OrderedDict
+import sys
+
+from .support import decode_group_name
+
+
+class GroupNameCache(object):
+    """A bounded cache of decoded group names.
+
+    :param int size: The maximum number of group names to keep.
+
+    :param str encoding: The encoding of the group names.
+
+    The least-recently-used name is dropped once the cache is full.  The
+    `hits` and `misses` counters are kept for metrics.
+
+    .. note::
+
+        Only the Syncrepl client thread may use this, though other threads
+        may read the counters.
+    """
+
+    def __init__(self, size, encoding):
+        self.size = size
+        self.encoding = encoding
+        self.names = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def decode(self, group_name, user_tuple):
+        """Decode a group name.
+
+        :param bytes group_name: The name of the group.
+
+        :param tuple user_tuple: A tuple containing unique ID and username.
+
+        :returns: The group name, as a string, or None.
+
+        The user tuple is only used for logging, if the decode fails.  Names
+        which fail to decode are not cached, so every failure is logged.
+        """
+        try:
+            decoded_name = self.names[group_name]
+        except KeyError:
+            pass
+        else:
+            self.hits = self.hits + 1
+            self.names.move_to_end(group_name)
+            return decoded_name
+
+        self.misses = self.misses + 1
+        decoded_name = decode_group_name(group_name, self.encoding, user_tuple)
+        if decoded_name is None:
+            return None
+
+        decoded_name = sys.intern(decoded_name)
+        self.names[group_name] = decoded_name
+        if len(self.names) > self.size:
+            self.names.popitem(last=False)
+        return decoded_name
+
+
+    def hit_rate(self):
+        """Get the fraction of lookups which were found in the cache.
+
+        :returns: A float between 0 and 1.
+        """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
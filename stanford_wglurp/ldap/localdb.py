@@ -0,0 +1,333 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP local database schema.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# The LDAP client keeps its own view of workgroup membership in sqlite.  The
+# layout of those tables is versioned, using sqlite's `user_version` pragma, so
+# that an existing database can be upgraded in place when the layout changes.
+#
+# Version 0 is the original layout: Workgroups and members were keyed by name
+# and unique ID, and the mapping table had no indexes at all.
+#
+# Version 1 gives groups and members integer surrogate IDs, makes the mapping
+# table a WITHOUT ROWID table keyed by (group, member) with a covering index in
+# the other direction, and keeps a count of members in each group.
+#
+# Normally, the tables live in Syncrepl's own database, and are committed along
+# with it after every callback.  The MembershipDB class supports keeping them
+# in a separate database instead, either on disk in WAL mode, or in memory with
+# periodic checkpoints to disk.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import os
+import sqlite3
+from sys import exit
+import threading
+import time
+
+from .support import get_state, set_state
+
+
+# The schema version that this code uses.
+SCHEMA_VERSION = 1
+
+# The current schema.
+# NOTE: This must not contain any transaction statements, because it is also
+# used as part of the migrations.
+SCHEMA = '''
+    CREATE TABLE workgroups (
+        id           INTEGER      PRIMARY KEY,
+        name         VARCHAR(128) NOT NULL UNIQUE,
+        member_count INTEGER      NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE members (
+        id       INTEGER      PRIMARY KEY,
+        dn       TEXT         NOT NULL UNIQUE,
+        uniqueid VARCHAR(128) NOT NULL UNIQUE,
+        username VARCHAR(128) NOT NULL UNIQUE
+    );
+
+    CREATE TABLE workgroup_members (
+        workgroup_id INTEGER NOT NULL REFERENCES workgroups (id),
+        member_id    INTEGER NOT NULL REFERENCES members (id),
+        PRIMARY KEY (workgroup_id, member_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX workgroup_members_member_idx
+        ON workgroup_members (member_id, workgroup_id);
+
+    CREATE TABLE IF NOT EXISTS wglurp_state (
+        name  VARCHAR(128) PRIMARY KEY,
+        value TEXT
+    );
+'''
+
+# The migration from version 0.
+# The old tables are renamed out of the way, the new tables are created, and
+# the data is copied across.  The old mapping table allowed duplicate rows, so
+# we have to de-duplicate as we go.
+MIGRATE_FROM_0 = '''
+    ALTER TABLE workgroups RENAME TO workgroups_v0;
+    ALTER TABLE members RENAME TO members_v0;
+    ALTER TABLE workgroup_members RENAME TO workgroup_members_v0;
+
+    %s
+
+    INSERT INTO members (dn, uniqueid, username)
+    SELECT dn, uniqueid, username
+      FROM members_v0
+     WHERE uniqueid IS NOT NULL
+       AND username IS NOT NULL;
+
+    INSERT INTO workgroups (name)
+    SELECT name
+      FROM workgroups_v0
+     ORDER BY name;
+
+    INSERT INTO workgroup_members (workgroup_id, member_id)
+        SELECT DISTINCT workgroups.id, members.id
+          FROM workgroup_members_v0
+    INNER JOIN workgroups
+            ON workgroups.name = workgroup_members_v0.workgroup_name
+    INNER JOIN members
+            ON members.uniqueid = workgroup_members_v0.member_id
+      ORDER BY 1, 2;
+
+    UPDATE workgroups
+       SET member_count = (
+        SELECT COUNT(*)
+          FROM workgroup_members
+         WHERE workgroup_members.workgroup_id = workgroups.id
+    );
+
+    DROP TABLE workgroup_members_v0;
+    DROP TABLE workgroups_v0;
+    DROP TABLE members_v0;
+''' % SCHEMA
+
+
+def prepare_schema(cursor):
+    """Create or upgrade the local membership tables.
+
+    :param cursor: An active sqlite3 cursor.
+    :type cursor: sqlite3.Cursor
+
+    :returns: None.
+
+    If the tables do not exist, they are created.  If they exist in an older
+    layout, they are migrated.  Each of those happens in its own transaction.
+
+    If the tables are from a newer version of the software, we exit.
+    """
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0]
+
+    if version == SCHEMA_VERSION:
+        logger.debug('Local schema is at version %d.' % version)
+        return
+    elif version > SCHEMA_VERSION:
+        logger.critical('The local database has schema version %d, but we '
+                        'only know up to version %d.'
+                        % (version, SCHEMA_VERSION)
+        )
+        logger.critical('Was a newer version of this software run?')
+        exit(1)
+
+    # Version 0 could be either an empty database, or the original layout.
+    cursor.execute('''
+        SELECT COUNT(*)
+          FROM sqlite_master
+         WHERE type = 'table'
+           AND name = 'workgroups'
+    ''')
+    if cursor.fetchone()[0] == 0:
+        logger.info('Creating local schema version %d.' % SCHEMA_VERSION)
+        script = SCHEMA
+    else:
+        logger.warning('Migrating local schema from version %d to %d.'
+                       % (version, SCHEMA_VERSION)
+        )
+        script = MIGRATE_FROM_0
+
+    # executescript commits anything outstanding before it starts.  We put the
+    # whole thing (including the version change) into one transaction.
+    cursor.executescript('BEGIN; %s PRAGMA user_version = %d; COMMIT;'
+                         % (script, SCHEMA_VERSION)
+    )
+    logger.info('Local schema is now at version %d.' % SCHEMA_VERSION)
+
+
+class MembershipDB(object):
+    """A membership database, separate from Syncrepl's database.
+
+    :param str mode: Either "wal" or "memory".
+
+    :param str path: The path to the on-disk database.
+
+    :param int checkpoint_interval: In "memory" mode, the minimum number of
+    seconds between checkpoints.
+
+    In "wal" mode, the database is opened in write-ahead-log mode, with
+    `synchronous` set to NORMAL, so that commits do not wait for the disk.
+
+    In "memory" mode, the on-disk database is copied into memory when opened.
+    After a commit, if the checkpoint interval has passed, the in-memory
+    database is copied back to disk, using the sqlite backup API.  It is also
+    copied back when closed.  So that the Syncrepl client thread isn't held
+    up, it only makes a quick copy in memory; a separate thread writes that
+    copy to disk.
+
+    Either way, we are no longer committing together with Syncrepl, so we
+    can't be sure our tables match Syncrepl's view after a crash.  So, we
+    record when we are running, and when we shut down cleanly.  If we open a
+    database which was not shut down cleanly, its snapshot is marked as
+    unknown, and the end of the refresh phase will SYNC every group.
+
+    .. note::
+
+        Only the Syncrepl client thread may use this while it is running.
+    """
+
+    def __init__(self, mode, path, checkpoint_interval):
+        self.mode = mode
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.next_checkpoint = None
+        self.checkpoint_thread = None
+
+        logger.info('Opening %s-mode membership database at "%s"'
+                    % (mode, path)
+        )
+        if mode == 'wal':
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('PRAGMA synchronous = NORMAL')
+        else:
+            self.connection = sqlite3.connect(':memory:',
+                                              check_same_thread=False)
+            if os.path.exists(path):
+                logger.debug('Loading membership checkpoint into memory.')
+                disk_connection = sqlite3.connect(path)
+                disk_connection.backup(self.connection)
+                disk_connection.close()
+        self.cursor = self.connection.cursor()
+
+        # Make sure the schema is current.
+        prepare_schema(self.cursor)
+
+        # Check how we were last shut down, and then mark us as running.
+        if get_state(self.cursor, 'shutdown') not in (None, 'clean'):
+            logger.warning('The membership database was not shut down '
+                           'cleanly.  All groups will be synced.'
+            )
+            set_state(self.cursor, 'snapshot', 'unknown')
+        set_state(self.cursor, 'shutdown', 'running')
+        self.connection.commit()
+
+        # In memory mode, the on-disk copy needs to know we're running, too.
+        if mode == 'memory':
+            self.checkpoint()
+
+
+    def commit(self):
+        """Commit our changes, and checkpoint if it is time.
+
+        :returns: None.
+        """
+        self.connection.commit()
+        if self.mode == 'memory' and time.time() >= self.next_checkpoint:
+            # If the last checkpoint is still being written, try again at
+            # the next commit.
+            if (self.checkpoint_thread is not None
+                and self.checkpoint_thread.is_alive()
+            ):
+                logger.debug('Last checkpoint is still being written.')
+                return
+            self.checkpoint(wait=False)
+
+
+    def checkpoint(self, wait=True):
+        """Copy the in-memory database to disk.
+
+        :param bool wait: If False, return once the database has been copied
+        in memory, and write the copy to disk from a separate thread.
+
+        :returns: None.
+
+        The copy is made to a temporary file, which is synced and then renamed
+        into place, so the on-disk copy is always complete.
+        """
+        logger.debug('Checkpointing membership database to "%s"' % self.path)
+        if self.checkpoint_thread is not None:
+            self.checkpoint_thread.join()
+            self.checkpoint_thread = None
+
+        # Copying in memory is quick, and gives the writer a copy which won't
+        # change under it.
+        snapshot = sqlite3.connect(':memory:', check_same_thread=False)
+        self.connection.backup(snapshot)
+        self.next_checkpoint = time.time() + self.checkpoint_interval
+
+        if wait is True:
+            self._write_checkpoint(snapshot)
+        else:
+            self.checkpoint_thread = threading.Thread(
+                name='Membership checkpoint',
+                target=self._background_checkpoint,
+                daemon=True,
+                args=(snapshot,)
+            )
+            self.checkpoint_thread.start()
+
+
+    def _write_checkpoint(self, snapshot):
+        # Write an in-memory copy of the database to disk, and close it.
+        temporary_path = self.path + '.tmp'
+        try:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+            disk_connection = sqlite3.connect(temporary_path)
+            snapshot.backup(disk_connection)
+            disk_connection.close()
+            with open(temporary_path, 'rb') as temporary_file:
+                os.fsync(temporary_file.fileno())
+            os.replace(temporary_path, self.path)
+        finally:
+            snapshot.close()
+        logger.debug('Checkpoint complete.')
+
+
+    def _background_checkpoint(self, snapshot):
+        # Run by the checkpoint thread, where there's nobody to raise to.
+        try:
+            self._write_checkpoint(snapshot)
+        except Exception as e:
+            logger.error('Unable to checkpoint the membership database: %s'
+                         % e
+            )
+
+
+    def close(self):
+        """Mark a clean shutdown, and close the database.
+
+        :returns: None.
+
+        In memory mode, this does a final checkpoint.
+        """
+        logger.info('Closing membership database.')
+        set_state(self.cursor, 'shutdown', 'clean')
+        self.connection.commit()
+        if self.mode == 'memory':
+            self.checkpoint()
+        self.cursor.close()
+        self.connection.close()
@@ -0,0 +1,349 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP membership index.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# In the persist phase, every LDAP modify needs to know who a DN is, which
+# groups they are in, and how many people are in a group.  Asking sqlite for
+# each of those is slow, so we keep the answers in memory.  sqlite is still
+# our durable store, but it is only written to: changes are queued up as they
+# are made, and written out in bulk when the callback is done.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import sys
+
+
+class MembershipIndex(object):
+    """An in-memory index of workgroup membership.
+
+    The index has the following mappings:
+
+    * `dns`: DN to unique ID.
+
+    * `members`: Unique ID to (username, DN) tuple.
+
+    * `usernames`: Username to unique ID.
+
+    * `member_groups`: Unique ID to the set of group names.
+
+    * `groups`: Group name to the set of member unique IDs.
+
+    It also tracks the database's integer IDs for members (`member_ids`) and
+    groups (`group_ids`).  We are the only writer, so new IDs are allocated
+    here, instead of asking the database for them.
+
+    All reads come from the index.  All writes update the index immediately,
+    and queue the matching sqlite statement, to be run by :meth:`flush`.
+    """
+
+    def __init__(self):
+        self.dns = dict()
+        self.members = dict()
+        self.usernames = dict()
+        self.member_groups = dict()
+        self.groups = dict()
+
+        # Database IDs, and the next IDs to use.
+        self.member_ids = dict()
+        self.group_ids = dict()
+        self.next_member_id = 1
+        self.next_group_id = 1
+
+        # The queue of (statement, parameters) tuples waiting to be written.
+        self.pending = list()
+
+        # Groups whose member count needs to be written.
+        self.counts_changed = set()
+
+
+    def load(self, cursor):
+        """Load the index from the database.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: None.
+
+        Anything already in the index is discarded.
+        """
+        self.__init__()
+
+        # These map database IDs back to names, for reading the mapping table.
+        uniqueid_by_id = dict()
+        group_name_by_id = dict()
+
+        cursor.execute('''
+            SELECT id, dn, uniqueid, username
+              FROM members
+        ''')
+        for (member_id, dn, uniqueid, username) in cursor:
+            self.dns[dn] = uniqueid
+            self.members[uniqueid] = (username, dn)
+            self.usernames[username] = uniqueid
+            self.member_groups[uniqueid] = set()
+            self.member_ids[uniqueid] = member_id
+            uniqueid_by_id[member_id] = uniqueid
+            self.next_member_id = max(self.next_member_id, member_id + 1)
+
+        cursor.execute('''
+            SELECT id, name
+              FROM workgroups
+        ''')
+        for (group_id, group_name) in cursor:
+            # Intern the name, so it's shared with the group name cache.
+            group_name = sys.intern(group_name)
+            self.groups[group_name] = set()
+            self.group_ids[group_name] = group_id
+            group_name_by_id[group_id] = group_name
+            self.next_group_id = max(self.next_group_id, group_id + 1)
+
+        cursor.execute('''
+            SELECT workgroup_id, member_id
+              FROM workgroup_members
+        ''')
+        for (group_id, member_id) in cursor:
+            group_name = group_name_by_id[group_id]
+            uniqueid = uniqueid_by_id[member_id]
+            self.groups[group_name].add(uniqueid)
+            self.member_groups[uniqueid].add(group_name)
+
+        logger.info('Membership index loaded with %d members and %d groups.'
+                    % (len(self.members), len(self.groups))
+        )
+
+
+    def lookup_dn(self, dn):
+        """Look up a member by DN.
+
+        :param str dn: The DN to look up.
+
+        :returns: A tuple containing unique ID and username, or None.
+        """
+        uniqueid = self.dns.get(dn)
+        if uniqueid is None:
+            return None
+        return (uniqueid, self.members[uniqueid][0])
+
+
+    def groups_of(self, uniqueid):
+        """Get the groups a member is in.
+
+        :param str uniqueid: The member's unique ID.
+
+        :returns: A set of group names, which must not be modified.
+        """
+        return self.member_groups.get(uniqueid, frozenset())
+
+
+    def group_size(self, group_name):
+        """Get the number of members in a group.
+
+        :param str group_name: The name of the group.
+
+        :returns: The number of members, which is zero for unknown groups.
+        """
+        return len(self.groups.get(group_name, ()))
+
+
+    def add_member(self, dn, uniqueid, username):
+        """Add a new member.
+
+        :param str dn: The member's DN.
+
+        :param str uniqueid: The member's unique ID.
+
+        :param str username: The member's username.
+
+        :returns: True if the member was added, or False if the DN, unique ID,
+        or username is already in use.
+        """
+        if (dn in self.dns or uniqueid in self.members
+            or username in self.usernames
+        ):
+            return False
+
+        member_id = self.next_member_id
+        self.next_member_id = member_id + 1
+
+        self.dns[dn] = uniqueid
+        self.members[uniqueid] = (username, dn)
+        self.usernames[username] = uniqueid
+        self.member_groups[uniqueid] = set()
+        self.member_ids[uniqueid] = member_id
+        self.pending.append(('''
+            INSERT
+              INTO members
+                   (id, dn, uniqueid, username)
+            VALUES (?, ?, ?, ?)
+        ''', (member_id, dn, uniqueid, username)))
+        return True
+
+
+    def remove_member(self, dn):
+        """Remove a member, who must not be in any groups.
+
+        :param str dn: The member's DN.
+
+        :returns: None.
+        """
+        uniqueid = self.dns.pop(dn)
+        (username, _) = self.members.pop(uniqueid)
+        del self.usernames[username]
+        del self.member_groups[uniqueid]
+        self.pending.append(('''
+            DELETE
+              FROM members
+             WHERE id = ?
+        ''', (self.member_ids.pop(uniqueid),)))
+
+
+    def rename_member(self, old_dn, new_dn):
+        """Change a member's DN.
+
+        :param str old_dn: The old DN.
+
+        :param str new_dn: The new DN.
+
+        :returns: True if the DN was changed, or False if the old DN is
+        unknown.
+        """
+        uniqueid = self.dns.pop(old_dn, None)
+        if uniqueid is None:
+            return False
+
+        self.dns[new_dn] = uniqueid
+        self.members[uniqueid] = (self.members[uniqueid][0], new_dn)
+        self.pending.append(('''
+            UPDATE members
+               SET dn = ?
+             WHERE id = ?
+        ''', (new_dn, self.member_ids[uniqueid])))
+        return True
+
+
+    def add_to_group(self, uniqueid, group_name):
+        """Add a member to a group, creating the group if needed.
+
+        :param str uniqueid: The member's unique ID.
+
+        :param str group_name: The name of the group.
+
+        :returns: True if the member was added, or False if they were already
+        in the group.
+        """
+        group_members = self.groups.get(group_name)
+        if group_members is None:
+            logger.info('Discovered group %s' % group_name)
+            group_members = self.groups[group_name] = set()
+            group_id = self.group_ids[group_name] = self.next_group_id
+            self.next_group_id = group_id + 1
+            self.pending.append(('''
+                INSERT
+                  INTO workgroups
+                       (id, name)
+                VALUES (?, ?)
+            ''', (group_id, group_name)))
+        elif uniqueid in group_members:
+            return False
+
+        group_members.add(uniqueid)
+        self.member_groups[uniqueid].add(group_name)
+        self.counts_changed.add(group_name)
+        self.pending.append(('''
+            INSERT
+              INTO workgroup_members
+                   (workgroup_id, member_id)
+            VALUES (?, ?)
+        ''', (self.group_ids[group_name], self.member_ids[uniqueid])))
+        return True
+
+
+    def remove_from_group(self, uniqueid, group_name):
+        """Remove a member from a group, deleting the group if it is empty.
+
+        :param str uniqueid: The member's unique ID.
+
+        :param str group_name: The name of the group.
+
+        :returns: True if the member was removed, or False if they were not in
+        the group.
+        """
+        group_members = self.groups.get(group_name)
+        if group_members is None or uniqueid not in group_members:
+            return False
+
+        group_members.discard(uniqueid)
+        self.member_groups[uniqueid].discard(group_name)
+        self.counts_changed.add(group_name)
+        self.pending.append(('''
+            DELETE
+              FROM workgroup_members
+             WHERE workgroup_id = ?
+               AND member_id = ?
+        ''', (self.group_ids[group_name], self.member_ids[uniqueid])))
+
+        # Is the group empty now?  If yes, then delete it.
+        if len(group_members) == 0:
+            logger.info('Group %s is now empty.' % group_name)
+            del self.groups[group_name]
+            self.counts_changed.discard(group_name)
+            self.pending.append(('''
+                DELETE
+                  FROM workgroups
+                 WHERE id = ?
+            ''', (self.group_ids.pop(group_name),)))
+        return True
+
+
+    def flush(self, cursor):
+        """Write queued changes to the database.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: The number of statements run.
+
+        Runs of the same statement are written with a single executemany.
+        Member counts are written last, once for each group that changed.
+
+        .. note::
+
+            This code does database operations, but transaction management is
+            left to the caller.
+        """
+        pending = self.pending
+        self.pending = list()
+
+        # Each group that changed gets one count update, at the end.
+        if len(self.counts_changed) > 0:
+            count_update = '''
+                UPDATE workgroups
+                   SET member_count = ?
+                 WHERE id = ?
+            '''
+            pending.extend(
+                (count_update, (len(self.groups[group_name]),
+                                self.group_ids[group_name]))
+                for group_name in self.counts_changed
+            )
+            self.counts_changed = set()
+
+        start = 0
+        while start < len(pending):
+            statement = pending[start][0]
+            end = start + 1
+            while end < len(pending) and pending[end][0] is statement:
+                end = end + 1
+            cursor.executemany(statement,
+                [parameters for (_, parameters) in pending[start:end]]
+            )
+            start = end
+
+        return len(pending)
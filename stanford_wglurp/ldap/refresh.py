@@ -0,0 +1,451 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP refresh builder.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# During the refresh phase, we rebuild our local view of workgroup
+# membership.  Doing that one record at a time (the way the persist-phase
+# callbacks work) means several sqlite round trips for every membership, which
+# is far too slow for a full directory.  Instead, the RefreshBuilder decodes
+# entries as they arrive from the server, and writes them to staging tables:
+# each entry as it arrives, and its memberships in batches.  At the end of the
+# refresh phase, the entries we weren't told about (because they haven't
+# changed since our last run) are filled in.
+#
+# Everything we know about the staged entries lives in the staging tables,
+# which also catch duplicate DNs, unique IDs, and usernames.  So, we never
+# hold a decoded copy of the directory in memory.
+#
+# The new view is loaded into temporary staging tables, so that it can be
+# compared with the view we had at the end of our last run.  That way, a
+# restart only sends out the changes that happened while we were away, instead
+# of sending a SYNC for every group.
+
+# We have to load the logger first!
+from ..logging import logger
+
+import sqlite3
+
+from .support import decode_user, iterate_groups
+
+
+class RefreshBuilder(object):
+    """Build the local membership tables in bulk.
+
+    :param callback: The callback class, which holds our attribute names and
+    encodings.
+
+    :param int batch_size: The number of entries to decode before writing
+    their memberships to the staging tables.
+
+    Call :meth:`start` when the refresh phase begins, and then :meth:`add`,
+    :meth:`delete`, and :meth:`rename` as entries arrive.  At the end of the
+    refresh phase, call :meth:`finish`.  Then, :meth:`compare` works out what
+    changed, :meth:`replace` makes the staged view current, and
+    :meth:`changes` walks the differences.
+    """
+
+    def __init__(self, callback, batch_size=1000):
+        self.attributes = (callback.unique_attribute,
+                           callback.username_attribute)
+        self.encodings = (callback.unique_encoding,
+                          callback.username_encoding)
+        self.groups_attribute = callback.groups_attribute
+        self.group_names = callback.group_names
+        self.batch_size = batch_size
+
+        # Memberships waiting to be written to the staging tables, and the
+        # number of entries they came from.
+        self.memberships = list()
+        self.pending_count = 0
+
+        # DNs which we were given, but which could not be staged.
+        self.skipped = set()
+
+
+    def start(self, cursor):
+        """Create (or empty) the staging tables.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: None.
+
+        The staging tables are temporary tables, named like the real tables,
+        but with a `refresh_` prefix.  Memberships are staged by DN.
+        """
+        for statement in (
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS refresh_members (
+                dn       TEXT         PRIMARY KEY,
+                uniqueid VARCHAR(128) UNIQUE,
+                username VARCHAR(128) UNIQUE
+            )''',
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS refresh_workgroup_members (
+                dn             TEXT,
+                workgroup_name VARCHAR(128)
+            )''',
+            '''
+            CREATE INDEX IF NOT EXISTS temp.refresh_workgroup_members_dn_idx
+                ON refresh_workgroup_members (dn)
+            ''',
+            'DELETE FROM refresh_members',
+            'DELETE FROM refresh_workgroup_members',
+        ):
+            cursor.execute(statement)
+        self.memberships = list()
+        self.pending_count = 0
+        self.skipped = set()
+
+
+    def has(self, dn, cursor):
+        """Check if we have been given an entry.
+
+        :param str dn: The DN of the entry.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: True if the entry was given to :meth:`add`.
+        """
+        if dn in self.skipped:
+            return True
+        cursor.execute('''
+            SELECT 1
+              FROM refresh_members
+             WHERE dn = ?
+        ''', (dn,))
+        return (cursor.fetchone() is not None)
+
+
+    def add(self, dn, attrs, cursor):
+        """Add (or replace) a directory entry in the view.
+
+        :param str dn: The DN of the entry.
+
+        :param attrs: The entry's attributes.
+        :type attrs: Dict of lists of bytes
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: True if the entry was added, else False.
+        """
+        # If we already have this entry, this is a change, so remove it first.
+        if self.has(dn, cursor):
+            self.delete(dn, cursor)
+
+        # Decode the unique ID and username.  If that fails, it's logged.
+        unique_username = decode_user(dn, attrs,
+                                      self.attributes, self.encodings)
+        if unique_username is None:
+            self.skipped.add(dn)
+            return False
+        (uniqueid, username) = unique_username
+
+        # Unique IDs and usernames have to be unique, which the staging table
+        # checks for us.
+        try:
+            cursor.execute('''
+                INSERT
+                  INTO refresh_members
+                       (dn, uniqueid, username)
+                VALUES (?, ?, ?)
+            ''', (dn, uniqueid, username))
+        except sqlite3.IntegrityError:
+            logger.error('Duplicate unique ID/username "%s"/"%s" on DN "%s".  '
+                         'Skipping.' % (uniqueid, username, dn)
+            )
+            self.skipped.add(dn)
+            return False
+
+        # Our multivalued attribute is allowed to be missing/empty.
+        # We use a set, in case the server sends the same group twice.
+        groups = set()
+        for group in attrs.get(self.groups_attribute, ()):
+            group_name = self.group_names.decode(group, unique_username)
+            if group_name is not None:
+                groups.add(group_name)
+        if len(groups) == 0:
+            logger.warning('User ID %s (%s) has no groups.'
+                           % (uniqueid, username)
+            )
+        self.memberships.extend((dn, group) for group in groups)
+
+        # Write out a batch, if we have enough.
+        self.pending_count = self.pending_count + 1
+        if self.pending_count >= self.batch_size:
+            self.flush(cursor)
+        return True
+
+
+    def delete(self, dn, cursor):
+        """Remove a directory entry from the view.
+
+        :param str dn: The DN of the entry.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: None.
+        """
+        if dn in self.skipped:
+            self.skipped.discard(dn)
+            return
+
+        # The entry's memberships might not have been written yet, so write
+        # everything before deleting.
+        self.flush(cursor)
+        cursor.execute('''
+            DELETE
+              FROM refresh_members
+             WHERE dn = ?
+        ''', (dn,))
+        cursor.execute('''
+            DELETE
+              FROM refresh_workgroup_members
+             WHERE dn = ?
+        ''', (dn,))
+
+
+    def rename(self, old_dn, new_dn, cursor):
+        """Change the DN of a directory entry in the view.
+
+        :param str old_dn: The old DN.
+
+        :param str new_dn: The new DN.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: None.
+
+        Anything we already had at the new DN is replaced.
+        """
+        if self.has(new_dn, cursor):
+            self.delete(new_dn, cursor)
+
+        if old_dn in self.skipped:
+            self.skipped.discard(old_dn)
+            self.skipped.add(new_dn)
+            return
+
+        self.flush(cursor)
+        for table in ('refresh_members', 'refresh_workgroup_members'):
+            cursor.execute('''
+                UPDATE %s
+                   SET dn = ?
+                 WHERE dn = ?
+            ''' % table, (new_dn, old_dn))
+
+
+    def flush(self, cursor):
+        """Write waiting memberships to the staging tables.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: None.
+
+        .. note::
+
+            This code does database operations, but transaction management is
+            left to the caller.
+        """
+        cursor.executemany('''
+            INSERT
+              INTO refresh_workgroup_members
+                   (dn, workgroup_name)
+            VALUES (?, ?)
+        ''', self.memberships)
+        self.memberships = list()
+        self.pending_count = 0
+
+
+    def finish(self, items, cursor):
+        """Fill in the rest of the view, at the end of the refresh phase.
+
+        :param dict items: The items currently in the directory.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: The number of groups in the new view.
+
+        Any item which we were not given during the refresh phase (because it
+        has not changed since our last run) is added now.
+        """
+        filled_count = 0
+        for dn in items:
+            if not self.has(dn, cursor):
+                self.add(dn, items[dn], cursor)
+                filled_count = filled_count + 1
+        self.flush(cursor)
+        logger.info('%d entries were filled in at the end of the refresh.'
+                    % filled_count
+        )
+        self.skipped = set()
+
+        # Make the list of groups, for comparing.
+        cursor.execute('DROP TABLE IF EXISTS temp.refresh_workgroups')
+        cursor.execute('''
+            CREATE TEMP TABLE refresh_workgroups AS
+            SELECT DISTINCT workgroup_name AS name
+              FROM refresh_workgroup_members
+        ''')
+        cursor.execute('SELECT COUNT(*) FROM refresh_workgroups')
+        return cursor.fetchone()[0]
+
+
+    def compare(self, cursor, snapshot_known):
+        """Compare the staged view with the current tables.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :param bool snapshot_known: True if the current tables hold the view
+        from the end of our last run.
+
+        :returns: None.
+
+        This fills three temporary tables:
+
+        * `refresh_syncs` has the name of every group that needs a SYNC.  If
+          the snapshot is not known, that is every group.  Otherwise, it is
+          every group which is new since the snapshot.
+
+        * `refresh_adds` and `refresh_removes` have a (group name, unique ID,
+          username) row for every membership that was added or removed since
+          the snapshot, in groups which are not being SYNCed.
+
+        A change of username appears as a remove of the old name, plus an add
+        of the new name.  A group which no longer exists has all of its
+        members removed.
+        """
+        for table in ('refresh_syncs', 'refresh_adds', 'refresh_removes'):
+            cursor.execute('DROP TABLE IF EXISTS temp.%s' % table)
+
+        # Without a snapshot, SYNC everything and stop there.
+        if snapshot_known is False:
+            logger.info('No usable snapshot from our last run.  '
+                        'All groups will be synced.'
+            )
+            cursor.execute('''
+                CREATE TEMP TABLE refresh_syncs AS
+                SELECT name FROM refresh_workgroups
+            ''')
+            for table in ('refresh_adds', 'refresh_removes'):
+                cursor.execute('''
+                    CREATE TEMP TABLE %s (
+                        workgroup_name, uniqueid, username
+                    )
+                ''' % table)
+            return
+
+        # New groups get a SYNC.
+        cursor.execute('''
+            CREATE TEMP TABLE refresh_syncs AS
+            SELECT name FROM refresh_workgroups
+            EXCEPT
+            SELECT name FROM main.workgroups
+        ''')
+
+        # For everything else, work out the differences.
+        old_memberships = '''
+                SELECT workgroups.name AS workgroup_name,
+                       members.uniqueid AS uniqueid,
+                       members.username AS username
+                  FROM main.workgroup_members AS workgroup_members
+            INNER JOIN main.workgroups AS workgroups
+                    ON workgroups.id = workgroup_members.workgroup_id
+            INNER JOIN main.members AS members
+                    ON members.id = workgroup_members.member_id
+        '''
+        new_memberships = '''
+                SELECT refresh_workgroup_members.workgroup_name
+                           AS workgroup_name,
+                       refresh_members.uniqueid AS uniqueid,
+                       refresh_members.username AS username
+                  FROM refresh_workgroup_members
+            INNER JOIN refresh_members
+                    ON refresh_members.dn = refresh_workgroup_members.dn
+        '''
+        cursor.execute('''
+            CREATE TEMP TABLE refresh_adds AS
+            SELECT * FROM (%s
+                 WHERE refresh_workgroup_members.workgroup_name
+                       NOT IN (SELECT name FROM refresh_syncs)
+            )
+            EXCEPT
+            %s
+        ''' % (new_memberships, old_memberships))
+        cursor.execute('''
+            CREATE TEMP TABLE refresh_removes AS
+            %s
+            EXCEPT
+            %s
+        ''' % (old_memberships, new_memberships))
+
+
+    def replace(self, cursor):
+        """Replace the current tables with the staged view.
+
+        :param cursor: An active sqlite3 cursor.
+        :type cursor: sqlite3.Cursor
+
+        :returns: None.
+
+        .. note::
+
+            This code does database operations, but transaction management is
+            left to the caller.
+        """
+        for table in ('workgroup_members', 'workgroups', 'members'):
+            cursor.execute('DELETE FROM main.%s' % table)
+        cursor.execute('''
+            INSERT INTO main.members (dn, uniqueid, username)
+            SELECT dn, uniqueid, username FROM refresh_members
+        ''')
+        cursor.execute('''
+              INSERT INTO main.workgroups (name, member_count)
+              SELECT workgroup_name, COUNT(*)
+                FROM refresh_workgroup_members
+            GROUP BY workgroup_name
+        ''')
+        cursor.execute('''
+              INSERT INTO main.workgroup_members (workgroup_id, member_id)
+              SELECT workgroups.id, members.id
+                FROM refresh_workgroup_members
+          INNER JOIN main.workgroups AS workgroups
+                  ON workgroups.name = refresh_workgroup_members.workgroup_name
+          INNER JOIN main.members AS members
+                  ON members.dn = refresh_workgroup_members.dn
+            ORDER BY 1, 2
+        ''')
+        for table in ('refresh_workgroup_members', 'refresh_workgroups',
+                      'refresh_members'):
+            cursor.execute('DROP TABLE temp.%s' % table)
+
+
+    def changes(self, cursor, action):
+        """Walk the changes found by :meth:`compare`.
+
+        :param cursor: An sqlite3 cursor, which will be used only by us.
+        :type cursor: sqlite3.Cursor
+
+        :param str action: Either "ADD" or "REMOVE".
+
+        :returns: A generator of (group name, member list) tuples.
+        """
+        table = 'refresh_adds' if action == 'ADD' else 'refresh_removes'
+        cursor.execute('''
+              SELECT workgroup_name, uniqueid, username
+                FROM %s
+            ORDER BY workgroup_name
+        ''' % table)
+        return iterate_groups(cursor)
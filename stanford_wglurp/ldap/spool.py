@@ -0,0 +1,174 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP change spool.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# If the database is down (or just can't keep up), the change writer puts
+# changes into the spool instead.  The spool is a file of JSON lines, one
+# change per line, which is only ever appended to.  A second, small file holds
+# the offset of the first change which has not yet been written to the
+# database.  Once everything has been written, both are reset.
+#
+# A change is only added to the spool once it has been synced to disk, so a
+# spooled change survives a crash.  The offset is synced after the changes
+# before it are committed to the database, so a crash in between can cause
+# some changes to be written twice, but never lost.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import json
+import os
+
+
+class ChangeSpool(object):
+    """An append-only, on-disk spool of changes.
+
+    :param str path: The path to the spool file.  The offset file uses the
+    same path, with `.offset` added.
+
+    Each change is an (action, group name, member list) tuple.
+
+    .. note::
+
+        Only the change writer thread may use this.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.file = open(path, mode='a+b')
+
+        # Read our offset, if we have one.
+        try:
+            with open(self.offset_path, mode='r',
+                      encoding='ascii') as offset_file:
+                self.offset = int(offset_file.read())
+        except FileNotFoundError:
+            self.offset = 0
+
+        # Count how many changes are waiting.  If we crashed in the middle of
+        # an append, the last line could be incomplete, so throw it away.
+        self.file.seek(0)
+        self.size = 0
+        self.pending = 0
+        line_count = 0
+        for line in self.file:
+            if not line.endswith(b'\n'):
+                break
+            if self.size >= self.offset:
+                self.pending = self.pending + 1
+            self.size = self.size + len(line)
+            line_count = line_count + 1
+        if self.file.tell() > self.size:
+            logger.warning('Discarding incomplete change at the end of the '
+                           'spool.'
+            )
+            self.file.truncate(self.size)
+        if self.offset > self.size:
+            logger.warning('Spool offset %d is past the end of the spool.  '
+                           'Starting over.' % self.offset
+            )
+            self.offset = 0
+            self.pending = line_count
+        if self.pending > 0:
+            logger.warning('%d changes are waiting in the spool.'
+                           % self.pending
+            )
+
+        # Counters for metrics.
+        self.changes_spooled = 0
+        self.changes_replayed = 0
+
+
+    def is_empty(self):
+        """Check if there are changes waiting in the spool.
+
+        :returns: True if there are no changes waiting.
+        """
+        return (self.pending == 0)
+
+
+    def append(self, batch):
+        """Add changes to the end of the spool.
+
+        :param list batch: A list of (action, group name, member list) tuples.
+
+        :returns: None.
+
+        The changes are synced to disk before we return.
+        """
+        data = b''.join(
+            json.dumps(change).encode('utf-8') + b'\n'
+            for change in batch
+        )
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size = self.size + len(data)
+        self.pending = self.pending + len(batch)
+        self.changes_spooled = self.changes_spooled + len(batch)
+
+
+    def read(self, limit):
+        """Read changes from the front of the spool.
+
+        :param int limit: The maximum number of changes to read.
+
+        :returns: A tuple containing a list of (action, group name, member
+        list) tuples, and the offset to pass to :meth:`advance` once they have
+        been written.
+        """
+        self.file.seek(self.offset)
+        batch = list()
+        offset = self.offset
+        while len(batch) < limit and offset < self.size:
+            line = self.file.readline()
+            offset = offset + len(line)
+            batch.append(tuple(json.loads(line.decode('utf-8'))))
+        return (batch, offset)
+
+
+    def advance(self, offset, count):
+        """Mark changes at the front of the spool as written.
+
+        :param int offset: The offset returned by :meth:`read`.
+
+        :param int count: The number of changes which were written.
+
+        :returns: None.
+
+        If the spool is now empty, it is reset.
+        """
+        self.pending = self.pending - count
+        self.changes_replayed = self.changes_replayed + count
+        if offset >= self.size:
+            logger.info('Spool is empty; resetting.')
+            self.file.truncate(0)
+            self.size = 0
+            offset = 0
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.offset = offset
+
+        # Write the offset to a temporary file, and then rename it into place.
+        temporary_path = self.offset_path + '.tmp'
+        with open(temporary_path, mode='w', encoding='ascii') as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(temporary_path, self.offset_path)
+
+
+    def close(self):
+        """Close the spool.
+
+        :returns: None.
+        """
+        self.file.close()
@@ -17,19 +17,95 @@
 from ..logging import logger
 
 
-def add_user_to_group(cursor, user_tuple, group_name, encoding):
+def decode_user(dn, attrs, attributes, encodings):
+    """Decode the unique ID and username of an LDAP entry.
+
+    :param str dn: The DN of the entry.
+
+    :param attrs: The entry's attributes.
+    :type attrs: Dict of lists of bytes
+
+    :param tuple attributes: The unique ID and username attribute names.
+
+    :param tuple encodings: The unique ID and username attribute encodings.
+
+    :returns: A tuple containing unique ID and username, or None.
+
+    This method is a support method, used by the LDAP callbacks and by the
+    refresh builder.  It catches cases where attributes are missing,
+    undecodable, or multi-valued.  In those cases, the problem is logged, and
+    None is returned.
+    """
+    unique_username = list()
+    for (attribute_name, attribute_encoding) in zip(attributes, encodings):
+        # In one operation, we access the attribute list (can throw
+        # KeyError), access the first item (can throw IndexError), and
+        # decode it (can throw UnicodeError).  Saves us alot of checks!
+        try:
+            attribute_value_list = attrs[attribute_name]
+            unique_username.append(
+                attribute_value_list[0].decode(attribute_encoding)
+            )
+        except (KeyError, IndexError):
+            logger.warning('Entry "%s" is missing the required '
+                           '\'%s\' attribute!' % (dn, attribute_name)
+            )
+            return None
+        except UnicodeError as e:
+            logger.warning('Error %s decoding the \'%s\' of entry "%s": %s'
+                           % (attribute_encoding, attribute_name,
+                              dn, str(e)
+                             )
+            )
+            return None
+        # Finally, catch if the attribute is multi-valued.
+        if len(attribute_value_list) > 1:
+            logger.error('Entry "%s" has a multi-valued '
+                         '\'%s\' attribute!' % (dn, attribute_name)
+            )
+            return None
+
+    return tuple(unique_username)
+
+
+def decode_group_name(group_name, encoding, user_tuple):
+    """Decode a group name.
+
+    :param bytes group_name: The name of the group.
+
+    :param str encoding: The expected encoding for the group name.
+
+    :param tuple user_tuple: A tuple containing unique ID and username.
+
+    :returns: The group name, as a string, or None.
+
+    The user tuple is only used for logging, if the decode fails.
+    """
+    try:
+        return group_name.decode(encoding)
+    except UnicodeError:
+        logger.error('Could not decode group name "%s"; '
+                     'user %s (%s) is a member.  Skipping.'
+                     % (group_name,
+                        user_tuple[0], user_tuple[1])
+        )
+        return None
+
+
+def add_user_to_group(index, user_tuple, group_name, group_names):
     """Add a user to a group.
 
-    :param cursor: An active sqlite3 cursor.
-    :type cursor: sqlite3.Cursor
+    :param index: The membership index.
+    :type index: stanford_wglurp.ldap.membership.MembershipIndex
 
     :param tuple user_tuple: A tuple containing unique ID and username.
 
     :param bytes group_name: The name of the group.
 
-    :param str encoding: The expected encoding for the group name.
+    :param group_names: The cache used to decode the group name.
+    :type group_names: stanford_wglurp.ldap.groupcache.GroupNameCache
 
-    :returns: The group name, as a string.
+    :returns: The group name, as a string, or None if the user was not added.
 
     This method is a support method, used by some of the LDAP callbacks.  Given
     a user tuple (userid and username), and a group name, this adds the user to
@@ -37,67 +113,44 @@ def add_user_to_group(cursor, user_tuple, group_name, encoding):
 
     .. note::
 
-        This code does database operations, but transaction management is left
-        to the caller.
+        The database changes are queued in the index, and will not be made
+        until the index is flushed.
     """
     # First, decode the group_name name to a string.
-    try:
-        group_name = group_name.decode(encoding)
-    except UnicodeError:
-        logger.error('Could not decode group_name name "%s"; '
-                     'user %s (%s) is a member.  Skipping.'
-                     % (group_name,
-                        user_tuple[0]. user_tuple[1])
-        )
+    group_name = group_names.decode(group_name, user_tuple)
+    if group_name is None:
         return None
 
-    # Now, find out if the group_name already exists.
-    cursor.execute('''
-        SELECT COUNT(*)
-          FROM workgroups
-         WHERE name = ?
-    ''', (group_name,))
-    workgroup_name_count = cursor.fetchone()
-
-    # If the list doesn't exist, create it.
-    if workgroup_name_count[0] == 0:
-        logger.info('Discovered group_name %s' % group_name)
-        cursor.execute('''
-            INSERT
-              INTO workgroups
-                   (name)
-            VALUES (?)
-        ''', (group_name,))
-
     # Now we can add the user to the workgroup_name!
     logger.info('Adding user %s (%s) to group %s'
                 % (user_tuple[0], user_tuple[1], group_name)
     )
-    cursor.execute('''
-        INSERT
-          INTO workgroup_members
-               (workgroup_name, member_id)
-        VALUES (?, ?)
-    ''', (group_name, user_tuple[0]))
+    if index.add_to_group(user_tuple[0], group_name) is False:
+        logger.warning('User %s (%s) was already in group %s'
+                       % (user_tuple[0], user_tuple[1], group_name)
+        )
+        return None
 
     # All done!  Return the group name as a proper string.
     return group_name
 
 
-def remove_user_from_group(cursor, user_tuple, group_name, encoding=None):
+def remove_user_from_group(index, user_tuple, group_name, group_names=None):
     """Remove a user from a group.
 
-    :param cursor: An active sqlite3 cursor.
-    :type cursor: sqlite3.Cursor
+    :param index: The membership index.
+    :type index: stanford_wglurp.ldap.membership.MembershipIndex
 
     :param tuple user_tuple: A tuple containing unique ID and username.
 
     :param group_name: The name of the group.
     :type group_name: bytes or str
 
-    :param str encoding: The expected encoding for the group name, if group_name is bytes.
+    :param group_names: The cache used to decode the group name, if
+    group_name is bytes.
+    :type group_names: stanford_wglurp.ldap.groupcache.GroupNameCache
 
-    :returns: The group name, as a string.
+    :returns: The group name, as a string, or None if the user was not removed.
 
     This method is a support method, used by some of the LDAP callbacks.  Given
     a user tuple (userid and username), and a group name, this removes the user
@@ -106,46 +159,204 @@ def remove_user_from_group(cursor, user_tuple, group_name, encoding=None):
 
     .. note::
 
-        This code does database operations, but transaction management is left
-        to the caller.
+        The database changes are queued in the index, and will not be made
+        until the index is flushed.
     """
     # First, decode the group_name name to a string.
-    try:
-        if encoding is not None:
-            group_name = group_name.decode(encoding)
-    except UnicodeError:
-        logger.error('Could not decode group_name name "%s"; '
-                     'user %s (%s) is a member.  Skipping.'
-                     % (group_name,
-                        user_tuple[0]. user_tuple[1])
-        )
-        return None
+    if group_names is not None:
+        group_name = group_names.decode(group_name, user_tuple)
+        if group_name is None:
+            return None
 
     # Log, and then delete.
     logger.info('Removing user %s (%s) from group %s'
                 % (user_tuple[0], user_tuple[1], group_name)
     )
+    if index.remove_from_group(user_tuple[0], group_name) is False:
+        logger.warning('User %s (%s) was not in group %s'
+                       % (user_tuple[0], user_tuple[1], group_name)
+        )
+        return None
+
+    # All done!  Return the group name as a proper string.
+    return group_name
+
+
+def sync_changes(cursor, groups_table=None, chunk_size=1000,
+                 fetch_size=1000):
+    """Walk the membership of every group, as a stream of SYNC changes.
+
+    :param cursor: An sqlite3 cursor, which will be used only by us.
+    :type cursor: sqlite3.Cursor
+
+    :param str groups_table: Optionally, the name of a table whose `name`
+    column lists the groups to walk.  If not provided, all groups are walked.
+
+    :param int chunk_size: The most members to put into one change.
+
+    :param int fetch_size: The number of rows to fetch from the database at
+    once.
+
+    :returns: A generator of (action, group name, member list) tuples.
+
+    A group with no more than `chunk_size` members gets a single SYNC change.
+    A bigger group gets a SYNC_BEGIN change, then a SYNC_CHUNK change for each
+    `chunk_size` members (sorted by unique ID), and then a SYNC_END change.
+    The BEGIN and END changes have no members.
+
+    No more than one chunk of members is held at a time, no matter how big
+    the group is.
+
+    .. note::
+
+        The cursor is in use until the generator is exhausted, so do not pass
+        a cursor that is needed for anything else.
+    """
+    query_memberships(cursor, groups_table)
+
+    current_group = None
+    current_members = list()
+    chunked = False
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if len(rows) == 0:
+            break
+        for (group_name, uniqueid, username) in rows:
+            if group_name != current_group:
+                # Finish the previous group.
+                if chunked is True:
+                    yield ('SYNC_CHUNK', current_group, current_members)
+                    yield ('SYNC_END', current_group, list())
+                elif current_group is not None:
+                    yield ('SYNC', current_group, current_members)
+                current_group = group_name
+                current_members = list()
+                chunked = False
+
+            # We only know a group needs chunks once it outgrows one.
+            if len(current_members) == chunk_size:
+                if chunked is False:
+                    yield ('SYNC_BEGIN', current_group, list())
+                    chunked = True
+                yield ('SYNC_CHUNK', current_group, current_members)
+                current_members = list()
+            current_members.append((uniqueid, username))
+
+    # Don't forget the last group!
+    if chunked is True:
+        yield ('SYNC_CHUNK', current_group, current_members)
+        yield ('SYNC_END', current_group, list())
+    elif current_group is not None:
+        yield ('SYNC', current_group, current_members)
+
+
+def query_memberships(cursor, groups_table=None):
+    """Run the query used to walk group memberships.
+
+    :param cursor: An sqlite3 cursor.
+    :type cursor: sqlite3.Cursor
+
+    :param str groups_table: Optionally, the name of a table whose `name`
+    column lists the groups to walk.  If not provided, all groups are walked.
+
+    :returns: None.
+
+    The query returns (group name, unique ID, username) rows, with each
+    group's rows together, and sorted by unique ID.
+    """
+    if groups_table is None:
+        where_clause = ''
+    else:
+        where_clause = ('WHERE workgroups.name IN '
+                        '(SELECT name FROM %s)' % groups_table)
+
+    # We order by group ID, which follows the mapping table's primary key.
     cursor.execute('''
-        DELETE
-          FROM workgroup_members
-         WHERE workgroup_name = ?
-           AND member_id = ?
-    ''', (group_name, user_tuple[0]))
+            SELECT workgroups.name,
+                   members.uniqueid,
+                   members.username
+              FROM workgroup_members
+        INNER JOIN workgroups
+                ON workgroups.id = workgroup_members.workgroup_id
+        INNER JOIN members
+                ON members.id = workgroup_members.member_id
+              %s
+          ORDER BY workgroup_members.workgroup_id, members.uniqueid
+    ''' % where_clause)
+
+
+def iterate_groups(cursor, fetch_size=1000):
+    """Group the results of a membership query.
+
+    :param cursor: An sqlite3 cursor, which has just executed a query.
+    :type cursor: sqlite3.Cursor
 
-    # Is the group empty now?  If yes, then delete it.
+    :param int fetch_size: The number of rows to fetch from the database at
+    once.
+
+    :returns: A generator of (group name, member list) tuples.
+
+    The query must return (group name, unique ID, username) rows, with each
+    group's rows next to each other.  Each time the group name changes, the
+    previous group's member list (a list of unique ID and username tuples) is
+    yielded.
+    """
+    current_group = None
+    current_members = list()
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if len(rows) == 0:
+            break
+        for (group_name, uniqueid, username) in rows:
+            if group_name != current_group:
+                if current_group is not None:
+                    yield (current_group, current_members)
+                current_group = group_name
+                current_members = list()
+            current_members.append((uniqueid, username))
+
+    # Don't forget the last group!
+    if current_group is not None:
+        yield (current_group, current_members)
+
+
+def get_state(cursor, name):
+    """Read a value from the local state table.
+
+    :param cursor: An active sqlite3 cursor.
+    :type cursor: sqlite3.Cursor
+
+    :param str name: The name of the state value.
+
+    :returns: The value, as a string, or None if it is not set.
+    """
     cursor.execute('''
-        SELECT COUNT(*)
-          FROM workgroup_members
-         WHERE workgroup_name = ?
-    ''', (group_name,))
-    membership_count = cursor.fetchone()
-    if membership_count[0] == 0:
-        logger.info('Group %s is now empty.' % group_name)
-        cursor.execute('''
-            DELETE
-              FROM workgroups
-             WHERE name = ?
-        ''', (group_name,))
+        SELECT value
+          FROM wglurp_state
+         WHERE name = ?
+    ''', (name,))
+    result = cursor.fetchone()
+    return (None if result is None else result[0])
 
-    # All done!  Return the group name as a proper string.
-    return group_name
+
+def set_state(cursor, name, value):
+    """Write a value to the local state table.
+
+    :param cursor: An active sqlite3 cursor.
+    :type cursor: sqlite3.Cursor
+
+    :param str name: The name of the state value.
+
+    :param str value: The value to set.
+
+    .. note::
+
+        This code does database operations, but transaction management is left
+        to the caller.
+    """
+    cursor.execute('''
+        INSERT OR REPLACE
+          INTO wglurp_state
+               (name, value)
+        VALUES (?, ?)
+    ''', (name, value))
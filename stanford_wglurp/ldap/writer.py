@@ -0,0 +1,283 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp LDAP change writer.
+#
+# Refer to the AUTHORS file for copyright statements.
+#
+
+# The Syncrepl client thread must keep reading from the LDAP server, even when
+# the database is slow (or reconnecting).  So, the callbacks never write to the
+# database themselves.  Instead, changes go into a bounded queue, and a
+# separate writer thread takes everything waiting in the queue, and writes it
+# in a single transaction (a "group commit").  If the queue fills up, the
+# callbacks wait for room, which we count, so it shows up in the metrics.
+#
+# If a write fails, the batch goes into the on-disk spool, and so does every
+# batch after it, until the spool has been replayed into the database.  That
+# way, a database outage never holds up the queue, and order is kept.
+#
+# A change is "durable" once it has been written to the database, or synced
+# to the spool.  flush() waits until everything queued so far is durable, for
+# callers which must not record something locally until its changes are safe.
+
+
+# We have to load the logger first!
+from ..logging import logger
+
+import queue
+import threading
+import time
+
+from ..db import changes, engine
+
+
+class ChangeWriter(object):
+    """Write changes to the database from a separate thread.
+
+    :param int queue_size: The maximum number of changes waiting to be
+    written.
+
+    :param spool: The spool to use when the database can't be written to.
+    :type spool: stanford_wglurp.ldap.spool.ChangeSpool
+
+    :param float retry_interval: The number of seconds to wait after a failed
+    write, before trying to replay the spool.
+
+    Changes are queued by :meth:`send`, and written by the thread running
+    :meth:`run`.  Changes are written in the order they were queued.
+    :meth:`flush` waits until everything queued so far is durable.
+
+    The following counters are kept for metrics: `changes_queued`,
+    `changes_written`, `batches_written`, `write_failures`, `send_waits` (the
+    number of times :meth:`send` had to wait for room in the queue), and
+    `send_wait_time` (the total seconds spent waiting).
+    """
+
+    def __init__(self, queue_size, spool, retry_interval=5.0):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_size = queue_size
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.next_replay = 0
+
+        # Changes are counted (before they are queued) and marked durable
+        # under this condition, so that flush() can wait for them.
+        self.durable_condition = threading.Condition()
+        self.changes_durable = 0
+
+        # Counters for metrics.
+        self.changes_queued = 0
+        self.changes_written = 0
+        self.batches_written = 0
+        self.write_failures = 0
+        self.send_waits = 0
+        self.send_wait_time = 0.0
+
+
+    def send(self, action, groups):
+        """Queue a change for each of a number of groups.
+
+        :param str action: The change action ("SYNC", "ADD", or "REMOVE").
+
+        :param groups: The groups, and their members, to send.
+        :type groups: Iterable of (group name, member list) tuples
+
+        :returns: The number of changes queued.
+
+        If the queue is full, this waits until there is room.
+        """
+        return self.send_changes(
+            (action, group_name, members) for (group_name, members) in groups
+        )
+
+
+    def send_changes(self, changes):
+        """Queue a number of changes.
+
+        :param changes: The changes to send.
+        :type changes: Iterable of (action, group name, member list) tuples
+
+        :returns: The number of changes queued.
+
+        The changes are read as they are queued, so they may come from a
+        generator.  If the queue is full, this waits until there is room.
+        """
+        change_count = 0
+        for (action, group_name, members) in changes:
+            logger.debug('Queueing %s for group %s' % (action, group_name))
+            change = (action, group_name, list(members))
+            with self.durable_condition:
+                self.changes_queued = self.changes_queued + 1
+            try:
+                self.queue.put_nowait(change)
+            except queue.Full:
+                wait_start = time.monotonic()
+                self.queue.put(change)
+                self.send_waits = self.send_waits + 1
+                self.send_wait_time = (self.send_wait_time
+                                       + time.monotonic() - wait_start)
+            change_count = change_count + 1
+        return change_count
+
+
+    def flush(self, timeout=None):
+        """Wait until every change queued so far is durable.
+
+        :param float timeout: The most seconds to wait.  If None, wait
+        forever.
+
+        :returns: True if everything is durable, or False if we timed out.
+
+        A change is durable once it is in the database, or in the spool.
+        """
+        with self.durable_condition:
+            target = self.changes_queued
+            return self.durable_condition.wait_for(
+                lambda: self.changes_durable >= target, timeout
+            )
+
+
+    def _durable(self, change_count):
+        # Mark changes (in queue order) as durable, and wake up flush().
+        with self.durable_condition:
+            self.changes_durable = self.changes_durable + change_count
+            self.durable_condition.notify_all()
+
+
+    def queue_depth(self):
+        """Get the number of changes waiting to be written.
+
+        :returns: An int.
+        """
+        return self.queue.qsize()
+
+
+    def _take(self, timeout):
+        # Wait for a change, and then take everything else that's waiting.
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return list()
+        while len(batch) < self.queue_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+
+    def write(self, batch):
+        """Write a batch of queued changes, in one transaction.
+
+        :param list batch: A list of (action, group name, member list) tuples.
+
+        :returns: None.
+
+        Exceptions from the database are raised.
+        """
+        db_session = engine.Session()
+        try:
+            written = changes.write_changes(db_session, (
+                changes.ChangeEntry(
+                    action = action,
+                    group = group_name,
+                    members = members,
+                )
+                for (action, group_name, members) in batch
+            ))
+        finally:
+            db_session.close()
+        self.changes_written = self.changes_written + written
+        self.batches_written = self.batches_written + 1
+
+
+    def replay(self):
+        """Write one batch of changes from the spool.
+
+        :returns: None.
+
+        Exceptions from the database are raised.
+        """
+        (batch, offset) = self.spool.read(self.queue_size)
+        self.write(batch)
+        self.spool.advance(offset, len(batch))
+        logger.info('Replayed %d changes from the spool; %d remain.'
+                    % (len(batch), self.spool.pending)
+        )
+
+
+    def run(self, finish_event):
+        """Write queued changes, until told to finish.
+
+        :param threading.Event finish_event: When set, everything left in the
+        queue is written, and we return.
+
+        :returns: None.
+
+        If a write fails, the batch is spooled, as is everything after it,
+        until the spool has been replayed.  The spool is replayed one batch
+        per pass, between taking new changes from the queue (which go to the
+        back of the spool), so the queue keeps moving during a replay.
+        """
+        while not (finish_event.is_set() and self.queue.empty()):
+            # While there's spool to replay, don't wait for new changes, so
+            # the spool drains as fast as the database will take it.
+            if (not self.spool.is_empty()
+                and time.monotonic() >= self.next_replay
+            ):
+                batch = self._take(timeout=0)
+            else:
+                batch = self._take(timeout=1.0)
+
+            # If the spool is empty, try writing straight to the database.
+            if len(batch) > 0 and self.spool.is_empty():
+                try:
+                    self.write(batch)
+                    logger.debug('Wrote %d changes.' % len(batch))
+                    self._durable(len(batch))
+                    batch = list()
+                except Exception as e:
+                    self.write_failures = self.write_failures + 1
+                    logger.error('Unable to write %d changes: %s'
+                                 % (len(batch), e)
+                    )
+                    logger.warning('Spooling changes until the database '
+                                   'recovers.'
+                    )
+                    self.next_replay = time.monotonic() + self.retry_interval
+
+            # Otherwise, the changes go to the back of the spool.
+            if len(batch) > 0:
+                self.spool.append(batch)
+                self._durable(len(batch))
+
+            # Work on the spool, if it's time.
+            if (not self.spool.is_empty()
+                and time.monotonic() >= self.next_replay
+            ):
+                try:
+                    self.replay()
+                except Exception as e:
+                    self.write_failures = self.write_failures + 1
+                    logger.error('Unable to replay the spool: %s' % e)
+                    self.next_replay = time.monotonic() + self.retry_interval
+
+        # Make one last try at emptying the spool.
+        try:
+            while not self.spool.is_empty():
+                self.replay()
+        except Exception as e:
+            logger.error('Unable to replay the spool: %s' % e)
+        if not self.spool.is_empty():
+            logger.warning('%d changes remain in the spool, and will be '
+                           'written at the next start.' % self.spool.pending
+            )
+        self.spool.close()
+
+        logger.info('Change writer wrote %d changes in %d batches.  Senders '
+                    'waited %d times, for %.1f seconds total.'
+                    % (self.changes_written, self.batches_written,
+                       self.send_waits, self.send_wait_time)
+        )
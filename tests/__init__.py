@@ -0,0 +1,15 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp tests.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# These tests cover the pure functions whose results are stored in the
+# database, or which separate processes must agree on.  They need an
+# installed package (with a working configuration), but no LDAP server or
+# database.
+#
+# Run them with `python -m unittest discover tests` (or `python setup.py
+# test`).
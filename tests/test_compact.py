@@ -0,0 +1,138 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp tests for queue compaction.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+import unittest
+
+from stanford_wglurp.db import encoding
+from stanford_wglurp.db.schema import Changes
+from stanford_wglurp.expander.compact import merge_run
+
+
+class FakeQuery(object):
+    # merge_run only filters to the run, so return the whole run.
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, *args):
+        return self
+
+    def order_by(self, *args):
+        return self
+
+    def all(self):
+        return sorted(self.rows, key=lambda row: row.id)
+
+
+class FakeSession(object):
+    # Just enough of a session for merge_run.
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.deleted = list()
+
+    def query(self, table):
+        return FakeQuery(self.rows)
+
+    def delete(self, row):
+        self.deleted.append(row)
+
+    def flush(self):
+        pass
+
+
+def make_change(change_id, action, members):
+    """Make an ADD or REMOVE change.
+
+    :param int change_id: The change's ID.
+
+    :param str action: The change's action.
+
+    :param list members: The change's (uniqueid, username) tuples.
+
+    :returns: A Changes object.
+    """
+    (payload_format, data, payload) = encoding.encode_members(members)
+    return Changes(id=change_id, worker=1, action=action, group='group',
+                   payload_format=payload_format, data=data, payload=payload)
+
+
+class MergeRunTests(unittest.TestCase):
+
+    def merge(self, changes):
+        """Merge a run, and return what is left.
+
+        :param list changes: The Changes in the run.
+
+        :returns: A tuple of (removed count, remaining), where remaining is a
+        list of (ID, action, members) tuples.
+        """
+        session = FakeSession(changes)
+        removed_count = merge_run(session,
+                                  [change.id for change in changes])
+        remaining = [
+            (change.id, change.action, encoding.decode_members(
+                change.payload_format, change.data, change.payload
+            ))
+            for change in changes if change not in session.deleted
+        ]
+        return (removed_count, remaining)
+
+    def test_cancelled_pair(self):
+        # A remove, then an add, of the same person: only the add is left.
+        (removed_count, remaining) = self.merge([
+            make_change(1, 'REMOVE', [('1', 'alice')]),
+            make_change(2, 'ADD', [('1', 'alice')]),
+        ])
+        self.assertEqual(removed_count, 1)
+        self.assertEqual(remaining, [
+            (2, 'ADD', [('1', 'alice')]),
+        ])
+
+    def test_cancelled_pair_with_others(self):
+        # An add, then a remove, of the same person: only the remove is left,
+        # and other people are kept.
+        (removed_count, remaining) = self.merge([
+            make_change(1, 'ADD', [('1', 'alice'), ('2', 'bob')]),
+            make_change(2, 'REMOVE', [('1', 'alice')]),
+            make_change(3, 'ADD', [('3', 'carol')]),
+        ])
+        self.assertEqual(removed_count, 1)
+        self.assertEqual(remaining, [
+            (1, 'REMOVE', [('1', 'alice')]),
+            (2, 'ADD', [('2', 'bob'), ('3', 'carol')]),
+        ])
+
+    def test_username_change(self):
+        # A username change is a remove of the old name, and an add of the
+        # new name.  Both have to survive.
+        (removed_count, remaining) = self.merge([
+            make_change(1, 'ADD', [('2', 'bob')]),
+            make_change(2, 'REMOVE', [('1', 'alice')]),
+            make_change(3, 'ADD', [('1', 'alicia')]),
+        ])
+        self.assertEqual(removed_count, 1)
+        self.assertEqual(remaining, [
+            (1, 'REMOVE', [('1', 'alice')]),
+            (2, 'ADD', [('2', 'bob'), ('1', 'alicia')]),
+        ])
+
+    def test_everything_cancels(self):
+        (removed_count, remaining) = self.merge([
+            make_change(1, 'ADD', [('1', 'alice')]),
+            make_change(2, 'ADD', [('2', 'bob')]),
+            make_change(3, 'REMOVE', [('1', 'alice'), ('2', 'bob')]),
+        ])
+        self.assertEqual(removed_count, 2)
+        self.assertEqual(remaining, [
+            (1, 'REMOVE', [('1', 'alice'), ('2', 'bob')]),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
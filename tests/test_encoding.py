@@ -0,0 +1,148 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp tests for queue payload encoding.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+import unittest
+import zlib
+
+from stanford_wglurp.db import encoding
+
+
+MEMBERS = [
+    ('1234567', 'akkornel'),
+    ('2345678', 'jdoe'),
+    ('3456789', 'müller'),
+]
+
+MESSAGE = {
+    'group': 'workgroup:stanford-it',
+    'adds': [['1234567', 'akkornel']],
+    'removes': [],
+}
+
+
+class EncodeMembersTests(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        (payload_format, data, payload) = encoding.encode_members(
+            MEMBERS, packed=False
+        )
+        self.assertEqual(payload_format, encoding.PAYLOAD_JSON)
+        self.assertIsNone(payload)
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, payload), MEMBERS
+        )
+
+    def test_packed_round_trip(self):
+        (payload_format, data, payload) = encoding.encode_members(
+            MEMBERS, packed=True
+        )
+        self.assertEqual(payload_format, encoding.PAYLOAD_PACKED)
+        self.assertIsNone(data)
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, payload), MEMBERS
+        )
+
+    def test_json_empty(self):
+        (payload_format, data, payload) = encoding.encode_members(
+            list(), packed=False
+        )
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, payload), list()
+        )
+
+    def test_packed_empty(self):
+        (payload_format, data, payload) = encoding.encode_members(
+            list(), packed=True
+        )
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, payload), list()
+        )
+
+    def test_json_null(self):
+        # Old rows can have no data at all.
+        self.assertEqual(
+            encoding.decode_members(encoding.PAYLOAD_JSON, None, None), list()
+        )
+
+    def test_packed_layout(self):
+        # Stored rows must stay readable, so the layout must not change.
+        (payload_format, data, payload) = encoding.encode_members(
+            [('1', 'a'), ('2', 'b')], packed=True
+        )
+        self.assertEqual(zlib.decompress(payload), b'1\x00a\x002\x00b')
+
+    def test_packed_memoryview(self):
+        # psycopg2 hands back bytea columns as memoryviews.
+        (payload_format, data, payload) = encoding.encode_members(
+            MEMBERS, packed=True
+        )
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, memoryview(payload)),
+            MEMBERS
+        )
+
+    def test_zjson_members(self):
+        (payload_format, data, payload) = encoding.encode_message(
+            [list(member) for member in MEMBERS], packed=True
+        )
+        self.assertEqual(payload_format, encoding.PAYLOAD_ZJSON)
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, payload), MEMBERS
+        )
+
+    def test_zjson_empty_members(self):
+        (payload_format, data, payload) = encoding.encode_message(
+            list(), packed=True
+        )
+        self.assertEqual(
+            encoding.decode_members(payload_format, data, payload), list()
+        )
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            encoding.decode_members(99, None, None)
+
+    def test_format_values(self):
+        # These values are stored in the database.
+        self.assertEqual(encoding.PAYLOAD_JSON, 0)
+        self.assertEqual(encoding.PAYLOAD_PACKED, 1)
+        self.assertEqual(encoding.PAYLOAD_ZJSON, 2)
+
+
+class EncodeMessageTests(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        (payload_format, message, payload) = encoding.encode_message(
+            MESSAGE, packed=False
+        )
+        self.assertEqual(payload_format, encoding.PAYLOAD_JSON)
+        self.assertIsNone(payload)
+        self.assertEqual(
+            encoding.decode_message(payload_format, message, payload), MESSAGE
+        )
+
+    def test_zjson_round_trip(self):
+        (payload_format, message, payload) = encoding.encode_message(
+            MESSAGE, packed=True
+        )
+        self.assertEqual(payload_format, encoding.PAYLOAD_ZJSON)
+        self.assertIsNone(message)
+        self.assertEqual(
+            encoding.decode_message(payload_format, message, payload), MESSAGE
+        )
+
+    def test_packed_is_not_a_message(self):
+        (payload_format, data, payload) = encoding.encode_members(
+            MEMBERS, packed=True
+        )
+        with self.assertRaises(ValueError):
+            encoding.decode_message(payload_format, data, payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
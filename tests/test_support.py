@@ -0,0 +1,134 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp tests for SYNC chunking.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+import sqlite3
+import unittest
+
+from stanford_wglurp.ldap.support import sync_changes
+
+
+def make_members(count):
+    """Make a sorted list of members.
+
+    :param int count: The number of members.
+
+    :returns: A list of (uniqueid, username) tuples, sorted by unique ID.
+    """
+    return [('%07d' % number, 'user%d' % number) for number in range(count)]
+
+
+class SyncChangesTests(unittest.TestCase):
+
+    def setUp(self):
+        # Just enough of the membership tables for the query.
+        self.connection = sqlite3.connect(':memory:')
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            CREATE TABLE members (
+                id       INTEGER PRIMARY KEY,
+                uniqueid TEXT,
+                username TEXT
+            )''')
+        cursor.execute('''
+            CREATE TABLE workgroups (
+                id   INTEGER PRIMARY KEY,
+                name TEXT
+            )''')
+        cursor.execute('''
+            CREATE TABLE workgroup_members (
+                workgroup_id INTEGER,
+                member_id    INTEGER,
+                PRIMARY KEY (workgroup_id, member_id)
+            )''')
+
+    def tearDown(self):
+        self.connection.close()
+
+    def add_group(self, name, members):
+        cursor = self.connection.cursor()
+        cursor.execute('INSERT INTO workgroups (name) VALUES (?)', (name,))
+        group_id = cursor.lastrowid
+        for (uniqueid, username) in members:
+            cursor.execute('SELECT id FROM members WHERE uniqueid = ?',
+                           (uniqueid,))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('''
+                    INSERT INTO members (uniqueid, username) VALUES (?, ?)
+                ''', (uniqueid, username))
+                member_id = cursor.lastrowid
+            else:
+                member_id = row[0]
+            cursor.execute('''
+                INSERT INTO workgroup_members (workgroup_id, member_id)
+                VALUES (?, ?)
+            ''', (group_id, member_id))
+
+    def sync(self, **kwargs):
+        return list(sync_changes(self.connection.cursor(), **kwargs))
+
+    def test_exactly_chunk_size(self):
+        members = make_members(5)
+        self.add_group('group', members)
+        self.assertEqual(self.sync(chunk_size=5), [
+            ('SYNC', 'group', members),
+        ])
+
+    def test_one_over_chunk_size(self):
+        members = make_members(6)
+        self.add_group('group', members)
+        self.assertEqual(self.sync(chunk_size=5), [
+            ('SYNC_BEGIN', 'group', list()),
+            ('SYNC_CHUNK', 'group', members[:5]),
+            ('SYNC_CHUNK', 'group', members[5:]),
+            ('SYNC_END', 'group', list()),
+        ])
+
+    def test_two_full_chunks(self):
+        members = make_members(10)
+        self.add_group('group', members)
+        self.assertEqual(self.sync(chunk_size=5), [
+            ('SYNC_BEGIN', 'group', list()),
+            ('SYNC_CHUNK', 'group', members[:5]),
+            ('SYNC_CHUNK', 'group', members[5:]),
+            ('SYNC_END', 'group', list()),
+        ])
+
+    def test_several_groups(self):
+        # Groups on either side of a chunked group, with fetches which don't
+        # line up with groups or chunks.
+        small = make_members(2)
+        big = make_members(6)
+        self.add_group('first', small)
+        self.add_group('second', big)
+        self.add_group('third', small)
+        self.assertEqual(self.sync(chunk_size=5, fetch_size=3), [
+            ('SYNC', 'first', small),
+            ('SYNC_BEGIN', 'second', list()),
+            ('SYNC_CHUNK', 'second', big[:5]),
+            ('SYNC_CHUNK', 'second', big[5:]),
+            ('SYNC_END', 'second', list()),
+            ('SYNC', 'third', small),
+        ])
+
+    def test_groups_table(self):
+        self.add_group('first', make_members(2))
+        self.add_group('second', make_members(3))
+        cursor = self.connection.cursor()
+        cursor.execute('CREATE TEMP TABLE wanted (name TEXT)')
+        cursor.execute("INSERT INTO wanted (name) VALUES ('second')")
+        self.assertEqual(self.sync(groups_table='wanted', chunk_size=5), [
+            ('SYNC', 'second', make_members(3)),
+        ])
+
+    def test_no_groups(self):
+        self.assertEqual(self.sync(chunk_size=5), list())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 et
+
+# stanford-wglurp tests for worker assignment.
+#
+# Refer to the AUTHORS file for copyright statements.
+
+# The Syncrepl client and the expander must put each group on the same
+# worker, even when they run different versions, so these are golden values:
+# if one of them changes, groups will move between workers.
+
+import unittest
+
+from stanford_wglurp.db.workers import group_key, jump_hash, worker_for_group
+
+
+class GroupKeyTests(unittest.TestCase):
+
+    def test_golden(self):
+        self.assertEqual(group_key('workgroup:stanford-it'),
+                         11887918358725552605)
+        self.assertEqual(group_key('workgroup:research-computing'),
+                         4012439543668767379)
+        self.assertEqual(group_key(''), 16476032584258269876)
+
+
+class JumpHashTests(unittest.TestCase):
+
+    def test_golden(self):
+        self.assertEqual(jump_hash(0, 10), 0)
+        self.assertEqual(jump_hash(1, 10), 6)
+        self.assertEqual(jump_hash(2**64 - 1, 10), 9)
+
+    def test_range(self):
+        for key in range(1000):
+            self.assertIn(jump_hash(key, 7), range(7))
+
+    def test_consistent(self):
+        # Adding a bucket only moves keys into the new bucket.
+        for key in range(1000):
+            before = jump_hash(key, 7)
+            after = jump_hash(key, 8)
+            self.assertIn(after, (before, 7))
+
+
+class WorkerForGroupTests(unittest.TestCase):
+
+    def test_golden(self):
+        for (group, workers) in (
+            ('workgroup:stanford-it', [1, 2, 3, 5, 14]),
+            ('workgroup:research-computing', [1, 1, 3, 3, 3]),
+            ('sunet:everyone', [1, 2, 2, 2, 2]),
+        ):
+            self.assertEqual(
+                [worker_for_group(group, count) for count in (1, 2, 4, 8, 16)],
+                workers
+            )
+
+    def test_never_zero(self):
+        # Worker #0 is reserved.
+        for number in range(1000):
+            self.assertIn(worker_for_group('group%d' % number, 4),
+                          (1, 2, 3, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()